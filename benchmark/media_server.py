@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+基准测试使用的本地媒体服务器，生成指定大小的合成视频，不需要访问真实网站。
+
+    /api/<id>?kind=progressive|hls&size=...      视频元数据（供 fakevideo 提取器使用）
+    /media/<id>.mp4?size=...                     单文件视频，支持 Range
+    /hls/<id>/index.m3u8?segments=...&size=...   HLS 播放列表
+    /hls/<id>/<n>.ts?size=...                    HLS 分片
+
+所有请求都支持 latency（毫秒，响应前的延迟）和 rate（字节/秒，0 为不限速）参数。
+"""
+
+import argparse
+import json
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+
+# 合成内容由这个块重复组成，同一偏移处的字节总是相同，便于校验和断点续传
+PATTERN = bytes(range(256)) * 256
+CHUNK_SIZE = 64 * 1024
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """解析单段 Range 请求头，返回 [start, end]；不合法时返回 None"""
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", (header or "").strip())
+    if not match or not (match.group(1) or match.group(2)):
+        return None
+    if match.group(1):
+        start = int(match.group(1))
+        end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+    else:
+        start = max(size - int(match.group(2)), 0)
+        end = size - 1
+    return (start, end) if start <= end else None
+
+class MediaRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "BenchmarkMedia/1.0"
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def do_HEAD(self) -> None:
+        self.handle_request(send_body=False)
+
+    def do_GET(self) -> None:
+        self.handle_request(send_body=True)
+
+    def handle_request(self, send_body: bool) -> None:
+        parts = urllib.parse.urlsplit(self.path)
+        params: Dict[str, str] = dict(urllib.parse.parse_qsl(parts.query))
+        latency = float(params.get("latency", 0)) / 1000
+        if latency:
+            time.sleep(latency)
+        self.server.requests += 1
+
+        match = re.fullmatch(r"/api/([\w-]+)", parts.path)
+        if match:
+            return self.send_json(self.video_metadata(match.group(1), params, parts.query), send_body)
+        match = re.fullmatch(r"/media/([\w-]+)\.mp4", parts.path)
+        if match:
+            return self.send_media(int(params.get("size", 1024 * 1024)), "video/mp4", params, send_body)
+        match = re.fullmatch(r"/hls/([\w-]+)/index\.m3u8", parts.path)
+        if match:
+            return self.send_playlist(params, parts.query, send_body)
+        match = re.fullmatch(r"/hls/([\w-]+)/(\d+)\.ts", parts.path)
+        if match:
+            return self.send_media(int(params.get("size", 256 * 1024)), "video/mp2t", params, send_body)
+        self.send_error(404)
+
+    def base_url(self) -> str:
+        return f"http://{self.headers.get('Host') or '127.0.0.1'}"
+
+    def video_metadata(self, video_id: str, params: Dict[str, str], query: str) -> Dict[str, object]:
+        kind = params.get("kind", "progressive")
+        size = int(params.get("size", 1024 * 1024))
+        metadata: Dict[str, object] = {"id": video_id, "title": f"Benchmark video {video_id}", "kind": kind, "size": size}
+        if kind == "hls":
+            segments = int(params.get("segments", 10))
+            segment_params = dict(params, size=str(max(size // segments, 1)))
+            metadata["manifest"] = f"{self.base_url()}/hls/{video_id}/index.m3u8?{urllib.parse.urlencode(segment_params)}"
+            metadata["duration"] = segments * 4
+        else:
+            metadata["url"] = f"{self.base_url()}/media/{video_id}.mp4?{query}"
+            metadata["duration"] = 60
+        return metadata
+
+    def send_json(self, data: Dict[str, object], send_body: bool) -> None:
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def send_playlist(self, params: Dict[str, str], query: str, send_body: bool) -> None:
+        segments = int(params.get("segments", 10))
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-TARGETDURATION:4", "#EXT-X-MEDIA-SEQUENCE:0"]
+        for index in range(segments):
+            lines.extend(["#EXTINF:4.0,", f"{index}.ts?{query}"])
+        lines.append("#EXT-X-ENDLIST")
+        body = ("\n".join(lines) + "\n").encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/vnd.apple.mpegurl")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def send_media(self, size: int, content_type: str, params: Dict[str, str], send_body: bool) -> None:
+        rate = float(params.get("rate", 0))
+        start, end = 0, size - 1
+        byte_range = parse_range(self.headers.get("Range"), size)
+        if byte_range is not None:
+            start, end = byte_range
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        if not send_body:
+            return
+
+        started_at = time.monotonic()
+        sent = 0
+        position = start
+        try:
+            while position <= end:
+                offset = position % len(PATTERN)
+                length = min(CHUNK_SIZE, end - position + 1, len(PATTERN) - offset)
+                self.wfile.write(PATTERN[offset:offset + length])
+                position += length
+                sent += length
+                if rate:
+                    # 按 rate 限速：发送得比预期快时等待
+                    ahead = sent / rate - (time.monotonic() - started_at)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        self.server.bytes_sent += sent
+
+class MediaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        super().__init__((host, port), MediaRequestHandler)
+        self.requests = 0
+        self.bytes_sent = 0
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "MediaServer":
+        threading.Thread(target=self.serve_forever, name="media-server", daemon=True).start()
+        return self
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serve synthetic videos for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8800)
+    args = parser.parse_args()
+    server = MediaServer(args.host, args.port)
+    print(f"Serving synthetic media at {server.base_url}, submit URLs like {server.base_url}/fake/demo?size=1048576")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
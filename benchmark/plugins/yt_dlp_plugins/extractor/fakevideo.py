@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+基准测试使用的 yt-dlp 提取器插件，处理本地媒体服务器（media_server.py）上的 /fake/<id> 链接。
+
+把 benchmark/plugins 加入 PYTHONPATH 后 yt-dlp 会自动加载。只匹配 127.0.0.1/localhost，
+不会影响真实网站的链接。
+"""
+
+from yt_dlp.extractor.common import InfoExtractor
+
+class FakeVideoIE(InfoExtractor):
+    IE_NAME = "fakevideo"
+    _VALID_URL = r"https?://(?:127\.0\.0\.1|localhost)(?::\d+)?/fake/(?P<id>[\w-]+)"
+
+    def _real_extract(self, url):
+        video_id = self._match_id(url)
+        # 元数据接口的 latency 参数模拟提取时访问网站 API 的耗时
+        metadata = self._download_json(url.replace("/fake/", "/api/", 1), video_id, note="Downloading metadata")
+        if metadata["kind"] == "hls":
+            formats = self._extract_m3u8_formats(metadata["manifest"], video_id, "ts", m3u8_id="hls")
+        else:
+            formats = [{
+                "format_id": "progressive",
+                "url": metadata["url"],
+                "ext": "mp4",
+                "filesize": metadata["size"],
+                "vcodec": "h264",
+                "acodec": "aac",
+            }]
+        return {
+            "id": video_id,
+            "title": metadata["title"],
+            "duration": metadata["duration"],
+            "formats": formats,
+        }
@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+yt-dlp API 的基准测试与压测，不访问真实网站。
+
+在子进程中启动 API 服务（独立的临时数据库和下载目录），由本地媒体服务器
+（media_server.py）和 fakevideo 提取器提供合成视频，然后依次运行以下场景：
+
+    download   POST /download 提交任务，并统计全部下载完成的吞吐量（任务/秒）
+    task       下载进行期间反复请求 GET /task/{id}
+    tasks      GET /tasks 分页列表
+    file       GET /download/{id}/file 读取已完成的文件（一半为 Range 请求）
+
+每个场景记录请求数、错误数、每秒请求数和 p50/p90/p99 延迟；另外记录数据库
+每秒写入的行数和服务进程的 RSS。结果写入 JSON 文件，可以用 --compare 对比
+两次运行（例如两个提交）的结果：
+
+    python benchmark/run.py --tasks 100 --output before.json
+    python benchmark/run.py --tasks 100 --output after.json
+    python benchmark/run.py --compare before.json after.json
+"""
+
+import argparse
+import datetime
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from media_server import MediaServer
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+PLUGINS_DIR = os.path.join(BENCHMARK_DIR, "plugins")
+
+# 对比结果时检查的指标：(路径, 数值越大越好)
+COMPARED_METRICS = [
+    (("downloads", "tasks_per_second"), True),
+    (("database", "row_writes_per_second"), False),
+    (("rss_mb", "peak"), False),
+] + [
+    ((scenario, key), better_high)
+    for scenario in ("download", "task", "tasks", "file")
+    for key, better_high in (("requests_per_second", True), ("p50_ms", False), ("p99_ms", False))
+]
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """最近秩法计算百分位数"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+def read_rss(pid: int) -> Optional[int]:
+    """读取进程的常驻内存（字节），只支持 Linux"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+class RssSampler:
+    """后台定期采样服务进程的 RSS，记录最大值"""
+
+    def __init__(self, pid: int, interval: float = 0.2):
+        self.pid = pid
+        self.interval = interval
+        self.samples: List[int] = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            rss = read_rss(self.pid)
+            if rss is not None:
+                self.samples.append(rss)
+            self._stop.wait(self.interval)
+
+    def start(self) -> "RssSampler":
+        self._thread.start()
+        return self
+
+    def stop(self) -> Dict[str, Optional[float]]:
+        self._stop.set()
+        self._thread.join()
+        to_mb = lambda value: round(value / 1024 / 1024, 2) if value is not None else None
+        return {
+            "start": to_mb(self.samples[0] if self.samples else None),
+            "peak": to_mb(max(self.samples) if self.samples else None),
+            "end": to_mb(self.samples[-1] if self.samples else None),
+        }
+
+class ApiClient:
+    """每个线程复用一个 keep-alive 连接的简单 HTTP 客户端"""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._local = threading.local()
+
+    def _connection(self) -> http.client.HTTPConnection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        return conn
+
+    def request(self, method: str, path: str, body: Optional[Dict[str, Any]] = None,
+                headers: Optional[Dict[str, str]] = None) -> Tuple[int, bytes, float]:
+        """发送请求并读取完整响应，返回 (状态码, 响应体, 耗时秒数)"""
+        headers = dict(headers or {})
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        started_at = time.perf_counter()
+        for attempt in range(2):
+            conn = self._connection()
+            try:
+                conn.request(method, path, body=payload, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+                return response.status, data, time.perf_counter() - started_at
+            except (http.client.HTTPException, ConnectionError):
+                # 服务端关闭了空闲连接，重连一次
+                conn.close()
+                self._local.conn = None
+                if attempt:
+                    raise
+        raise AssertionError("unreachable")
+
+    def get_json(self, path: str) -> Dict[str, Any]:
+        status, data, _ = self.request("GET", path)
+        if status != 200:
+            raise RuntimeError(f"GET {path} returned {status}: {data[:200]!r}")
+        return json.loads(data)
+
+class LoadResult:
+    """一个场景的请求延迟与错误统计"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies: List[float] = []
+        self.errors = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, ok: bool, seconds: float, size: int = 0) -> None:
+        with self._lock:
+            self.latencies.append(seconds)
+            self.bytes += size
+            if not ok:
+                self.errors += 1
+
+    def summary(self) -> Dict[str, Any]:
+        to_ms = lambda value: round(value * 1000, 3) if value is not None else None
+        count = len(self.latencies)
+        return {
+            "requests": count,
+            "errors": self.errors,
+            "seconds": round(self.seconds, 3),
+            "requests_per_second": round(count / self.seconds, 2) if self.seconds else None,
+            "bytes": self.bytes,
+            "p50_ms": to_ms(percentile(self.latencies, 50)),
+            "p90_ms": to_ms(percentile(self.latencies, 90)),
+            "p99_ms": to_ms(percentile(self.latencies, 99)),
+            "max_ms": to_ms(max(self.latencies) if self.latencies else None),
+        }
+
+def run_load(name: str, request: Callable[[int], Tuple[bool, float, int]], total: int, concurrency: int,
+             stop: Optional[threading.Event] = None) -> LoadResult:
+    """
+    用 concurrency 个线程发送 total 个请求；request(i) 返回 (是否成功, 耗时, 字节数)。
+    stop 被设置时提前结束。
+    """
+    result = LoadResult(name)
+    counter = iter(range(total))
+    counter_lock = threading.Lock()
+
+    def worker() -> None:
+        while stop is None or not stop.is_set():
+            with counter_lock:
+                index = next(counter, None)
+            if index is None:
+                return
+            try:
+                ok, seconds, size = request(index)
+            except Exception as e:
+                print(f"[{name}] request failed: {e}")
+                ok, seconds, size = False, 0.0, 0
+            result.record(ok, seconds, size)
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=name) as executor:
+        for future in [executor.submit(worker) for _ in range(concurrency)]:
+            future.result()
+    result.seconds = time.perf_counter() - started_at
+    return result
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_api(workdir: str, port: int, env: Dict[str, str]) -> subprocess.Popen:
+    """在子进程中启动 API 服务，fakevideo 插件通过 PYTHONPATH 加载"""
+    child_env = dict(os.environ)
+    child_env.update({
+        "PYTHONPATH": os.pathsep.join(filter(None, [PLUGINS_DIR, child_env.get("PYTHONPATH")])),
+        "YTDLP_TASK_DB": os.path.join(workdir, "tasks.db"),
+    })
+    child_env.pop("YTDLP_API_KEY", None)
+    child_env.update(env)
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=REPO_DIR,
+        env=child_env,
+        stdout=open(os.path.join(workdir, "server.log"), "wb"),
+        stderr=subprocess.STDOUT,
+    )
+
+def wait_until_ready(client: ApiClient, process: subprocess.Popen, timeout: float = 60.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"API server exited with code {process.returncode}")
+        try:
+            status, _, _ = client.request("GET", "/stats")
+            if status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("API server did not start in time")
+
+def wait_for_downloads(client: ApiClient, expected: int, timeout: float) -> Dict[str, Any]:
+    """等待下载池完成 expected 个任务，返回下载池的统计"""
+    deadline = time.monotonic() + timeout
+    while True:
+        pool = client.get_json("/queue?limit=0")["data"]["pool"]
+        finished = pool["completed"] + pool["failed"] + pool["canceled"]
+        if finished >= expected and pool["queued"] == 0 and pool["active"] == 0:
+            return pool
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Downloads did not finish in {timeout:g}s: {pool}")
+        time.sleep(0.1)
+
+def git_revision() -> Dict[str, Any]:
+    def git(*args: str) -> str:
+        return subprocess.run(["git", *args], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+    try:
+        return {"commit": git("rev-parse", "HEAD") or None, "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+    except OSError:
+        return {"commit": None, "dirty": None}
+
+def media_url(server: MediaServer, index: int, args: argparse.Namespace) -> str:
+    kind = "hls" if random.random() < args.hls_ratio else "progressive"
+    params = {"kind": kind, "size": args.size, "segments": args.segments, "latency": args.latency, "rate": args.rate}
+    return f"{server.base_url}/fake/bench-{index:06d}?{urllib.parse.urlencode(params)}"
+
+def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    random.seed(args.seed)
+    media = MediaServer().start()
+    workdir = tempfile.mkdtemp(prefix="ytdlp-bench-")
+    port = free_port()
+    env = {"YTDLP_MAX_CONCURRENT_DOWNLOADS": str(args.workers)}
+    env.update(item.split("=", 1) for item in args.env)
+    process = start_api(workdir, port, env)
+    client = ApiClient("127.0.0.1", port)
+    results: Dict[str, Any] = {
+        "timestamp": datetime.datetime.now().isoformat(),
+        "git": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+    }
+    try:
+        wait_until_ready(client, process)
+        sampler = RssSampler(process.pid).start()
+        writes_before = client.get_json("/stats")["data"]["task_store"]["row_writes"]
+        output_path = os.path.join(workdir, "downloads")
+
+        task_ids: List[str] = []
+        task_ids_lock = threading.Lock()
+
+        def submit(index: int) -> Tuple[bool, float, int]:
+            body = {"url": media_url(media, index, args), "output_path": output_path, "format": "best", "quiet": True}
+            if args.download_profile:
+                body["download_profile"] = json.loads(args.download_profile)
+            status, data, seconds = client.request("POST", "/download", body)
+            if status == 200:
+                with task_ids_lock:
+                    task_ids.append(json.loads(data)["task_id"])
+            return status == 200, seconds, len(data)
+
+        downloads_started = time.perf_counter()
+        download = run_load("download", submit, args.tasks, args.concurrency)
+
+        # 下载进行期间查询任务状态
+        downloads_done = threading.Event()
+        status_load: Dict[str, LoadResult] = {}
+
+        def poll_status() -> None:
+            def request(index: int) -> Tuple[bool, float, int]:
+                status, data, seconds = client.request("GET", f"/task/{random.choice(task_ids)}")
+                return status == 200, seconds, len(data)
+            status_load["task"] = run_load("task", request, args.requests, args.concurrency, stop=downloads_done)
+
+        poller = threading.Thread(target=poll_status, name="task-status-load")
+        if task_ids:
+            poller.start()
+        try:
+            pool = wait_for_downloads(client, len(task_ids), args.timeout)
+        finally:
+            downloads_done.set()
+            if poller.is_alive():
+                poller.join()
+        downloads_seconds = time.perf_counter() - downloads_started
+        writes_after = client.get_json("/stats")["data"]["task_store"]["row_writes"]
+
+        def list_tasks(index: int) -> Tuple[bool, float, int]:
+            path = "/tasks?limit=100" if index % 2 == 0 else "/tasks?limit=100&status=completed&fields=id,status,progress"
+            status, data, seconds = client.request("GET", path)
+            return status == 200, seconds, len(data)
+
+        tasks = run_load("tasks", list_tasks, args.requests, args.concurrency)
+
+        def fetch_file(index: int) -> Tuple[bool, float, int]:
+            headers = {"Range": "bytes=0-65535"} if index % 2 else {}
+            status, data, seconds = client.request("GET", f"/download/{random.choice(task_ids)}/file", headers=headers)
+            return status in (200, 206), seconds, len(data)
+
+        files = run_load("file", fetch_file, args.requests if task_ids else 0, args.concurrency)
+        rss = sampler.stop()
+
+        results.update({
+            "download": download.summary(),
+            "task": status_load["task"].summary() if "task" in status_load else LoadResult("task").summary(),
+            "tasks": tasks.summary(),
+            "file": files.summary(),
+            "downloads": {
+                "tasks": len(task_ids),
+                "completed": pool["completed"],
+                "failed": pool["failed"],
+                "seconds": round(downloads_seconds, 3),
+                "tasks_per_second": round(pool["completed"] / downloads_seconds, 3) if downloads_seconds else None,
+                "avg_wait_seconds": pool["avg_wait_seconds"],
+                "avg_run_seconds": pool["avg_run_seconds"],
+                "media_bytes_served": media.bytes_sent,
+            },
+            "database": {
+                "row_writes": writes_after - writes_before,
+                "row_writes_per_second": round((writes_after - writes_before) / downloads_seconds, 2) if downloads_seconds else None,
+            },
+            "rss_mb": rss,
+        })
+        return results
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        media.shutdown()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+        else:
+            print(f"Kept working directory {workdir}")
+
+def lookup(results: Dict[str, Any], path: Tuple[str, ...]) -> Optional[float]:
+    value: Any = results
+    for key in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value if isinstance(value, (int, float)) else None
+
+def compare(base: Dict[str, Any], new: Dict[str, Any], threshold: float) -> List[str]:
+    """打印两次结果的差异，返回变差超过 threshold 百分比的指标"""
+    regressions: List[str] = []
+    print(f"{'metric':<36}{'base':>14}{'new':>14}{'change':>10}")
+    for path, better_high in COMPARED_METRICS:
+        before, after = lookup(base, path), lookup(new, path)
+        if before is None or after is None:
+            continue
+        change = (after - before) / before * 100 if before else 0.0
+        worse = -change if better_high else change
+        name = ".".join(path)
+        flag = ""
+        if worse > threshold:
+            regressions.append(name)
+            flag = "  <- regression"
+        print(f"{name:<36}{before:>14g}{after:>14g}{change:>+9.1f}%{flag}")
+    return regressions
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the yt-dlp API against a local synthetic media server")
+    parser.add_argument("--tasks", type=int, default=50, help="Download tasks to submit")
+    parser.add_argument("--requests", type=int, default=2000, help="Requests per read scenario (task, tasks, file)")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent client connections")
+    parser.add_argument("--workers", type=int, default=4, help="YTDLP_MAX_CONCURRENT_DOWNLOADS of the server")
+    parser.add_argument("--size", type=int, default=1024 * 1024, help="Size of each synthetic video in bytes")
+    parser.add_argument("--hls-ratio", type=float, default=0.5, help="Share of tasks that use fragmented HLS")
+    parser.add_argument("--segments", type=int, default=10, help="Fragments per HLS video")
+    parser.add_argument("--latency", type=float, default=0, help="Media server latency per request in ms")
+    parser.add_argument("--rate", type=float, default=0, help="Media server bandwidth per response in bytes/s (0: unlimited)")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds to wait for all downloads")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--download-profile", metavar="JSON", help="download_profile sent with every task")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE", help="Extra environment for the server")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary database and downloads")
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="Compare two result files instead of running")
+    parser.add_argument("--threshold", type=float, default=10.0, help="Regression threshold in percent for --compare")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            base = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        regressions = compare(base, new, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} metric(s) regressed by more than {args.threshold:g}%")
+            sys.exit(1)
+        return
+
+    results = run_benchmark(args)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+        print(f"Results written to {args.output}")
+    print(text)
+
+if __name__ == "__main__":
+    main()
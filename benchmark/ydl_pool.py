@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+对比每个任务新建 YoutubeDL 与从实例池（main.YoutubeDLPool）取用的开销，不访问真实网站。
+
+每一轮对本地媒体服务器（media_server.py）上的 fakevideo 链接做一次提取，分别记录：
+
+    cold   每次新建 YoutubeDL，提取后关闭（之前每个任务的做法）
+    warm   从实例池取出实例提取，结束后放回
+    setup  只新建并关闭 YoutubeDL、不提取，即每个任务节省的初始化开销的上限
+
+    python benchmark/ydl_pool.py --rounds 200 --latency 5
+
+安装了 requests 时 yt-dlp 使用连接池，warm 还会复用到媒体服务器的 HTTP 连接。
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, "plugins"))
+sys.path.insert(0, REPO_DIR)
+
+import yt_dlp
+
+from media_server import MediaServer
+from run import percentile
+
+def measure(rounds: int, run: Callable[[int], None]) -> Dict[str, Any]:
+    """运行 rounds 次，返回每次耗时的统计（毫秒）"""
+    latencies: List[float] = []
+    for index in range(rounds):
+        started_at = time.perf_counter()
+        run(index)
+        latencies.append(time.perf_counter() - started_at)
+    to_ms = lambda value: round(value * 1000, 3)
+    return {
+        "rounds": rounds,
+        "mean_ms": to_ms(sum(latencies) / len(latencies)),
+        "p50_ms": to_ms(percentile(latencies, 50)),
+        "p90_ms": to_ms(percentile(latencies, 90)),
+        "p99_ms": to_ms(percentile(latencies, 99)),
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure the per-task YoutubeDL setup cost saved by the instance pool")
+    parser.add_argument("--rounds", type=int, default=100, help="Extractions per mode")
+    parser.add_argument("--latency", type=float, default=0, help="Media server latency per request in ms")
+    parser.add_argument("--output", help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    # 导入 main 会创建任务库，使用临时文件
+    os.environ.setdefault("YTDLP_TASK_DB", os.path.join(tempfile.mkdtemp(), "tasks.db"))
+    import main
+
+    server = MediaServer().start()
+    params = {"quiet": True, "no_warnings": True, "skip_download": True}
+    url = lambda index: f"{server.base_url}/fake/pool-{index}?latency={args.latency:g}"
+    pool = main.YoutubeDLPool(max_idle=1)
+
+    def cold(index: int) -> None:
+        with yt_dlp.YoutubeDL(dict(params)) as ydl:
+            ydl.extract_info(url(index), download=False)
+
+    def warm(index: int) -> None:
+        with pool.checkout(params) as ydl:
+            ydl.extract_info(url(index), download=False)
+
+    def setup(index: int) -> None:
+        with yt_dlp.YoutubeDL(dict(params)):
+            pass
+
+    # 预热：加载提取器和插件，避免第一轮的导入开销计入 cold
+    cold(-1)
+    results: Dict[str, Any] = {
+        "yt_dlp": yt_dlp.version.__version__,
+        "latency_ms": args.latency,
+        "cold": measure(args.rounds, cold),
+        "warm": measure(args.rounds, warm),
+        "setup": measure(args.rounds, setup),
+        "pool": pool.metrics(),
+    }
+    results["saved_per_task_ms"] = round(results["cold"]["mean_ms"] - results["warm"]["mean_ms"], 3)
+    pool.close()
+    server.shutdown()
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+        print(f"Results written to {args.output}")
+    print(text)
+
+if __name__ == "__main__":
+    main()
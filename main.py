@@ -1,20 +1,79 @@
 import yt_dlp
 import os
 import glob
+import stat
 import uuid
+import socket
+import secrets
+import mimetypes
+import email.utils
 
 import asyncio
 
+import re
+import copy
 import json
+import time
+import base64
+import random
+import hashlib
+import urllib.parse
+import collections
+import heapq
+import itertools
+import atexit
 import datetime
 import sqlite3
-from typing import Dict, Any, Optional, List, Callable, Set
-from fastapi import FastAPI, HTTPException, Query, Depends, Header
-from fastapi.responses import JSONResponse, FileResponse
+import threading
+import contextlib
+import shutil
+from contextlib import asynccontextmanager
+from typing import Dict, Any, Optional, List, Callable, Set, Tuple, NamedTuple, AsyncIterator, BinaryIO, Literal
+from fastapi import FastAPI, HTTPException, Query, Depends, Header, Request, WebSocket, WebSocketDisconnect
+from starlette.requests import HTTPConnection
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse, Response
+import anyio
 import uvicorn
-from pydantic import BaseModel
-from concurrent.futures import ThreadPoolExecutor
-from yt_dlp.utils import DownloadCancelled
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field, PrivateAttr
+from concurrent.futures import Future, ThreadPoolExecutor
+from yt_dlp.utils import (
+    ContentTooShortError, DownloadCancelled, ExtractorError, GeoRestrictedError, PostProcessingError,
+    UnavailableVideoError, UnsupportedError,
+)
+from yt_dlp.networking.exceptions import HTTPError as YtdlpHTTPError, TransportError
+from yt_dlp.extractor import gen_extractor_classes
+from yt_dlp.postprocessor import FFmpegVideoConvertorPP, FFmpegVideoRemuxerPP
+from yt_dlp.postprocessor.common import PostProcessor
+
+def get_env_float(name: str, default: float, minimum: float = 0.0) -> float:
+    """读取浮点类型的环境变量，非法值回退到默认值"""
+    value = os.getenv(name)
+    if value is None or value.strip() == "":
+        return default
+    try:
+        return max(minimum, float(value))
+    except ValueError:
+        print(f"Invalid value for {name}: {value!r}, using {default}")
+        return default
+
+def get_env_bool(name: str, default: bool = False) -> bool:
+    """读取布尔类型的环境变量（1/true/yes/on 为真）"""
+    value = os.getenv(name)
+    if value is None or value.strip() == "":
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+def get_env_int(name: str, default: int, minimum: int = 1) -> int:
+    """读取整数类型的环境变量，非法值回退到默认值"""
+    value = os.getenv(name)
+    if value is None or value.strip() == "":
+        return default
+    try:
+        return max(minimum, int(value))
+    except ValueError:
+        print(f"Invalid value for {name}: {value!r}, using {default}")
+        return default
 
 def NormalizeString(s: str, max_length: int = 200) -> str:
     """
@@ -69,6 +128,74 @@ def create_safe_filename(title: str, format_str: str, ext: str, max_length: int
     else:
         return f"{safe_title}.{safe_ext}"
 
+# 不影响下载内容的跟踪参数，去重时忽略（另外还有所有 utm_* 参数）；其他站点的 ref、app 等参数可能决定内容，保留不动
+TRACKING_QUERY_PARAMS = {"fbclid", "gclid"}
+# 只在 YouTube 链接上忽略的分享和来源参数
+YOUTUBE_TRACKING_QUERY_PARAMS = {"si", "feature", "pp", "ab_channel", "app", "spm", "ref"}
+YOUTUBE_HOSTS = {"youtube.com", "m.youtube.com", "music.youtube.com", "youtube-nocookie.com"}
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+def normalize_url(url: str) -> str:
+    """
+    将URL规范化为去重使用的形式：小写协议和域名，去掉锚点与 utm_*/fbclid/gclid 跟踪参数，
+    查询参数排序。YouTube 链接还会统一为 https，去掉 si/feature 等分享参数，
+    youtu.be / shorts / embed / live 链接统一为 watch?v= 形式，并去掉 t/start 等播放位置参数。
+    """
+    url = url.strip()
+    parts = urllib.parse.urlsplit(url)
+    if not parts.scheme or not parts.netloc:
+        return url
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if host.startswith("www."):
+        host = host[4:]
+    path = parts.path
+    youtube = host == "youtu.be" or host in YOUTUBE_HOSTS
+    ignored = TRACKING_QUERY_PARAMS | YOUTUBE_TRACKING_QUERY_PARAMS if youtube else TRACKING_QUERY_PARAMS
+    query = urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+    query = [
+        (key, value) for key, value in query
+        if key.lower() not in ignored and not key.lower().startswith("utm_")
+    ]
+
+    if youtube:
+        scheme = "https"
+        video_id = None
+        segments = [segment for segment in path.split("/") if segment]
+        if host == "youtu.be" and segments:
+            video_id = segments[0]
+        elif len(segments) >= 2 and segments[0] in ("shorts", "embed", "live", "v"):
+            video_id = segments[1]
+        params = dict(query)
+        if video_id or path.rstrip("/") == "/watch":
+            video_id = video_id or params.get("v")
+            query = [("v", video_id)] if video_id else []
+            if params.get("list"):
+                query.append(("list", params["list"]))
+            host, path = "youtube.com", "/watch"
+        else:
+            host = "youtube.com"
+            query = [(key, value) for key, value in query if key not in ("t", "start")]
+    else:
+        if parts.port not in (None, DEFAULT_PORTS.get(scheme)):
+            host = f"{host}:{parts.port}"
+
+    return urllib.parse.urlunsplit((scheme, host, path, urllib.parse.urlencode(sorted(query)), ""))
+
+def make_dedup_key(url: str, output_path: str, format: str, tenant: Optional[str] = None) -> str:
+    """
+    根据规范化的 URL、输出目录、格式和租户生成去重键，只在同一租户内去重。
+    默认租户的键不包含租户，与没有租户的旧数据一致。
+    """
+    parts = [normalize_url(url), os.path.abspath(output_path), format]
+    if tenant and tenant != DEFAULT_TENANT:
+        parts.append(tenant)
+    return hashlib.sha1("\0".join(parts).encode("utf-8")).hexdigest()
+
+def playlist_dedup_key(url: str, output_path: str, format: str, tenant: Optional[str] = None) -> str:
+    """播放列表父任务的去重键，与把同一链接作为单个任务提交区分开"""
+    return "playlist:" + make_dedup_key(url, output_path, format, tenant)
+
 class Task(BaseModel):
     id: str
     url: str
@@ -78,24 +205,711 @@ class Task(BaseModel):
     result: Optional[Dict[str, Any]] = None
     error: Optional[str] = None
     progress: Optional[Dict[str, Any]] = None
+    priority: int = 0
+    created_at: Optional[str] = None
+    dedup_key: Optional[str] = None
+    # 播放列表展开后的子任务指向父任务；父任务（kind 为 playlist）本身不下载，状态和进度由子任务汇总
+    parent_id: Optional[str] = None
+    kind: str = "video"
+    # 解析后的下载参数（见 DownloadProfiles），随任务保存，重启后沿用
+    download_options: Optional[Dict[str, Any]] = None
+    # 失败的下载次数（包括已自动重试的），以及最近一次错误的类别（见 classify_error）
+    attempts: int = 0
+    error_code: Optional[str] = None
+    # 提交任务的租户（见 TenantRegistry），为空时属于 default 租户
+    tenant: Optional[str] = None
+    # 从数据库按需加载的已结束任务，result 在首次需要时才读取并解析
+    _result_loaded: bool = PrivateAttr(default=True)
+
+TERMINAL_STATUSES = {"completed", "failed", "canceled"}
+
+TASK_COLUMNS = (
+    "id", "url", "output_path", "format", "status", "result", "progress", "error",
+    "timestamp", "priority", "created_at", "dedup_key", "parent_id", "kind", "download_options",
+    "attempts", "error_code", "tenant",
+)
+
+def task_to_row(task: Task, timestamp: str) -> Tuple[Any, ...]:
+    """将任务转换为 tasks 表的一行"""
+    return (
+        task.id,
+        task.url,
+        task.output_path,
+        task.format,
+        task.status,
+        json.dumps(task.result) if task.result else None,
+        json.dumps(task.progress) if task.progress else None,
+        task.error,
+        timestamp,
+        task.priority,
+        task.created_at or timestamp,
+        task.dedup_key,
+        task.parent_id,
+        task.kind,
+        json.dumps(task.download_options) if task.download_options else None,
+        task.attempts,
+        task.error_code,
+        task.tenant,
+    )
+
+# /tasks 接口可投影的字段及其对应的列
+TASK_FIELD_COLUMNS = {
+    "id": "id",
+    "url": "url",
+    "output_path": "output_path",
+    "format": "format",
+    "status": "status",
+    "progress": "progress",
+    "error": "error",
+    "error_code": "error_code",
+    "attempts": "attempts",
+    "priority": "priority",
+    "tenant": "tenant",
+    "created_at": "created_at",
+    "updated_at": "timestamp",
+    "parent_id": "parent_id",
+    "kind": "kind",
+    "download_options": "download_options",
+    "result": "result",
+}
+DEFAULT_TASK_FIELDS = [field for field in TASK_FIELD_COLUMNS if field != "result"]
+
+# 构建任务对象需要的列（不含 result）
+TASK_ROW_SELECT = (
+    "id, url, output_path, format, status, error, progress, priority, created_at, dedup_key, parent_id, kind, download_options, "
+    "attempts, error_code, tenant"
+)
+
+# 新任务只插入一次，违反去重唯一索引时由调用方处理，避免静默覆盖其他任务
+INSERT_TASK_SQL = f"INSERT INTO tasks ({', '.join(TASK_COLUMNS)}) VALUES ({', '.join('?' for _ in TASK_COLUMNS)})"
+# 批量提交时跳过已存在的任务
+INSERT_NEW_TASKS_SQL = INSERT_TASK_SQL.replace("INSERT INTO", "INSERT OR IGNORE INTO", 1)
+
+# 之后的写入只更新已有的行：
+# - 已被删除的任务不会被延迟写入重新插入
+# - 其他进程设置的 canceling 不会被进度更新覆盖回 downloading/postprocessing
+# - 运行中的状态只能由持有租约的进程写入，离开这些状态时释放租约（播放列表父任务不使用租约）
+RUNNING_STATUSES = ("downloading", "postprocessing", "canceling")
+RUNNING_STATUSES_SQL = ", ".join(f"'{status}'" for status in RUNNING_STATUSES)
+UPDATE_TASK_SQL = (
+    "UPDATE tasks SET "
+    + ", ".join(f"{column} = :{column}" for column in TASK_COLUMNS[1:] if column != "status")
+    + ", status = CASE WHEN status = 'canceling' AND :status IN ('downloading', 'postprocessing') THEN status ELSE :status END"
+    + f", lease_owner = CASE WHEN :status IN ({RUNNING_STATUSES_SQL}) THEN lease_owner END"
+    + f", lease_expires = CASE WHEN :status IN ({RUNNING_STATUSES_SQL}) THEN lease_expires END"
+    + " WHERE id = :id AND (kind != 'video' OR lease_owner = :owner"
+    + f" OR (lease_owner IS NULL AND :status NOT IN ({RUNNING_STATUSES_SQL})))"
+)
+
+class LatencyHistogram:
+    """按 Prometheus 风格累计分桶的耗时直方图（单位：秒），线程安全"""
+
+    DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        cumulative = 0
+        buckets: Dict[str, int] = {}
+        for bound, count in zip(list(self.buckets) + ["+Inf"], counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return {"count": cumulative, "sum": round(total, 6), "buckets": buckets}
+
+EVENT_LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+TASK_DURATION_BUCKETS = (1.0, 5.0, 15.0, 30.0, 60.0, 300.0, 900.0, 1800.0, 3600.0, 7200.0)
+
+class Metrics:
+    """
+    Prometheus 指标中需要在热路径上记录的部分：各分组的下载字节数与速度、
+    任务下载和后处理耗时、视频信息提取耗时和事件循环延迟。队列、缓存、数据库等指标在抓取时
+    直接读取各组件已有的统计。enabled 为 False 时记录方法直接返回。
+    """
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.downloaded_bytes: Dict[str, int] = collections.defaultdict(int)
+        # 任务ID -> (分组, 文件名, 已下载字节数, 当前速度)
+        self._downloads: Dict[str, Tuple[str, Optional[str], int, float]] = {}
+        self.task_seconds: Dict[str, LatencyHistogram] = {}
+        self.postprocess_seconds: Dict[str, LatencyHistogram] = {}
+        self.extraction_seconds = LatencyHistogram()
+        self.event_loop_lag = LatencyHistogram(EVENT_LOOP_LAG_BUCKETS)
+        self._lock = threading.Lock()
+
+    def record_progress(self, task_id: str, group: str, progress_data: Dict[str, Any]) -> None:
+        """累计本次进度回调新下载的字节数；每个文件的第一次回调只作为基准（可能是续传的缓存）"""
+        if not self.enabled:
+            return
+        filename = progress_data.get("filename")
+        downloaded = progress_data.get("downloaded_bytes") or 0
+        speed = progress_data.get("speed") or 0.0
+        with self._lock:
+            previous = self._downloads.get(task_id)
+            if previous is not None and previous[1] == filename and downloaded >= previous[2]:
+                self.downloaded_bytes[group] += downloaded - previous[2]
+            self._downloads[task_id] = (group, filename, downloaded, speed)
+
+    def record_task(self, task_id: str, status: str, seconds: float) -> None:
+        """任务运行结束时记录耗时（按最终状态）"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._downloads.pop(task_id, None)
+            histogram = self.task_seconds.get(status)
+            if histogram is None:
+                histogram = self.task_seconds[status] = LatencyHistogram(TASK_DURATION_BUCKETS)
+        histogram.observe(seconds)
+
+    def record_postprocess(self, status: str, seconds: float) -> None:
+        """后处理结束时记录耗时（按最终状态）"""
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self.postprocess_seconds.get(status)
+            if histogram is None:
+                histogram = self.postprocess_seconds[status] = LatencyHistogram(TASK_DURATION_BUCKETS)
+        histogram.observe(seconds)
+
+    def record_extraction(self, seconds: float) -> None:
+        if self.enabled:
+            self.extraction_seconds.observe(seconds)
+
+    def download_speeds(self) -> Dict[str, float]:
+        """各分组正在进行的下载的速度之和（字节/秒）"""
+        speeds: Dict[str, float] = collections.defaultdict(float)
+        with self._lock:
+            for group, _, _, speed in self._downloads.values():
+                speeds[group] += speed
+        return speeds
+
+    async def monitor_event_loop(self, interval: float = 0.5) -> None:
+        """定期睡眠 interval 秒，实际醒来的延迟即事件循环被阻塞的时间"""
+        loop = asyncio.get_running_loop()
+        while True:
+            started_at = loop.time()
+            await asyncio.sleep(interval)
+            self.event_loop_lag.observe(max(loop.time() - started_at - interval, 0.0))
+
+metrics = Metrics(get_env_bool("YTDLP_METRICS", True))
+
+SQLITE_WRITE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+class TaskStore:
+    """
+    SQLite 任务存储。
+
+    使用一个长期打开的 WAL 模式连接。普通的进度更新先记在内存中，由后台线程
+    每隔 flush_interval 秒合并写入（同一任务多次更新只写一行）；新任务、状态变化
+    以及进入终态的任务会立即写入。
+
+    同一台主机上的多个进程可以同时打开同一个数据库文件：工作进程通过
+    claim 原子地认领等待中的任务并获得租约（lease_owner/lease_expires），运行期间
+    定期续约；持有者崩溃后租约过期，任务由其他进程回收重新排队。
+    """
+
+    def __init__(self, db_file: str, flush_interval: float = 1.0, owner: Optional[str] = None):
+        self.db_file = db_file
+        self.flush_interval = flush_interval
+        # 本进程的租约持有者标识
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        # 多进程并发写入时等待锁释放，而不是立即报 database is locked
+        self.conn = sqlite3.connect(db_file, timeout=30.0, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn_lock = threading.RLock()
+        self._dirty: Dict[str, Tuple[Task, str]] = {}
+        self._dirty_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._local = threading.local()
+        self.stats: Dict[str, int] = {"saves": 0, "row_writes": 0, "flushes": 0, "failed_flushes": 0}
+        # 每次批量写入（executemany + commit）的耗时
+        self.write_seconds = LatencyHistogram(SQLITE_WRITE_BUCKETS)
+        self._writer = threading.Thread(target=self._run_writer, name="task-store-writer", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def execute(self, sql: str, params: Tuple[Any, ...] = ()) -> List[Tuple[Any, ...]]:
+        """在共享连接上执行一条语句并提交，返回查询结果"""
+        with self._conn_lock:
+            cursor = self.conn.execute(sql, params)
+            rows = cursor.fetchall()
+            self.conn.commit()
+            return rows
+
+    def _update(self, sql: str, params: Tuple[Any, ...]) -> int:
+        """执行一条写语句并提交，返回受影响的行数"""
+        with self.transaction() as conn:
+            return conn.execute(sql, params).rowcount
+
+    def insert(self, task: Task) -> None:
+        """立即插入新任务；与已有任务的去重键冲突时抛出 sqlite3.IntegrityError"""
+        with self.transaction() as conn:
+            conn.execute(INSERT_TASK_SQL, task_to_row(task, datetime.datetime.now().isoformat()))
+        self.stats["row_writes"] += 1
+
+    def insert_many(self, tasks: List[Task]) -> Dict[str, str]:
+        """
+        在一个事务中批量插入新任务，去重键已存在的任务被跳过。
+        返回每个去重键实际对应的任务ID（新插入的或已有的）。
+        """
+        timestamp = datetime.datetime.now().isoformat()
+        keys = [task.dedup_key for task in tasks]
+        ids: Dict[str, str] = {}
+        with self.transaction() as conn:
+            cursor = conn.executemany(INSERT_NEW_TASKS_SQL, [task_to_row(task, timestamp) for task in tasks])
+            self.stats["row_writes"] += max(cursor.rowcount, 0)
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                ids.update(conn.execute(
+                    f"SELECT dedup_key, id FROM tasks WHERE dedup_key IN ({', '.join('?' for _ in chunk)})",
+                    chunk,
+                ).fetchall())
+        return ids
+
+    def save(self, task: Task, immediate: bool = False) -> None:
+        """记录任务的最新状态；immediate 为 True 时同步写入数据库"""
+        timestamp = datetime.datetime.now().isoformat()
+        with self._dirty_lock:
+            self._dirty[task.id] = (task, timestamp)
+            self.stats["saves"] += 1
+        if immediate:
+            self.flush()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """独占共享连接执行一组语句，成功后提交，失败时回滚"""
+        with self._conn_lock:
+            try:
+                yield self.conn
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+
+    def _reader(self) -> sqlite3.Connection:
+        """每个线程一个只读连接，WAL 模式下读取不会阻塞写入"""
+        conn = getattr(self._local, "reader", None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{os.path.abspath(self.db_file)}?mode=ro", uri=True, check_same_thread=False)
+            self._local.reader = conn
+        return conn
+
+    def query(self, sql: str, params: Tuple[Any, ...] = ()) -> List[Tuple[Any, ...]]:
+        """在本线程的只读连接上执行查询，不等待共享连接上的写入；只能看到已提交的数据"""
+        return self._reader().execute(sql, params).fetchall()
+
+    def iter_tasks(
+        self,
+        fields: List[str],
+        statuses: Optional[List[str]] = None,
+        since: Optional[str] = None,
+        until: Optional[str] = None,
+        url_prefix: Optional[str] = None,
+        parent_id: Optional[str] = None,
+        tenant: Optional[str] = None,
+        cursor: Optional[Tuple[str, str]] = None,
+        descending: bool = True,
+        limit: Optional[int] = None,
+        batch_size: int = 500,
+    ):
+        """
+        按创建时间分页读取任务（键集分页，使用 created_at/id 索引），逐行返回投影后的字典。
+        cursor 为上一页最后一行的 (created_at, id)。
+        """
+        self.flush()
+        columns = [TASK_FIELD_COLUMNS[field] for field in fields]
+        select = ", ".join(["created_at", "id"] + columns)
+        conditions: List[str] = []
+        params: List[Any] = []
+        if statuses:
+            conditions.append(f"status IN ({', '.join('?' for _ in statuses)})")
+            params.extend(statuses)
+        if since:
+            conditions.append("created_at >= ?")
+            params.append(since)
+        if until:
+            conditions.append("created_at < ?")
+            params.append(until)
+        if url_prefix:
+            escaped = url_prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            conditions.append("url LIKE ? ESCAPE '\\'")
+            params.append(escaped + "%")
+        if parent_id:
+            conditions.append("parent_id = ?")
+            params.append(parent_id)
+        if tenant:
+            # 没有记录租户的旧任务属于 default 租户
+            conditions.append("(tenant = ? OR tenant IS NULL)" if tenant == DEFAULT_TENANT else "tenant = ?")
+            params.append(tenant)
+        order = "DESC" if descending else "ASC"
+        comparison = "<" if descending else ">"
+
+        remaining = limit
+        while remaining is None or remaining > 0:
+            page_conditions = list(conditions)
+            page_params = list(params)
+            if cursor is not None:
+                page_conditions.append(f"(created_at, id) {comparison} (?, ?)")
+                page_params.extend(cursor)
+            where = f"WHERE {' AND '.join(page_conditions)}" if page_conditions else ""
+            size = batch_size if remaining is None else min(batch_size, remaining)
+            rows = self._reader().execute(
+                f"SELECT {select} FROM tasks {where} ORDER BY created_at {order}, id {order} LIMIT ?",
+                page_params + [size],
+            ).fetchall()
+            for row in rows:
+                item: Dict[str, Any] = {}
+                for field, value in zip(fields, row[2:]):
+                    if field in ("result", "progress", "download_options") and value:
+                        value = json.loads(value)
+                    item[field] = value
+                yield (row[0], row[1]), item
+            if len(rows) < size:
+                return
+            cursor = (rows[-1][0], rows[-1][1])
+            if remaining is not None:
+                remaining -= len(rows)
+
+    def delete(self, task_id: str) -> None:
+        with self._dirty_lock:
+            self._dirty.pop(task_id, None)
+        self.execute("DELETE FROM tasks WHERE id = ?", (task_id,))
+
+    def claim(self, task_id: str, ttl: float) -> bool:
+        """原子地把等待中的任务置为 downloading 并获得租约，多个进程竞争时只有一个成功"""
+        self.flush()
+        return self._update(
+            "UPDATE tasks SET status = 'downloading', lease_owner = ?, lease_expires = ?, timestamp = ? "
+            "WHERE id = ? AND status = 'pending' AND kind = 'video'",
+            (self.owner, time.time() + ttl, datetime.datetime.now().isoformat(), task_id),
+        ) == 1
+
+    def transition(self, task_id: str, from_statuses: Tuple[str, ...], status: str, error: Optional[str] = None) -> bool:
+        """仅当任务当前处于 from_statuses 之一时修改其状态，不影响租约"""
+        self.flush()
+        placeholders = ", ".join("?" for _ in from_statuses)
+        return self._update(
+            f"UPDATE tasks SET status = ?, error = COALESCE(?, error), timestamp = ? "
+            f"WHERE id = ? AND status IN ({placeholders})",
+            (status, error, datetime.datetime.now().isoformat(), task_id) + tuple(from_statuses),
+        ) == 1
+
+    def renew_leases(self, task_ids: List[str], ttl: float) -> Dict[str, Tuple[str, Optional[str]]]:
+        """延长本进程持有的全部租约，并返回 task_ids 在数据库中当前的 (status, lease_owner)"""
+        with self.transaction() as conn:
+            conn.execute(
+                f"UPDATE tasks SET lease_expires = ? WHERE lease_owner = ? AND status IN ({RUNNING_STATUSES_SQL})",
+                (time.time() + ttl, self.owner),
+            )
+            if not task_ids:
+                return {}
+            rows = conn.execute(
+                f"SELECT id, status, lease_owner FROM tasks WHERE id IN ({', '.join('?' for _ in task_ids)})",
+                tuple(task_ids),
+            ).fetchall()
+        return {task_id: (status, lease_owner) for task_id, status, lease_owner in rows}
+
+    def expired_leases(self, force: bool = False) -> List[Tuple[Any, ...]]:
+        """
+        返回租约已过期（持有者崩溃或失联）的运行中任务。
+        force 为 True 时返回所有运行中的任务，用于单进程模式启动时回收上次运行留下的任务。
+        """
+        sql = f"SELECT {TASK_ROW_SELECT} FROM tasks WHERE status IN ({RUNNING_STATUSES_SQL}) AND kind = 'video'"
+        params: Tuple[Any, ...] = ()
+        if not force:
+            sql += " AND (lease_expires IS NULL OR lease_expires < ?)"
+            params = (time.time(),)
+        return self.execute(sql, params)
+
+    def reclaim(self, task: Task, previous_status: str, force: bool = False) -> bool:
+        """回收过期租约：写入任务的新状态并清除租约；租约已被续期或任务已变化时返回 False"""
+        sql = (
+            "UPDATE tasks SET status = ?, progress = ?, error = ?, lease_owner = NULL, lease_expires = NULL, timestamp = ? "
+            "WHERE id = ? AND status = ?"
+        )
+        params: Tuple[Any, ...] = (
+            task.status,
+            json.dumps(task.progress) if task.progress else None,
+            task.error,
+            datetime.datetime.now().isoformat(),
+            task.id,
+            previous_status,
+        )
+        if not force:
+            sql += " AND (lease_expires IS NULL OR lease_expires < ?)"
+            params += (time.time(),)
+        return self._update(sql, params) == 1
+
+    def flush(self) -> None:
+        """把所有待写入的任务合并为一次事务写入数据库"""
+        with self._conn_lock:
+            with self._dirty_lock:
+                pending = list(self._dirty.values())
+                self._dirty.clear()
+            if not pending:
+                return
+            # 在写入时再序列化，保证写入的是任务的最新状态
+            rows = [dict(zip(TASK_COLUMNS, task_to_row(task, timestamp)), owner=self.owner) for task, timestamp in pending]
+            started_at = time.perf_counter()
+            try:
+                try:
+                    self.conn.executemany(UPDATE_TASK_SQL, rows)
+                    self.conn.commit()
+                    self.stats["row_writes"] += len(rows)
+                except sqlite3.IntegrityError:
+                    # 批量写入中有违反唯一约束的行，逐行写入以免影响其他任务
+                    self.conn.rollback()
+                    for row in rows:
+                        try:
+                            self.conn.execute(UPDATE_TASK_SQL, row)
+                            self.stats["row_writes"] += 1
+                        except sqlite3.IntegrityError as e:
+                            print(f"Error saving task {row['id']} to database: {e}")
+                    self.conn.commit()
+                self.stats["flushes"] += 1
+            except Exception as e:
+                # 写入失败（例如数据库长时间被锁定）时放回待写入的任务，由下一次写入重试；
+                # 期间再次保存的任务以较新的记录为准
+                self.conn.rollback()
+                with self._dirty_lock:
+                    for task, timestamp in pending:
+                        self._dirty.setdefault(task.id, (task, timestamp))
+                self.stats["failed_flushes"] += 1
+                print(f"Error saving tasks to database: {e}")
+            finally:
+                self.write_seconds.observe(time.perf_counter() - started_at)
+
+    def _run_writer(self) -> None:
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
+
+    def close(self) -> None:
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self.flush()
+
+# 任务存储后端，由 YTDLP_TASK_STORE 选择；新的后端需要提供与 TaskStore 相同的
+# 读写（save/insert/flush/delete/iter_tasks/query/execute）和租约（claim/transition/renew_leases/expired_leases/reclaim）接口
+TASK_STORE_BACKENDS: Dict[str, Callable[..., TaskStore]] = {"sqlite": TaskStore}
+
+def open_task_store(db_file: str, flush_interval: float) -> TaskStore:
+    backend = os.environ.get("YTDLP_TASK_STORE", "sqlite").strip().lower()
+    factory = TASK_STORE_BACKENDS.get(backend)
+    if factory is None:
+        raise ValueError(f"Unknown task store backend: {backend}")
+    return factory(db_file, flush_interval)
+
+def task_event(task: Task, status: Optional[str] = None) -> Dict[str, Any]:
+    """构建推送给订阅者的任务事件（不包含体积较大的 result）"""
+    event = {
+        "id": task.id,
+        "url": task.url,
+        "status": status or task.status,
+        "progress": task.progress,
+        "tenant": task.tenant or DEFAULT_TENANT,
+    }
+    if task.error:
+        event["error"] = task.error
+    if task.error_code:
+        event["error_code"] = task.error_code
+    return event
+
+class Subscription:
+    """
+    单个订阅者的事件缓冲区。
+
+    事件按任务合并，每个任务只保留最新的一条；缓冲的任务数超过 max_pending 时
+    丢弃最旧的事件。慢消费者因此只会错过中间状态，而不会拖慢发布方。
+    tenant 不为空时只接收该租户的任务的事件。
+    """
+
+    def __init__(self, task_ids: Optional[Set[str]], max_pending: int, tenant: Optional[str] = None):
+        self.task_ids = task_ids
+        self.tenant = tenant
+        self.max_pending = max_pending
+        self.dropped = 0
+        self._pending: "collections.OrderedDict[str, Dict[str, Any]]" = collections.OrderedDict()
+        self._ready = asyncio.Event()
+
+    def wants(self, event: Dict[str, Any]) -> bool:
+        if self.tenant is not None and event.get("tenant") != self.tenant:
+            return False
+        return self.task_ids is None or event["id"] in self.task_ids
+
+    def offer(self, event: Dict[str, Any]) -> None:
+        task_id = event["id"]
+        if task_id in self._pending:
+            self.dropped += 1
+            del self._pending[task_id]
+        elif len(self._pending) >= self.max_pending:
+            self.dropped += 1
+            self._pending.popitem(last=False)
+        self._pending[task_id] = event
+        self._ready.set()
+
+    async def get(self, timeout: Optional[float] = None) -> List[Dict[str, Any]]:
+        """等待并取出所有缓冲的事件，超时返回空列表"""
+        if not self._pending:
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return []
+        events = list(self._pending.values())
+        self._pending.clear()
+        self._ready.clear()
+        return events
+
+class TaskEventBroker:
+    """进程内的任务事件发布/订阅，发布方可以在任意线程中调用 publish"""
+
+    def __init__(self, max_pending: int):
+        self.max_pending = max_pending
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._subscriptions: Set[Subscription] = set()
+
+    def bind(self, loop: Optional[asyncio.AbstractEventLoop]) -> None:
+        self._loop = loop
+
+    def subscribe(self, task_ids: Optional[Set[str]] = None, tenant: Optional[str] = None) -> Subscription:
+        subscription = Subscription(task_ids, self.max_pending, tenant)
+        self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        self._subscriptions.discard(subscription)
+
+    @property
+    def has_subscribers(self) -> bool:
+        return bool(self._subscriptions)
+
+    def publish(self, event: Dict[str, Any]) -> None:
+        if not self._subscriptions or self._loop is None or self._loop.is_closed():
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._dispatch(event)
+        else:
+            self._loop.call_soon_threadsafe(self._dispatch, event)
+
+    def _dispatch(self, event: Dict[str, Any]) -> None:
+        for subscription in list(self._subscriptions):
+            if subscription.wants(event):
+                subscription.offer(event)
+
+# 全局任务事件代理，State 的所有状态变化都会经由它推送给 SSE/WebSocket 客户端
+events = TaskEventBroker(get_env_int("YTDLP_EVENT_BUFFER_SIZE", 1000))
+
+class TaskCache:
+    """
+    内存中的任务缓存。
+
+    未结束的任务（pending/downloading/canceling）始终常驻；已结束的任务按 LRU
+    保留最多 max_size 个，超出时淘汰最久未访问的任务，需要时再从数据库读取。
+    """
+
+    def __init__(self, max_size: int, on_evict: Optional[Callable[[Task], None]] = None):
+        self.max_size = max_size
+        self.on_evict = on_evict
+        self._active: Dict[str, Task] = {}
+        self._finished: "collections.OrderedDict[str, Task]" = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, task_id: str) -> Optional[Task]:
+        with self._lock:
+            task = self._active.get(task_id)
+            if task is not None:
+                return task
+            task = self._finished.get(task_id)
+            if task is not None:
+                self._finished.move_to_end(task_id)
+            return task
+
+    def put(self, task: Task) -> None:
+        """加入或刷新任务，并根据任务当前状态决定是否常驻"""
+        evicted: List[Task] = []
+        with self._lock:
+            if task.status in TERMINAL_STATUSES:
+                self._active.pop(task.id, None)
+                self._finished[task.id] = task
+                self._finished.move_to_end(task.id)
+                while len(self._finished) > self.max_size:
+                    evicted.append(self._finished.popitem(last=False)[1])
+            else:
+                self._finished.pop(task.id, None)
+                self._active[task.id] = task
+        if self.on_evict:
+            for task in evicted:
+                self.on_evict(task)
+
+    def pop(self, task_id: str) -> Optional[Task]:
+        with self._lock:
+            task = self._active.pop(task_id, None)
+            if task is None:
+                task = self._finished.pop(task_id, None)
+            return task
+
+    def active_tasks(self) -> List[Task]:
+        with self._lock:
+            return list(self._active.values())
+
+    def __contains__(self, task_id: str) -> bool:
+        return task_id in self._active or task_id in self._finished
+
+    def __len__(self) -> int:
+        return len(self._active) + len(self._finished)
 
 class State:
     def __init__(self):
-        self.tasks: Dict[str, Task] = {}
+        # 内存中只缓存未结束的任务和最近访问过的已结束任务，其余任务按需从数据库读取
+        self.tasks = TaskCache(get_env_int("YTDLP_TASK_CACHE_SIZE", 1000, minimum=0), on_evict=self._on_evict)
+        # (规范化URL, 输出目录, 格式) -> 任务ID，覆盖缓存中的任务，未命中时查询数据库的唯一索引
+        self.dedup_index: Dict[str, str] = {}
         self.cancel_requested: Set[str] = set()
-        self.db_file = "tasks.db"
+        self.db_file = os.environ.get("YTDLP_TASK_DB", "tasks.db")
+        # 共享模式下多个进程/主机使用同一个任务库，数据库是唯一可信来源，
+        # 内存中只缓存本进程认领（持有租约）的任务
+        self.shared = get_env_bool("YTDLP_SHARED_STORE")
+        self.lease_ttl = get_env_float("YTDLP_LEASE_TTL", 30.0, minimum=1.0)
+        self.poll_interval = get_env_float("YTDLP_QUEUE_POLL_INTERVAL", 1.0, minimum=0.05)
+        # 本进程持有租约的任务，以及租约已被回收（不应再写入）的任务
+        self.owned: Set[str] = set()
+        self.lost: Set[str] = set()
+        self.store = open_task_store(self.db_file, get_env_float("YTDLP_DB_FLUSH_INTERVAL", 1.0))
+        self._heartbeat_stop = threading.Event()
+        self._heartbeat_thread: Optional[threading.Thread] = None
+        self._remote_watermark = datetime.datetime.now().isoformat()
         # 初始化数据库
         self._init_db()
         # 从数据库加载任务状态
-        self._load_tasks()
+        if not self.shared:
+            self._load_tasks()
     
     def _init_db(self) -> None:
         """初始化SQLite数据库"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        
         # 创建任务表
-        cursor.execute('''
+        self.store.execute('''
         CREATE TABLE IF NOT EXISTS tasks (
             id TEXT PRIMARY KEY,
             url TEXT NOT NULL,
@@ -109,108 +923,199 @@ class State:
         )
         ''')
 
-        cursor.execute("PRAGMA table_info(tasks)")
-        existing_columns = {row[1] for row in cursor.fetchall()}
-        if "progress" not in existing_columns:
-            cursor.execute("ALTER TABLE tasks ADD COLUMN progress TEXT")
-        
-        conn.commit()
-        conn.close()
+        existing_columns = {row[1] for row in self.store.execute("PRAGMA table_info(tasks)")}
+        migrations = {
+            "progress": "ALTER TABLE tasks ADD COLUMN progress TEXT",
+            "priority": "ALTER TABLE tasks ADD COLUMN priority INTEGER NOT NULL DEFAULT 0",
+            "created_at": "ALTER TABLE tasks ADD COLUMN created_at TEXT",
+            "dedup_key": "ALTER TABLE tasks ADD COLUMN dedup_key TEXT",
+            "lease_owner": "ALTER TABLE tasks ADD COLUMN lease_owner TEXT",
+            "lease_expires": "ALTER TABLE tasks ADD COLUMN lease_expires REAL",
+            "parent_id": "ALTER TABLE tasks ADD COLUMN parent_id TEXT",
+            "kind": "ALTER TABLE tasks ADD COLUMN kind TEXT NOT NULL DEFAULT 'video'",
+            "download_options": "ALTER TABLE tasks ADD COLUMN download_options TEXT",
+            "attempts": "ALTER TABLE tasks ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0",
+            "error_code": "ALTER TABLE tasks ADD COLUMN error_code TEXT",
+            "tenant": "ALTER TABLE tasks ADD COLUMN tenant TEXT",
+        }
+        for column, statement in migrations.items():
+            if column not in existing_columns:
+                try:
+                    self.store.execute(statement)
+                except sqlite3.OperationalError as e:
+                    # 多个进程同时启动时，其他进程可能已经完成了迁移
+                    if "duplicate column" not in str(e):
+                        raise
+        # 旧数据没有创建时间，用最后更新时间代替，保证队列顺序稳定
+        self.store.execute("UPDATE tasks SET created_at = timestamp WHERE created_at IS NULL")
+        self.store.execute("CREATE INDEX IF NOT EXISTS idx_tasks_queue ON tasks (status, priority, created_at)")
+        self.store.execute("CREATE INDEX IF NOT EXISTS idx_tasks_created ON tasks (created_at, id)")
+        self.store.execute("CREATE INDEX IF NOT EXISTS idx_tasks_status_created ON tasks (status, created_at, id)")
+        self.store.execute("CREATE INDEX IF NOT EXISTS idx_tasks_timestamp ON tasks (timestamp)")
+        self.store.execute("CREATE INDEX IF NOT EXISTS idx_tasks_parent ON tasks (parent_id, status)")
+        # 去重键规则变化后（1：加入租户；2：跟踪参数按站点区分）按新规则重新生成所有任务的去重键
+        if "dedup_key" not in existing_columns or self.store.execute("PRAGMA user_version")[0][0] < 2:
+            self._backfill_dedup_keys()
+        self.store.execute("PRAGMA user_version = 2")
+        self.store.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_tasks_dedup ON tasks (dedup_key)")
+
+    def _backfill_dedup_keys(self) -> None:
+        """为旧数据生成去重键；重复的任务只有最早创建的一个保留去重键"""
+        rows = self.store.execute("SELECT id, url, output_path, format, tenant, kind FROM tasks ORDER BY created_at, id")
+        seen: Set[str] = set()
+        updates: List[Tuple[Optional[str], str]] = []
+        for task_id, url, output_path, format, tenant, kind in rows:
+            key = (playlist_dedup_key if kind == "playlist" else make_dedup_key)(url, output_path, format, tenant)
+            if key in seen:
+                continue
+            seen.add(key)
+            updates.append((key, task_id))
+        with self.store.transaction() as conn:
+            # 先清空旧的键，避免按新规则生成的键与尚未更新的行冲突
+            conn.execute("UPDATE tasks SET dedup_key = NULL")
+            conn.executemany("UPDATE tasks SET dedup_key = ? WHERE id = ?", updates)
     
+    def _row_to_task(self, row: Tuple[Any, ...]) -> Task:
+        """将数据库中的一行转换为任务对象，result 不在此处解析"""
+        (task_id, url, output_path, format, status, error, progress_json, priority, created_at, dedup_key, parent_id, kind, options_json,
+         attempts, error_code, tenant) = row
+        task = Task(
+            id=task_id,
+            url=url,
+            output_path=output_path,
+            format=format,
+            status=status,
+            error=error,
+            progress=json.loads(progress_json) if progress_json else None,
+            priority=priority or 0,
+            created_at=created_at,
+            dedup_key=dedup_key,
+            parent_id=parent_id,
+            kind=kind or "video",
+            download_options=json.loads(options_json) if options_json else None,
+            attempts=attempts or 0,
+            error_code=error_code,
+            tenant=tenant
+        )
+        task._result_loaded = False
+        return task
+
+    def _is_local(self, task_id: str) -> bool:
+        """内存中的任务是否可信：非共享模式下总是可信，共享模式下只有本进程认领的任务可信"""
+        return not self.shared or task_id in self.owned
+
+    def _cache_task(self, task: Task) -> None:
+        self.tasks.put(task)
+        if task.dedup_key:
+            self.dedup_index[task.dedup_key] = task.id
+
+    def _on_evict(self, task: Task) -> None:
+        if task.dedup_key and self.dedup_index.get(task.dedup_key) == task.id:
+            del self.dedup_index[task.dedup_key]
+
     def _load_tasks(self) -> None:
-        """从数据库加载任务状态"""
+        """从数据库加载未结束的任务，已结束的任务在访问时才读取"""
         try:
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
-            
-            cursor.execute("SELECT id, url, output_path, format, status, result, error, progress FROM tasks")
-            rows = cursor.fetchall()
-            
+            placeholders = ", ".join("?" for _ in TERMINAL_STATUSES)
+            rows = self.store.execute(
+                f"SELECT {TASK_ROW_SELECT} FROM tasks WHERE status NOT IN ({placeholders})",
+                tuple(TERMINAL_STATUSES),
+            )
             for row in rows:
-                task_id, url, output_path, format, status, result_json, error, progress_json = row
-                
-                # 解析JSON结果（如果有）
-                result = json.loads(result_json) if result_json else None
-                progress = json.loads(progress_json) if progress_json else None
-                
-                # 创建Task对象并存储在内存中
-                task = Task(
-                    id=task_id,
-                    url=url,
-                    output_path=output_path,
-                    format=format,
-                    status=status,
-                    result=result,
-                    error=error,
-                    progress=progress
-                )
-                self.tasks[task_id] = task
-                
-            conn.close()
+                self._cache_task(self._row_to_task(row))
         except Exception as e:
             print(f"Error loading tasks from database: {e}")
+
+    def _fetch_task(self, task_id: str, cache: bool = True) -> Optional[Task]:
+        rows = self.store.query(f"SELECT {TASK_ROW_SELECT} FROM tasks WHERE id = ?", (task_id,))
+        if not rows:
+            return None
+        task = self._row_to_task(rows[0])
+        if cache:
+            self._cache_task(task)
+        return task
+
+    def load_result(self, task: Task) -> Optional[Dict[str, Any]]:
+        """按需读取并解析任务的 result"""
+        if not task._result_loaded:
+            rows = self.store.query("SELECT result FROM tasks WHERE id = ?", (task.id,))
+            task.result = json.loads(rows[0][0]) if rows and rows[0][0] else None
+            task._result_loaded = True
+        return task.result
     
-    def _save_task(self, task: Task) -> None:
-        """将任务状态保存到数据库"""
+    def _save_task(self, task: Task, immediate: bool = True) -> None:
+        """将任务状态保存到数据库；immediate 为 False 时由后台线程合并写入"""
         try:
-            # 先更新内存中的任务状态
-            self.tasks[task.id] = task
-            
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
-            
-            timestamp = datetime.datetime.now().isoformat()
-            result_json = json.dumps(task.result) if task.result else None
-            progress_json = json.dumps(task.progress) if task.progress else None
-            
-            # 使用REPLACE策略插入/更新任务
-            cursor.execute('''
-            INSERT OR REPLACE INTO tasks (id, url, output_path, format, status, result, progress, error, timestamp)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                task.id,
-                task.url,
-                task.output_path,
-                task.format,
-                task.status,
-                result_json,
-                progress_json,
-                task.error,
-                timestamp
-            ))
-            
-            conn.commit()
-            conn.close()
+            # 先更新内存中的任务状态；未加载 result 的任务先补全，避免写入时覆盖为空
+            if not task._result_loaded:
+                self.load_result(task)
+            if self._is_local(task.id):
+                self._cache_task(task)
+            self.store.save(task, immediate=immediate or task.status in TERMINAL_STATUSES)
         except Exception as e:
             print(f"Error saving task to database: {e}")
     
-    def add_task(self, url: str, output_path: str, format: str) -> str:
+    def add_task(self, url: str, output_path: str, format: str, priority: int = 0, download_options: Optional[Dict[str, Any]] = None,
+                 tenant: Optional[str] = None) -> str:
+        """创建新任务；如果其他请求或进程已经创建了相同的任务，返回已有任务的ID"""
         task_id = str(uuid.uuid4())
         task = Task(
             id=task_id,
             url=url,
             output_path=output_path,
             format=format,
-            status="pending"
+            status="pending",
+            priority=priority,
+            created_at=datetime.datetime.now().isoformat(),
+            dedup_key=make_dedup_key(url, output_path, format, tenant),
+            download_options=download_options,
+            tenant=tenant
         )
-        self.tasks[task_id] = task
         
-        # 将任务保存到数据库
-        self._save_task(task)
+        # 将任务保存到数据库，由去重唯一索引保证并发提交时只创建一个任务
+        try:
+            self.store.insert(task)
+        except sqlite3.IntegrityError:
+            existing = self.find_duplicate(url, output_path, format, tenant)
+            if existing is None:
+                raise
+            return existing.id
+        if not self.shared:
+            self._cache_task(task)
         
         return task_id
     
     def get_task(self, task_id: str) -> Optional[Task]:
-        return self.tasks.get(task_id)
+        if not self._is_local(task_id):
+            return self._fetch_task(task_id, cache=False)
+        task = self.tasks.get(task_id)
+        if task is None:
+            task = self._fetch_task(task_id)
+        return task
+
+    def find_duplicate(self, url: str, output_path: str, format: str, tenant: Optional[str] = None) -> Optional[Task]:
+        """查找同一租户相同（规范化URL, 输出目录, 格式）的已有任务"""
+        key = make_dedup_key(url, output_path, format, tenant)
+        task_id = self.dedup_index.get(key)
+        if task_id is None:
+            rows = self.store.query("SELECT id FROM tasks WHERE dedup_key = ?", (key,))
+            if not rows:
+                return None
+            task_id = rows[0][0]
+        return self.get_task(task_id)
     
-    def update_task(self, task_id: str, status: str, result: Optional[Dict[str, Any]] = None, error: Optional[str] = None, progress: Optional[Dict[str, Any]] = None) -> None:
-        if task_id in self.tasks:
-            task = self.tasks[task_id]
-            terminal_statuses = {"completed", "failed", "canceled"}
-            if task.status in terminal_statuses and status not in terminal_statuses:
+    def update_task(self, task_id: str, status: str, result: Optional[Dict[str, Any]] = None, error: Optional[str] = None, progress: Optional[Dict[str, Any]] = None,
+                    error_code: Optional[str] = None, attempts: Optional[int] = None) -> None:
+        # 租约已被其他进程回收的任务不再写入，以免覆盖新的认领者
+        if task_id in self.lost:
+            return
+        task = self.get_task(task_id)
+        if task is not None:
+            if task.status in TERMINAL_STATUSES and status not in TERMINAL_STATUSES:
                 return
-            if task.status == "canceling" and status == "downloading":
+            if task.status == "canceling" and status in ("downloading", "postprocessing"):
                 return
+            status_changed = task.status != status
             task.status = status
             if result is not None:
                 task.result = result
@@ -218,141 +1123,2219 @@ class State:
                 task.error = error
             if progress is not None:
                 task.progress = progress
+            if error_code is not None:
+                task.error_code = error_code
+            if attempts is not None:
+                task.attempts = attempts
             
-            # 将更新后的任务状态保存到数据库
-            self._save_task(task)
+            # 状态变化立即写入数据库，单纯的进度更新由后台线程批量写入
+            self._save_task(task, immediate=status_changed or result is not None or error is not None or attempts is not None)
+            if status not in RUNNING_STATUSES and task_id in self.owned:
+                # 写入时已释放租约
+                self.owned.discard(task_id)
+                if self.shared:
+                    self.tasks.pop(task_id)
+            events.publish(task_event(task))
+            if status_changed and task.parent_id:
+                self.refresh_parent(task.parent_id)
+
+    def add_tasks(self, urls: List[str], output_path: str, format: str, priority: int = 0, parent: Optional[Task] = None,
+                  download_options: Optional[Dict[str, Any]] = None, tenant: Optional[str] = None) -> List[Tuple[str, Optional[Task]]]:
+        """
+        批量创建任务（一次事务），已存在的相同任务不会重复创建。
+        parent 不为空时先创建该父任务，新建的任务成为它的子任务。
+        返回与 urls 一一对应的 (任务ID, 新建的任务或 None)。
+        """
+        now = datetime.datetime.now().isoformat()
+        tasks: List[Task] = [parent] if parent is not None else []
+        for url in urls:
+            tasks.append(Task(
+                id=str(uuid.uuid4()),
+                url=url,
+                output_path=output_path,
+                format=format,
+                status="pending",
+                priority=priority,
+                created_at=now,
+                dedup_key=make_dedup_key(url, output_path, format, tenant),
+                parent_id=parent.id if parent is not None else None,
+                download_options=download_options,
+                tenant=tenant,
+            ))
+        ids = self.store.insert_many(tasks)
+        results: List[Tuple[str, Optional[Task]]] = []
+        for task in tasks:
+            task_id = ids.get(task.dedup_key, task.id)
+            created = task_id == task.id
+            if created and not self.shared:
+                self._cache_task(task)
+            if task is not parent:
+                results.append((task_id, task if created else None))
+        return results
+
+    def add_playlist(self, url: str, output_path: str, format: str, entry_urls: List[str], priority: int = 0,
+                     download_options: Optional[Dict[str, Any]] = None, tenant: Optional[str] = None) -> Tuple[str, List[Tuple[str, Optional[Task]]]]:
+        """创建播放列表父任务及其子任务；相同的播放列表已提交过时返回已有的父任务"""
+        existing = self.find_playlist(url, output_path, format, tenant)
+        if existing is not None:
+            return existing.id, []
+        parent = Task(
+            id=str(uuid.uuid4()),
+            url=url,
+            output_path=output_path,
+            format=format,
+            status="pending",
+            priority=priority,
+            created_at=datetime.datetime.now().isoformat(),
+            dedup_key=playlist_dedup_key(url, output_path, format, tenant),
+            kind="playlist",
+            download_options=download_options,
+            tenant=tenant,
+        )
+        children = self.add_tasks(entry_urls, output_path, format, priority, parent=parent, download_options=download_options, tenant=tenant)
+        existing = self.find_playlist(url, output_path, format, tenant)
+        if existing is not None and existing.id != parent.id:
+            # 并发提交了相同的播放列表，以先创建的父任务为准
+            self.store.execute("UPDATE tasks SET parent_id = ? WHERE parent_id = ?", (existing.id, parent.id))
+            self.refresh_parent(existing.id)
+            return existing.id, children
+        self.refresh_parent(parent.id)
+        return parent.id, children
+
+    def find_playlist(self, url: str, output_path: str, format: str, tenant: Optional[str] = None) -> Optional[Task]:
+        rows = self.store.query("SELECT id FROM tasks WHERE dedup_key = ?", (playlist_dedup_key(url, output_path, format, tenant),))
+        return self.get_task(rows[0][0]) if rows else None
+
+    def child_ids(self, parent_id: str, statuses: Optional[Tuple[str, ...]] = None) -> List[str]:
+        sql = "SELECT id FROM tasks WHERE parent_id = ?"
+        params: Tuple[Any, ...] = (parent_id,)
+        if statuses:
+            sql += f" AND status IN ({', '.join('?' for _ in statuses)})"
+            params += tuple(statuses)
+        return [row[0] for row in self.store.query(sql + " ORDER BY created_at, id", params)]
+
+    def cancel_children(self, parent_id: str) -> List[str]:
+        """
+        取消播放列表的所有子任务：等待中的子任务在一条语句中直接取消，
+        运行中的子任务逐个置为 canceling。返回被直接取消的子任务ID。
+        """
+        self.store.flush()
+        pending = self.child_ids(parent_id, ("pending",))
+        self.store.execute(
+            "UPDATE tasks SET status = 'canceled', error = 'Canceled by user', timestamp = ? WHERE parent_id = ? AND status = 'pending'",
+            (datetime.datetime.now().isoformat(), parent_id),
+        )
+        for task_id in pending:
+            task = self.tasks.get(task_id) if self._is_local(task_id) else None
+            if task is not None and task.status == "pending":
+                task.status, task.error = "canceled", "Canceled by user"
+                self._cache_task(task)
+        for task_id in self.child_ids(parent_id, ("downloading", "postprocessing")):
+            self.cancel_task(task_id)
+        self.refresh_parent(parent_id)
+        return pending
+
+    def playlist_progress(self, parent_id: str) -> Dict[str, Any]:
+        """汇总子任务的状态数量、已下载字节数、速度和整体完成百分比"""
+        self.store.flush()
+        rows = self.store.execute(
+            "SELECT status, COUNT(*), "
+            "SUM(json_extract(progress, '$.downloaded_bytes')), "
+            "SUM(COALESCE(json_extract(progress, '$.total_bytes'), json_extract(progress, '$.total_bytes_estimate'))), "
+            "SUM(json_extract(progress, '$.percent')), "
+            "SUM(json_extract(progress, '$.speed')) "
+            "FROM tasks WHERE parent_id = ? GROUP BY status",
+            (parent_id,),
+        )
+        counts = {status: 0 for status in ("pending", "downloading", "postprocessing", "canceling", "completed", "failed", "canceled")}
+        downloaded = total_bytes = speed = 0.0
+        percent_sum = 0.0
+        for status, count, status_downloaded, status_total, status_percent, status_speed in rows:
+            counts[status] = counts.get(status, 0) + count
+            downloaded += status_downloaded or 0
+            total_bytes += status_total or 0
+            if status == "completed":
+                percent_sum += 100.0 * count
+            elif status in RUNNING_STATUSES:
+                percent_sum += status_percent or 0
+                speed += status_speed or 0
+        total = sum(counts.values())
+        return {
+            "total": total,
+            **counts,
+            "downloaded_bytes": int(downloaded),
+            "total_bytes": int(total_bytes) or None,
+            "speed": speed or None,
+            "percent": round(percent_sum / total, 2) if total else 100.0,
+        }
+
+    def refresh_parent(self, parent_id: str) -> None:
+        """根据子任务重新计算播放列表父任务的状态，并推送状态变化"""
+        progress = self.playlist_progress(parent_id)
+        active = progress["pending"] + progress["downloading"] + progress["postprocessing"] + progress["canceling"]
+        error = None
+        if active == 0:
+            if progress["failed"]:
+                status = "failed"
+                error = f"{progress['failed']} of {progress['total']} entries failed"
+            elif progress["canceled"]:
+                status = "canceled"
+                error = "Canceled by user"
+            else:
+                status = "completed"
+        elif progress["canceling"] and not (progress["pending"] or progress["downloading"] or progress["postprocessing"]):
+            status = "canceling"
+        elif progress["pending"] == progress["total"]:
+            status = "pending"
+        else:
+            status = "downloading"
+        self.store.execute(
+            "UPDATE tasks SET status = ?, progress = ?, error = ?, timestamp = ? WHERE id = ? AND kind = 'playlist'",
+            (status, json.dumps(progress), error, datetime.datetime.now().isoformat(), parent_id),
+        )
+        parent = self.tasks.get(parent_id) if self._is_local(parent_id) else None
+        if parent is not None:
+            parent.status, parent.progress, parent.error = status, progress, error
+            self._cache_task(parent)
+        else:
+            parent = self._fetch_task(parent_id, cache=False)
+        if parent is not None:
+            events.publish(task_event(parent))
+
+    def claim_task(self, task_id: str) -> Optional[Task]:
+        """认领等待中的任务并获得租约；任务已被其他进程认领或不再等待时返回 None"""
+        if not self.store.claim(task_id, self.lease_ttl):
+            return None
+        self.owned.add(task_id)
+        self.lost.discard(task_id)
+        task = self.tasks.get(task_id) if not self.shared else None
+        if task is not None:
+            task.status = "downloading"
+        else:
+            task = self._fetch_task(task_id)
+        if task is not None and task.parent_id:
+            self.refresh_parent(task.parent_id)
+        return task
 
     def request_cancel(self, task_id: str) -> bool:
-        task = self.tasks.get(task_id)
+        task = self.get_task(task_id)
         if not task:
             return False
         if task.status in ("completed", "failed", "canceled"):
             return False
-        self.cancel_requested.add(task_id)
+        # 其他进程运行的任务通过数据库中的 canceling 状态通知，由其心跳同步
+        if self._is_local(task_id):
+            self.cancel_requested.add(task_id)
         return True
 
+    def cancel_task(self, task_id: str) -> Optional[str]:
+        """
+        取消任务并返回任务的新状态。
+
+        等待中的任务直接置为 canceled；运行中的任务置为 canceling，由持有租约的
+        进程（可能是其他进程）在下一次进度回调时停止下载。
+        """
+        if self.store.transition(task_id, ("pending",), "canceled", error="Canceled by user"):
+            status = "canceled"
+        elif self.request_cancel(task_id) and self.store.transition(task_id, ("downloading", "postprocessing"), "canceling"):
+            status = "canceling"
+        else:
+            task = self.get_task(task_id)
+            return task.status if task else None
+        task = self.tasks.get(task_id) if self._is_local(task_id) else None
+        if task is not None:
+            task.status = status
+            if status == "canceled":
+                task.error = "Canceled by user"
+            self._cache_task(task)
+        else:
+            task = self._fetch_task(task_id, cache=False)
+        if task is not None:
+            events.publish(task_event(task))
+        return status
+
     def is_cancel_requested(self, task_id: str) -> bool:
         return task_id in self.cancel_requested
 
     def clear_cancel(self, task_id: str) -> None:
         self.cancel_requested.discard(task_id)
+        self.lost.discard(task_id)
 
     def delete_task(self, task_id: str) -> bool:
-        task = self.tasks.pop(task_id, None)
+        task = self.tasks.pop(task_id) or self._fetch_task(task_id, cache=False)
         if not task:
             return False
+        if task.dedup_key and self.dedup_index.get(task.dedup_key) == task_id:
+            del self.dedup_index[task.dedup_key]
         try:
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM tasks WHERE id = ?", (task_id,))
-            conn.commit()
-            conn.close()
+            self.store.delete(task_id)
         except Exception as e:
             print(f"Error deleting task from database: {e}")
+        events.publish(task_event(task, status="deleted"))
         return True
 
     def restart_task(self, task_id: str) -> Optional[Task]:
-        task = self.tasks.get(task_id)
+        task = self.get_task(task_id)
         if not task:
             return None
         task.status = "pending"
         task.result = None
+        task._result_loaded = True
         task.error = None
+        task.error_code = None
+        task.attempts = 0
         task.progress = None
         self.clear_cancel(task_id)
         self._save_task(task)
+        events.publish(task_event(task))
         return task
     
-    def list_tasks(self) -> List[Task]:
-        return list(self.tasks.values())
+    def recover_interrupted_tasks(self, force: Optional[bool] = None) -> List[Task]:
+        """
+        恢复被中断的任务。
+
+        downloading 状态的任务重新置为 pending 以便重新排队，保留进度中的文件名，
+        yt-dlp 会从已有的 .part/.ytdl 缓存继续下载；postprocessing 状态的任务同样重新排队，
+        已下载完的文件会被 yt-dlp 直接沿用，随后重新后处理；canceling 状态的任务直接标记为 canceled。
+        单进程模式启动时回收所有运行中的任务；共享模式下只回收租约已过期的任务
+        （持有者崩溃或失联），仍在续约的任务不受影响。
+        """
+        if force is None:
+            force = not self.shared
+        recovered: List[Task] = []
+        for row in self.store.expired_leases(force=force):
+            task = self._row_to_task(row)
+            previous_status = task.status
+            if previous_status == "canceling":
+                task.status = "canceled"
+                task.error = "Canceled by user"
+            else:
+                progress = dict(task.progress or {})
+                progress["status"] = "interrupted"
+                progress["resumable_bytes"] = get_partial_download_bytes(task)
+                task.status = "pending"
+                task.progress = progress
+            if not self.store.reclaim(task, previous_status, force=force):
+                continue
+            self.owned.discard(task.id)
+            if not self.shared:
+                self._cache_task(task)
+            events.publish(task_event(task))
+            if task.status == "pending":
+                recovered.append(task)
+        if recovered:
+            print(f"Recovered {len(recovered)} interrupted task(s)")
+        return recovered
+
+    def list_pending_tasks(self, limit: Optional[int] = None) -> List[Task]:
+        """按队列顺序（优先级高者在前，其次先进先出）返回等待中的任务"""
+        if self.shared:
+            rows = self.store.execute(
+                f"SELECT {TASK_ROW_SELECT} FROM tasks WHERE status = 'pending' AND kind = 'video' "
+                "ORDER BY priority DESC, created_at LIMIT ?",
+                (-1 if limit is None else limit,),
+            )
+            return [self._row_to_task(row) for row in rows]
+        pending = [task for task in self.tasks.active_tasks() if task.status == "pending" and task.kind == "video"]
+        pending.sort(key=lambda task: (-task.priority, task.created_at or ""))
+        return pending[:limit] if limit is not None else pending
+
+    def heartbeat(self) -> None:
+        """
+        续约本进程持有的租约，同步其他进程对这些任务的取消/删除，并回收过期租约。
+        由心跳线程定期调用。
+        """
+        owned = list(self.owned)
+        current = self.store.renew_leases(owned, self.lease_ttl)
+        for task_id in owned:
+            status, lease_owner = current.get(task_id, (None, None))
+            if lease_owner == self.store.owner:
+                if status == "canceling" and task_id not in self.cancel_requested:
+                    self.cancel_requested.add(task_id)
+                    task = self.tasks.get(task_id)
+                    if task is not None:
+                        task.status = "canceling"
+            elif task_id in self.owned:
+                # 任务已被删除，或租约过期后已被回收：停止下载且不再写入
+                self.lost.add(task_id)
+                self.cancel_requested.add(task_id)
+                self.owned.discard(task_id)
+                self.tasks.pop(task_id)
+        self.recover_interrupted_tasks(force=False)
+
+    def publish_remote_changes(self) -> None:
+        """共享模式下把其他进程写入的任务变化转发给本进程的事件订阅者"""
+        rows = self.store.execute(
+            f"SELECT {TASK_ROW_SELECT}, timestamp FROM tasks WHERE timestamp > ? ORDER BY timestamp",
+            (self._remote_watermark,),
+        )
+        if rows:
+            self._remote_watermark = rows[-1][-1]
+        if not events.has_subscribers:
+            return
+        for row in rows:
+            if row[0] not in self.owned:
+                events.publish(task_event(self._row_to_task(row[:-1])))
+
+    def start_heartbeat(self) -> None:
+        if self._heartbeat_thread is not None:
+            return
+        self._heartbeat_stop.clear()
+        self._heartbeat_thread = threading.Thread(target=self._run_heartbeat, name="task-lease-heartbeat", daemon=True)
+        self._heartbeat_thread.start()
+
+    def stop_heartbeat(self) -> None:
+        if self._heartbeat_thread is None:
+            return
+        self._heartbeat_stop.set()
+        self._heartbeat_thread.join()
+        self._heartbeat_thread = None
+
+    def _run_heartbeat(self) -> None:
+        # 租约在 TTL 内续约三次，保证偶尔的延迟不会导致租约过期
+        renew_interval = self.lease_ttl / 3
+        next_renew = 0.0
+        while not self._heartbeat_stop.wait(self.poll_interval):
+            try:
+                if time.monotonic() >= next_renew:
+                    self.heartbeat()
+                    next_renew = time.monotonic() + renew_interval
+                self.publish_remote_changes()
+            except Exception as e:
+                print(f"Error in task lease heartbeat: {e}")
 
 # 创建全局状态对象
 state = State()
 
-def download_video(url: str, output_path: str = "./downloads", format: str = "best", quiet: bool = False, progress_hook: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+# 限流分组方式：extractor 按 yt-dlp 提取器（同一站点的多个提取器归为一组），domain 按域名
+LIMIT_GROUP_BY = os.environ.get("YTDLP_LIMIT_GROUP_BY", "extractor").strip().lower()
+
+# 域名 -> 分组。匹配提取器需要逐个尝试上千个正则，同一域名只匹配一次，批量提交时不会成为瓶颈
+_host_groups: Dict[str, str] = {}
+
+def task_group(url: str) -> str:
+    """返回任务所属的限流分组，例如 youtube、vimeo；通用提取器处理的链接使用域名"""
+    host = urllib.parse.urlsplit(normalize_url(url)).hostname or "unknown"
+    if LIMIT_GROUP_BY != "extractor":
+        return host
+    group = _host_groups.get(host)
+    if group is None:
+        group = host
+        for ie in gen_extractor_classes():
+            if ie.ie_key() != "Generic" and ie.suitable(url):
+                group = ie.IE_NAME.split(":")[0].lower()
+                break
+        if len(_host_groups) < 10000:
+            _host_groups[host] = group
+    return group
+
+# 站点限流或拒绝访问时 yt-dlp 报出的错误
+THROTTLE_ERROR_PATTERN = re.compile(r"HTTP Error (429|403)|Too Many Requests", re.IGNORECASE)
+
+# 错误类别：network 和 rate_limited 是暂时性的，会自动重试；其余类别重试也不会成功
+RETRYABLE_ERRORS = {"network", "rate_limited"}
+
+# yt-dlp 把底层异常转成文本报告时（例如分片下载失败）只能按错误信息分类
+ERROR_MESSAGE_PATTERNS = (
+    ("rate_limited", THROTTLE_ERROR_PATTERN),
+    ("geo_blocked", re.compile(r"not available (in|from) your (country|location)|geo.?restrict", re.IGNORECASE)),
+    ("postprocessing", re.compile(r"Postprocessing|ffmpeg|ffprobe", re.IGNORECASE)),
+    ("unavailable", re.compile(
+        r"Video unavailable|Private video|has been removed|no longer available|HTTP Error 4(01|04|10)"
+        r"|Unsupported URL|Requested format is not available|members.only|Sign in to confirm",
+        re.IGNORECASE,
+    )),
+    ("network", re.compile(
+        r"timed? ?out|Connection (reset|refused|aborted)|Remote end closed|Temporary failure in name resolution"
+        r"|Name or service not known|Network is unreachable|IncompleteRead|Did not get any data blocks"
+        r"|fragment \d+ not found|Giving up after \d+|HTTP Error 5\d\d",
+        re.IGNORECASE,
+    )),
+)
+
+def iter_error_chain(error: BaseException):
+    """依次返回错误本身以及 yt-dlp 包装在其中的原始异常"""
+    seen: Set[int] = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        yield error
+        exc_info = getattr(error, "exc_info", None)
+        cause = getattr(error, "cause", None)
+        if isinstance(exc_info, tuple) and len(exc_info) > 1 and isinstance(exc_info[1], BaseException):
+            error = exc_info[1]
+        elif isinstance(cause, BaseException):
+            error = cause
+        else:
+            error = error.__cause__ or error.__context__
+
+def classify_error(error: BaseException) -> str:
     """
-    Download a video from the specified URL using yt-dlp.
-    
-    Args:
-        url (str): The URL of the video to download
-        output_path (str): Directory where the video will be saved
-        format (str): Video format to download (e.g., "best", "bestvideo+bestaudio", "mp4")
-        quiet (bool): If True, suppress output
-        
-    Returns:
-        Dict[str, Any]: Information about the downloaded video
+    把下载失败的原因归为以下类别之一：network（连接、超时、分片或 5xx 错误）、rate_limited（429/403）、
+    geo_blocked、unavailable（视频不存在、已删除、需要登录等）、postprocessing 或 unknown
     """
-    # Create output directory if it doesn't exist
-    os.makedirs(output_path, exist_ok=True)
-    
-    # Configure yt-dlp options
-    # 使用自定义函数生成安全的文件名模板
-    def get_safe_outtmpl(info_dict):
-        """为每个视频生成安全的输出文件名"""
-        title = info_dict.get('title', 'video')
-        ext = info_dict.get('ext', 'mp4')
-        safe_filename = create_safe_filename(title, format, ext)
-        return os.path.join(output_path, safe_filename)
-    
-    progress_hooks = []
-    if progress_hook:
-        progress_hooks.append(progress_hook)
-    
-    ydl_opts = {
-        'outtmpl': os.path.join(output_path, '%(title).180s.%(ext)s'),
-        'quiet': quiet,
-        'no_warnings': quiet,
-        'format': format,
-        'no_abort_on_error': True,
-        # 添加进度钩子来处理文件名
-        'progress_hooks': progress_hooks,
-    }
-    
-    # 如果需要更安全的处理，我们可以在下载前先获取信息
-    temp_ydl_opts = {
-        'quiet': True,
-        'no_warnings': True,
-        'skip_download': True,
-    }
-    
-    try:
-        # 先获取视频信息来生成安全的文件名
-        with yt_dlp.YoutubeDL(temp_ydl_opts) as temp_ydl:
-            info = temp_ydl.extract_info(url, download=False)
-            if info:
-                title = info.get('title', 'video')
-                ext = info.get('ext', 'mp4')
-                safe_filename = create_safe_filename(title, format, ext)
-                ydl_opts['outtmpl'] = os.path.join(output_path, safe_filename)
-    except Exception:
-        # 如果获取信息失败，使用默认的安全模板
-        pass
-    
-    # Download the video
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=True)
-        return ydl.sanitize_info(info)
+    for cause in iter_error_chain(error):
+        if isinstance(cause, PostProcessingError):
+            return "postprocessing"
+        if isinstance(cause, GeoRestrictedError):
+            return "geo_blocked"
+        if isinstance(cause, YtdlpHTTPError):
+            if cause.status in (403, 429):
+                return "rate_limited"
+            if cause.status >= 500:
+                return "network"
+            return "unavailable"
+        if isinstance(cause, (TransportError, ContentTooShortError, ConnectionError, TimeoutError, socket.timeout, socket.gaierror)):
+            return "network"
+        if isinstance(cause, (UnavailableVideoError, UnsupportedError)):
+            return "unavailable"
+    message = str(error)
+    for code, pattern in ERROR_MESSAGE_PATTERNS:
+        if pattern.search(message):
+            return code
+    # 提取器明确报告的错误（expected）是视频本身的问题，例如私有或已删除的视频
+    if any(isinstance(cause, ExtractorError) and cause.expected for cause in iter_error_chain(error)):
+        return "unavailable"
+    return "unknown"
 
-def get_video_info(url: str, quiet: bool = False) -> Dict[str, Any]:
+class RetryPolicy:
     """
-    Get information about a video without downloading it.
-    
-    Args:
-        url (str): The URL of the video
-        quiet (bool): If True, suppress output
-        
-    Returns:
-        Dict[str, Any]: Information about the video
+    暂时性错误的自动重试：第 n 次重试前等待 base * 2^(n-1) 秒（最长 max_delay），
+    实际等待时间在其一半到全部之间随机选取，避免同时失败的任务同时重试。
     """
-    ydl_opts = {
-        'quiet': quiet,
+
+    def __init__(self, max_retries: int, base: float, max_delay: float, rng: Optional[random.Random] = None):
+        self.max_retries = max_retries
+        self.base = base
+        self.max_delay = max_delay
+        self.rng = rng or random.Random()
+
+    def delay(self, attempts: int) -> float:
+        ceiling = min(self.max_delay, self.base * 2 ** max(attempts - 1, 0))
+        return ceiling / 2 + self.rng.uniform(0, ceiling / 2)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"max_retries": self.max_retries, "base": self.base, "max_delay": self.max_delay}
+
+retry_policy = RetryPolicy(
+    max_retries=get_env_int("YTDLP_RETRY_LIMIT", 3, minimum=0),
+    base=get_env_float("YTDLP_RETRY_BASE", 10.0, minimum=0.1),
+    max_delay=get_env_float("YTDLP_RETRY_MAX", 600.0, minimum=0.1),
+)
+
+class TokenBucket:
+    """令牌桶：每秒补充 rate 个令牌，最多累积 burst 个"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """距离下一个令牌可用还需等待的秒数"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+class GroupLimits(BaseModel):
+    # 每个字段为 null 或 0 时不限制
+    max_concurrent: Optional[int] = Field(None, ge=0, description="Concurrent downloads in the group")
+    rate: Optional[float] = Field(None, ge=0, description="Download starts per second (token bucket)")
+    burst: Optional[int] = Field(None, ge=0, description="Token bucket size")
+    ratelimit: Optional[int] = Field(None, ge=0, description="Bandwidth per download in bytes/s")
+
+class LimitsUpdate(BaseModel):
+    global_ratelimit: Optional[int] = Field(None, ge=0, description="Total bandwidth in bytes/s shared by all downloads")
+    default: Optional[GroupLimits] = None
+    # 分组设为 null 时删除该分组的单独配置
+    groups: Optional[Dict[str, Optional[GroupLimits]]] = None
+
+class GroupState:
+    def __init__(self):
+        self.active = 0
+        self.started = 0
+        self.throttled = 0
+        self.backoff_seconds = 0.0
+        self.backoff_until = 0.0
+        self.bucket: Optional[TokenBucket] = None
+
+class DownloadLimiter:
+    """
+    按分组（提取器或域名）限制下载。
+
+    - max_concurrent：分组内同时进行的下载数
+    - rate/burst：令牌桶，限制分组内每秒开始的下载数
+    - ratelimit：分组内每个下载的带宽；global_ratelimit 为所有下载共享的总带宽，
+      平均分给正在进行的下载，下载数量变化时实时调整（yt-dlp 每读取一块数据都会重新读取 ratelimit）
+    - 遇到 429/403 时暂停整个分组，暂停时间从 backoff_base 开始翻倍，最长 backoff_max，下载成功后重置
+
+    限制只作用于当前进程；共享模式下每个工作进程各自限流。
+    """
+
+    def __init__(self, default: Dict[str, Any], overrides: Dict[str, Dict[str, Any]], global_ratelimit: Optional[int],
+                 backoff_base: float, backoff_max: float, max_retries: int):
+        self.default = default
+        self.overrides = overrides
+        self.global_ratelimit = global_ratelimit
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_retries = max_retries
+        self._groups: Dict[str, GroupState] = {}
+        self._running: Dict[str, Tuple[str, Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+
+    def limits_for(self, group: str) -> Dict[str, Any]:
+        limits = dict(self.default)
+        limits.update(self.overrides.get(group, {}))
+        return limits
+
+    def _group(self, group: str) -> GroupState:
+        state = self._groups.get(group)
+        if state is None:
+            state = self._groups[group] = GroupState()
+        return state
+
+    def _bucket(self, state: GroupState, limits: Dict[str, Any]) -> Optional[TokenBucket]:
+        rate = limits.get("rate")
+        if not rate:
+            state.bucket = None
+            return None
+        burst = limits.get("burst") or 1
+        if state.bucket is None or state.bucket.rate != rate or state.bucket.burst != max(1, burst):
+            state.bucket = TokenBucket(rate, burst)
+        return state.bucket
+
+    def ready_in(self, group: str, now: float) -> Optional[float]:
+        """分组内的下一个任务还需等待多少秒才能开始；分组已满（需等待下载结束）时返回 None"""
+        with self._lock:
+            limits = self.limits_for(group)
+            state = self._group(group)
+            if limits.get("max_concurrent") and state.active >= limits["max_concurrent"]:
+                return None
+            wait = max(0.0, state.backoff_until - now)
+            bucket = self._bucket(state, limits)
+            if bucket is not None:
+                wait = max(wait, bucket.wait_time(now))
+            return wait
+
+    def acquire(self, group: str, now: float) -> None:
+        with self._lock:
+            state = self._group(group)
+            state.active += 1
+            state.started += 1
+            bucket = self._bucket(state, self.limits_for(group))
+            if bucket is not None:
+                bucket.take(now)
+
+    def release(self, group: str) -> None:
+        with self._lock:
+            state = self._group(group)
+            state.active = max(0, state.active - 1)
+
+    def attach(self, task_id: str, group: str, params: Dict[str, Any]) -> None:
+        """登记正在进行的下载的 yt-dlp 参数，以便调整其带宽上限"""
+        with self._lock:
+            self._running[task_id] = (group, params)
+            self._rebalance()
+
+    def detach(self, task_id: str) -> None:
+        with self._lock:
+            if self._running.pop(task_id, None) is not None:
+                self._rebalance()
+
+    def _rebalance(self) -> None:
+        share = self.global_ratelimit // len(self._running) if self.global_ratelimit and self._running else None
+        for group, params in self._running.values():
+            candidates = [limit for limit in (share, self.limits_for(group).get("ratelimit")) if limit]
+            params["ratelimit"] = max(1, min(candidates)) if candidates else None
+
+    def record_throttle(self, group: str) -> float:
+        """记录一次 429/403，暂停分组并返回暂停的秒数"""
+        with self._lock:
+            state = self._group(group)
+            state.throttled += 1
+            state.backoff_seconds = min(self.backoff_max, state.backoff_seconds * 2 if state.backoff_seconds else self.backoff_base)
+            state.backoff_until = time.monotonic() + state.backoff_seconds
+            return state.backoff_seconds
+
+    def record_success(self, group: str) -> None:
+        with self._lock:
+            self._group(group).backoff_seconds = 0.0
+
+    def configure(self, update: LimitsUpdate) -> None:
+        """运行时修改限制；未提供的字段保持不变"""
+        with self._lock:
+            if "global_ratelimit" in update.model_fields_set:
+                self.global_ratelimit = update.global_ratelimit or None
+            if update.default is not None:
+                self.default.update(update.default.model_dump(exclude_unset=True))
+            for group, limits in (update.groups or {}).items():
+                if limits is None:
+                    self.overrides.pop(group, None)
+                else:
+                    self.overrides.setdefault(group, {}).update(limits.model_dump(exclude_unset=True))
+            self._rebalance()
+
+    def snapshot(self, queued: Optional[Dict[str, int]] = None) -> Dict[str, Any]:
+        queued = queued or {}
+        now = time.monotonic()
+        with self._lock:
+            ratelimits: Dict[str, Any] = {}
+            for group, params in self._running.values():
+                ratelimits.setdefault(group, params.get("ratelimit"))
+            groups = {}
+            for name in sorted(set(self._groups) | set(queued)):
+                state = self._group(name)
+                groups[name] = {
+                    "limits": self.limits_for(name),
+                    "active": state.active,
+                    "queued": queued.get(name, 0),
+                    "started": state.started,
+                    "throttled": state.throttled,
+                    "backoff_seconds": state.backoff_seconds,
+                    "backoff_remaining": round(max(0.0, state.backoff_until - now), 3),
+                    "tokens": round(state.bucket.tokens, 3) if state.bucket is not None else None,
+                    "download_ratelimit": ratelimits.get(name),
+                }
+            return {
+                "group_by": LIMIT_GROUP_BY,
+                "global_ratelimit": self.global_ratelimit,
+                "default": dict(self.default),
+                "overrides": {group: dict(limits) for group, limits in self.overrides.items()},
+                "backoff": {"base": self.backoff_base, "max": self.backoff_max, "retries": self.max_retries},
+                "groups": groups,
+            }
+
+def load_group_limits() -> Dict[str, Dict[str, Any]]:
+    """从 YTDLP_GROUP_LIMITS（JSON）读取各分组的单独配置，例如 {"youtube": {"max_concurrent": 2}}"""
+    raw = os.environ.get("YTDLP_GROUP_LIMITS")
+    if not raw:
+        return {}
+    try:
+        return {
+            group: GroupLimits(**limits).model_dump(exclude_unset=True)
+            for group, limits in json.loads(raw).items()
+        }
+    except Exception as e:
+        print(f"Invalid YTDLP_GROUP_LIMITS, ignoring: {e}")
+        return {}
+
+# 创建全局下载限流器
+limiter = DownloadLimiter(
+    default={
+        "max_concurrent": get_env_int("YTDLP_GROUP_MAX_CONCURRENT", 0, minimum=0) or None,
+        "rate": get_env_float("YTDLP_GROUP_RATE", 0.0) or None,
+        "burst": get_env_int("YTDLP_GROUP_BURST", 1),
+        "ratelimit": get_env_int("YTDLP_GROUP_RATELIMIT", 0, minimum=0) or None,
+    },
+    overrides=load_group_limits(),
+    global_ratelimit=get_env_int("YTDLP_GLOBAL_RATELIMIT", 0, minimum=0) or None,
+    backoff_base=get_env_float("YTDLP_BACKOFF_BASE", 30.0, minimum=0.1),
+    backoff_max=get_env_float("YTDLP_BACKOFF_MAX", 900.0, minimum=0.1),
+    max_retries=get_env_int("YTDLP_BACKOFF_RETRIES", 3, minimum=0),
+)
+
+class DownloadProfile(BaseModel):
+    # 每个字段为 null 时使用服务端配置的值
+    name: Optional[str] = Field(None, description="Server-side named profile to start from")
+    concurrent_fragment_downloads: Optional[int] = Field(None, ge=1, description="DASH/HLS fragments downloaded in parallel")
+    http_chunk_size: Optional[int] = Field(None, ge=0, description="Download HTTP files in chunks of this many bytes (0 disables)")
+    buffersize: Optional[int] = Field(None, ge=1024, description="Download buffer size in bytes")
+    external_downloader: Optional[str] = Field(None, description="External downloader such as aria2c, or native")
+    throttled_rate: Optional[int] = Field(None, ge=0, description="Re-extract when the speed stays below this many bytes/s")
+    # 后处理预设，在下载完成后由后处理阶段执行（见 PostProcessPool）
+    remux_video: Optional[str] = Field(None, description="Remux the downloaded file into this container without re-encoding")
+    recode_video: Optional[str] = Field(None, description="Re-encode the downloaded file into this format")
+    embed_thumbnail: Optional[bool] = Field(None, description="Embed the video thumbnail into the file")
+
+class ServerDownloadProfile(DownloadProfile):
+    # 外部下载器的命令行参数只能由服务端配置，请求中的同名字段会被忽略
+    external_downloader_args: Optional[List[str]] = None
+
+# 下载参数与 yt-dlp 参数的对应关系
+DOWNLOAD_PROFILE_PARAMS = {
+    "concurrent_fragment_downloads": "concurrent_fragment_downloads",
+    "http_chunk_size": "http_chunk_size",
+    "buffersize": "buffersize",
+    "throttled_rate": "throttledratelimit",
+}
+
+# 请求中的下载参数默认的上限
+DEFAULT_DOWNLOAD_PROFILE_LIMITS = {
+    "concurrent_fragment_downloads": 16,
+    "http_chunk_size": 100 * 1024 * 1024,
+    "buffersize": 16 * 1024 * 1024,
+}
+
+class DownloadProfiles:
+    """
+    服务端的命名下载配置。
+
+    default 配置作用于所有任务；请求可以选择一个命名配置并覆盖其中的字段，
+    覆盖的数值不能超过 limits 中的上限，外部下载器必须在允许列表中且已安装。
+    解析结果随任务保存，服务重启或任务重新开始时使用相同的参数。
+    """
+
+    def __init__(self, profiles: Dict[str, Dict[str, Any]], limits: Dict[str, int], external_downloaders: Set[str]):
+        self.profiles = profiles
+        self.limits = limits
+        self.external_downloaders = external_downloaders
+
+    def resolve(self, requested: Optional[DownloadProfile] = None) -> Optional[Dict[str, Any]]:
+        """合并默认配置、命名配置和请求中的字段；请求不合法时抛出 ValueError"""
+        options = dict(self.profiles.get("default", {}))
+        if requested is not None:
+            if requested.name:
+                if requested.name not in self.profiles:
+                    raise ValueError(f"Unknown download profile: {requested.name}")
+                options.update(self.profiles[requested.name])
+            overrides = requested.model_dump(exclude_none=True, exclude={"name"})
+            for field, value in overrides.items():
+                limit = self.limits.get(field)
+                if limit and value > limit:
+                    raise ValueError(f"{field} must not exceed {limit}")
+            for field, convertor in (("remux_video", FFmpegVideoRemuxerPP), ("recode_video", FFmpegVideoConvertorPP)):
+                if field in overrides and overrides[field] not in convertor.SUPPORTED_EXTS:
+                    raise ValueError(f"Unsupported {field} format: {overrides[field]}")
+            downloader = overrides.get("external_downloader")
+            if downloader is not None and downloader != "native":
+                if downloader not in self.external_downloaders:
+                    raise ValueError(f"External downloader not allowed: {downloader}")
+                if shutil.which(downloader) is None:
+                    raise ValueError(f"External downloader not installed: {downloader}")
+            if downloader is not None and downloader != options.get("external_downloader"):
+                # 其他下载器的参数不适用
+                options.pop("external_downloader_args", None)
+            options.update(overrides)
+        return {field: value for field, value in options.items() if value is not None} or None
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "profiles": {name: dict(profile) for name, profile in self.profiles.items()},
+            "limits": dict(self.limits),
+            "external_downloaders": {name: shutil.which(name) is not None for name in sorted(self.external_downloaders)},
+        }
+
+def build_download_params(options: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """把任务保存的下载参数转换为 yt-dlp 参数"""
+    params: Dict[str, Any] = {}
+    for field, param in DOWNLOAD_PROFILE_PARAMS.items():
+        if (options or {}).get(field) is not None:
+            params[param] = options[field]
+    downloader = (options or {}).get("external_downloader")
+    if downloader and downloader != "native":
+        params["external_downloader"] = {"default": downloader}
+        if options.get("external_downloader_args"):
+            params["external_downloader_args"] = {downloader.lower(): list(options["external_downloader_args"])}
+    if (options or {}).get("embed_thumbnail"):
+        # 缩略图在下载阶段写入磁盘，由后处理阶段嵌入
+        params["writethumbnail"] = True
+    return params
+
+def postprocess_presets(options: Optional[Dict[str, Any]]) -> List[Tuple[str, Dict[str, Any]]]:
+    """任务下载参数中的后处理预设，转换为 (yt-dlp 后处理器类名, 参数) 列表，顺序与 yt-dlp 命令行一致"""
+    options = options or {}
+    steps: List[Tuple[str, Dict[str, Any]]] = []
+    if options.get("remux_video"):
+        steps.append(("FFmpegVideoRemuxerPP", {"preferedformat": options["remux_video"]}))
+    if options.get("recode_video"):
+        steps.append(("FFmpegVideoConvertorPP", {"preferedformat": options["recode_video"]}))
+    if options.get("embed_thumbnail"):
+        steps.append(("EmbedThumbnailPP", {}))
+    return steps
+
+def load_download_profiles() -> DownloadProfiles:
+    """
+    从环境变量读取下载配置：YTDLP_DOWNLOAD_PROFILES（JSON，名称 -> 配置，其中 default 作用于所有任务）、
+    YTDLP_DOWNLOAD_PROFILE_LIMITS（JSON，请求中各字段的上限）和 YTDLP_EXTERNAL_DOWNLOADERS（允许的外部下载器）
+    """
+    profiles: Dict[str, Dict[str, Any]] = {}
+    raw = os.environ.get("YTDLP_DOWNLOAD_PROFILES")
+    if raw:
+        try:
+            profiles = {
+                name: ServerDownloadProfile(**profile).model_dump(exclude_none=True, exclude={"name"})
+                for name, profile in json.loads(raw).items()
+            }
+        except Exception as e:
+            print(f"Invalid YTDLP_DOWNLOAD_PROFILES, ignoring: {e}")
+    limits = dict(DEFAULT_DOWNLOAD_PROFILE_LIMITS)
+    raw = os.environ.get("YTDLP_DOWNLOAD_PROFILE_LIMITS")
+    if raw:
+        try:
+            limits.update({field: int(value) for field, value in json.loads(raw).items() if field in DOWNLOAD_PROFILE_PARAMS})
+        except Exception as e:
+            print(f"Invalid YTDLP_DOWNLOAD_PROFILE_LIMITS, ignoring: {e}")
+    downloaders = os.environ.get("YTDLP_EXTERNAL_DOWNLOADERS", "aria2c")
+    return DownloadProfiles(profiles, limits, {name.strip() for name in downloaders.split(",") if name.strip()})
+
+# 服务端的命名下载配置
+download_profiles = load_download_profiles()
+
+class InsufficientDiskSpace(DownloadCancelled):
+    """选定格式的估算大小超过输出目录所在卷的可用空间，下载在开始前被中止"""
+
+    def __init__(self, required: int, available: int):
+        super().__init__(f"Not enough disk space: {required} bytes needed, {available} bytes available")
+        self.required = required
+        self.available = available
+
+def estimate_download_size(info: Dict[str, Any]) -> Optional[int]:
+    """按选定格式的 filesize / filesize_approx 估算下载大小，需要合并时各格式相加；大小未知时返回 None"""
+    total = 0
+    for fmt in info.get("requested_formats") or [info]:
+        size = fmt.get("filesize") or fmt.get("filesize_approx")
+        if not size:
+            return None
+        total += int(size)
+    return total
+
+class DiskSpaceGuard:
+    """
+    下载的磁盘空间准入。
+
+    每个正在运行的下载按估算大小预留空间，预留量随已写入的字节减少。新的下载只有在
+    输出目录所在卷的可用空间减去 min_free 和同一卷上其他下载的剩余预留后仍能容纳时才开始，
+    否则抛出 InsufficientDiskSpace，由调用方推迟任务。大小未知的下载只检查 min_free。
+    预留只在本进程内统计，多工作进程时各进程分别计算。
+    """
+
+    def __init__(self, min_free: int):
+        self.min_free = min_free
+        self._lock = threading.Lock()
+        # 任务ID -> (设备号, 预留字节数, 文件名 -> 已写入字节数)
+        self._reservations: Dict[str, Tuple[int, int, Dict[str, int]]] = {}
+        self.stats: Dict[str, int] = {"admitted": 0, "deferred": 0}
+
+    def _remaining(self, device: Optional[int] = None, exclude: Optional[str] = None) -> int:
+        return sum(
+            max(reserved - sum(written.values()), 0)
+            for task_id, (dev, reserved, written) in self._reservations.items()
+            if (device is None or dev == device) and task_id != exclude
+        )
+
+    def admit(self, task_id: str, output_path: str, estimate: Optional[int]) -> None:
+        """为下载预留 estimate 字节；空间不足时抛出 InsufficientDiskSpace"""
+        device = os.stat(output_path).st_dev
+        free = shutil.disk_usage(output_path).free
+        required = estimate or 0
+        with self._lock:
+            available = free - self.min_free - self._remaining(device, exclude=task_id)
+            if required > available:
+                self.stats["deferred"] += 1
+                raise InsufficientDiskSpace(required, max(available, 0))
+            self._reservations[task_id] = (device, required, {})
+            self.stats["admitted"] += 1
+
+    def record_progress(self, task_id: str, filename: Optional[str], downloaded: int) -> None:
+        with self._lock:
+            reservation = self._reservations.get(task_id)
+            if reservation is not None and filename:
+                reservation[2][filename] = downloaded
+
+    def release(self, task_id: str) -> None:
+        with self._lock:
+            self._reservations.pop(task_id, None)
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "min_free": self.min_free,
+                "active": len(self._reservations),
+                "reserved_bytes": self._remaining(),
+                **self.stats,
+            }
+
+# 磁盘空间准入：卷上始终保留的空间，以及空间不足的任务重新检查的间隔
+disk_guard = DiskSpaceGuard(get_env_int("YTDLP_DISK_MIN_FREE", 0, minimum=0))
+DISK_RECHECK_INTERVAL = get_env_float("YTDLP_DISK_RECHECK_INTERVAL", 30.0, minimum=1.0)
+
+# 请求可选的优先级；同一优先级内按租户公平排队
+PRIORITY_LEVELS = {"low": -1, "normal": 0, "high": 1}
+PriorityLevel = Literal["low", "normal", "high"]
+# 没有配置 API 密钥时的请求、YTDLP_API_KEY 以及没有记录租户的旧任务都属于该租户
+DEFAULT_TENANT = "default"
+
+class TenantConfig(BaseModel):
+    # 限制为 null 或 0 时不限制
+    keys: List[str] = Field(default_factory=list, description="API keys that identify the tenant")
+    weight: float = Field(1.0, gt=0, description="Share of download starts while several tenants have queued tasks")
+    max_concurrent: Optional[int] = Field(None, ge=0, description="Concurrent downloads of the tenant")
+    max_bytes_per_day: Optional[int] = Field(None, ge=0, description="Bytes the tenant may download per UTC day")
+    max_priority: PriorityLevel = Field("high", description="Highest priority the tenant may request")
+
+def utc_day(now: Optional[datetime.datetime] = None) -> str:
+    return (now or datetime.datetime.now(datetime.timezone.utc)).strftime("%Y-%m-%d")
+
+def seconds_until_next_day(now: Optional[datetime.datetime] = None) -> float:
+    """距离下一个 UTC 日（每日配额重置）的秒数"""
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    tomorrow = (now + datetime.timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return (tomorrow - now).total_seconds()
+
+class TenantRegistry:
+    """
+    API 密钥到租户的映射，以及每个租户的调度权重和配额。
+
+    - keys：识别租户的 API 密钥，一个租户可以有多个（便于轮换）
+    - weight：多个租户都有任务排队时，调度器按权重分配开始下载的机会（见 DownloadScheduler）
+    - max_concurrent：租户同时进行的下载数
+    - max_bytes_per_day：租户每个 UTC 日下载的字节数；用完后新的提交返回 429，已排队的任务等到第二天才开始
+    - max_priority：租户提交任务时可以使用的最高优先级
+
+    YTDLP_API_KEY 是 default 租户的密钥；没有配置任何密钥时不检查密钥，所有请求属于 default 租户。
+    YTDLP_ADMIN_KEY 是管理员密钥（属于 default 租户），可以查看和管理所有租户的任务并修改下载限制；
+    没有配置 YTDLP_TENANTS 时 YTDLP_API_KEY 也是管理员密钥。
+    每日用量按下载进度统计，由调度器每 usage_refresh 秒在线程池中调用 sync 写入 tenant_usage 表并
+    重新读取所有进程的当天用量，重启后保留；多个进程共享任务库时，其他进程的用量最多延迟 usage_refresh 秒可见。
+    调度器出队和请求准入只读取内存中的用量，不访问数据库。
+    """
+
+    def __init__(self, tenants: Dict[str, Dict[str, Any]], legacy_key: Optional[str], store: TaskStore, usage_refresh: float = 5.0,
+                 admin_key: Optional[str] = None):
+        self.tenants = tenants
+        self.admin_key = admin_key
+        self.store = store
+        self.usage_refresh = usage_refresh
+        self._keys: Dict[str, str] = {}
+        for name, config in tenants.items():
+            for key in config.get("keys") or []:
+                self._keys[key] = name
+        # 调度器每次出队都会读取租户配置，预先去掉密钥并补全默认值
+        self._default = TenantConfig().model_dump(exclude={"keys"})
+        self._configs = {
+            name: {**self._default, **{field: value for field, value in config.items() if field != "keys"}}
+            for name, config in tenants.items()
+        }
+        if legacy_key:
+            self._keys.setdefault(legacy_key, DEFAULT_TENANT)
+        if admin_key:
+            self._keys[admin_key] = DEFAULT_TENANT
+        self._lock = threading.Lock()
+        # 同一时间只有一次 sync 访问数据库
+        self._sync_lock = threading.Lock()
+        # (租户, 日期) -> 最近一次 sync 时数据库中的字节数
+        self._usage: Dict[Tuple[str, str], int] = {}
+        # (租户, 日期) -> 正在写入数据库的字节数，以及尚未写入的字节数
+        self._flushing: Dict[Tuple[str, str], int] = {}
+        self._pending: Dict[Tuple[str, str], int] = collections.defaultdict(int)
+        # 任务ID -> (文件名, 已下载字节数)
+        self._downloads: Dict[str, Tuple[Optional[str], int]] = {}
+        # 因超过每日配额被拒绝的提交
+        self.rejected: Dict[str, int] = collections.defaultdict(int)
+        self.store.execute('''
+        CREATE TABLE IF NOT EXISTS tenant_usage (
+            tenant TEXT NOT NULL,
+            day TEXT NOT NULL,
+            bytes INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (tenant, day)
+        )
+        ''')
+        self.sync()
+
+    @property
+    def auth_required(self) -> bool:
+        return bool(self._keys)
+
+    def authenticate(self, key: Optional[str]) -> Optional[str]:
+        """返回密钥所属的租户，密钥无效时返回 None"""
+        return self._keys.get(key) if key else None
+
+    def is_admin(self, key: Optional[str]) -> bool:
+        if not self.auth_required:
+            return True
+        if not key:
+            return False
+        return key == self.admin_key or (not self.tenants and self._keys.get(key) == DEFAULT_TENANT)
+
+    def config(self, tenant: str) -> Dict[str, Any]:
+        return self._configs.get(tenant, self._default)
+
+    def sync(self) -> None:
+        """把本进程累计的用量写入数据库，并重新读取所有进程的当天用量；会访问数据库，不要在事件循环中调用"""
+        with self._sync_lock:
+            with self._lock:
+                self._flushing, self._pending = dict(self._pending), collections.defaultdict(int)
+            try:
+                if self._flushing:
+                    with self.store.transaction() as conn:
+                        conn.executemany(
+                            "INSERT INTO tenant_usage (tenant, day, bytes) VALUES (?, ?, ?) "
+                            "ON CONFLICT(tenant, day) DO UPDATE SET bytes = bytes + excluded.bytes",
+                            [(tenant, day, count) for (tenant, day), count in self._flushing.items()],
+                        )
+            except Exception:
+                # 写入失败的用量留到下一次 sync
+                with self._lock:
+                    for key, count in self._flushing.items():
+                        self._pending[key] += count
+                    self._flushing = {}
+                raise
+            day = utc_day()
+            rows = self.store.execute("SELECT tenant, bytes FROM tenant_usage WHERE day = ?", (day,))
+            with self._lock:
+                # 数据库中的值已包含刚写入的用量
+                self._usage = {(tenant, day): count for tenant, count in rows}
+                self._flushing = {}
+
+    def bytes_today(self, tenant: str) -> int:
+        """租户当天已下载的字节数（只读取内存）"""
+        key = (tenant, utc_day())
+        with self._lock:
+            return self._usage.get(key, 0) + self._flushing.get(key, 0) + self._pending.get(key, 0)
+
+    def quota_reset_in(self, tenant: str) -> float:
+        """租户的每日流量已用完时返回距离重置的秒数，否则返回 0"""
+        limit = self.config(tenant)["max_bytes_per_day"]
+        if not limit or self.bytes_today(tenant) < limit:
+            return 0.0
+        return seconds_until_next_day()
+
+    def record_progress(self, task_id: str, tenant: str, filename: Optional[str], downloaded: int) -> None:
+        """累计租户新下载的字节数；与 Metrics.record_progress 相同，每个文件的第一次回调只作为基准"""
+        with self._lock:
+            previous = self._downloads.get(task_id)
+            if previous is not None and previous[0] == filename and downloaded >= previous[1]:
+                self._pending[(tenant, utc_day())] += downloaded - previous[1]
+            self._downloads[task_id] = (filename, downloaded)
+
+    def finish(self, task_id: str) -> None:
+        with self._lock:
+            self._downloads.pop(task_id, None)
+
+    def snapshot(self, queued: Dict[str, int], active: Dict[str, int]) -> Dict[str, Any]:
+        """各租户的配置（不含密钥）、排队和进行中的任务数以及当天用量"""
+        names = sorted(set(self.tenants) | {DEFAULT_TENANT} | set(queued) | set(active))
+        return {
+            name: {
+                **self.config(name),
+                "queued": queued.get(name, 0),
+                "active": active.get(name, 0),
+                "bytes_today": self.bytes_today(name),
+                "rejected": self.rejected.get(name, 0),
+            }
+            for name in names
+        }
+
+def load_tenants() -> Dict[str, Dict[str, Any]]:
+    """
+    从 YTDLP_TENANTS（JSON）读取租户配置，例如 {"alice": {"keys": ["..."], "weight": 2, "max_concurrent": 2}}。
+    配置无效时拒绝启动：忽略配置会让服务在没有密钥检查的情况下运行。
+    """
+    raw = os.environ.get("YTDLP_TENANTS")
+    if not raw:
+        return {}
+    try:
+        return {name: TenantConfig(**config).model_dump() for name, config in json.loads(raw).items()}
+    except Exception as e:
+        raise RuntimeError(f"Invalid YTDLP_TENANTS: {e}")
+
+tenants = TenantRegistry(load_tenants(), os.environ.get("YTDLP_API_KEY"), state.store, admin_key=os.environ.get("YTDLP_ADMIN_KEY"))
+
+class DownloadScheduler:
+    """
+    固定大小的下载工作池。
+
+    等待中的任务按优先级（高者优先）和创建时间（先进先出）排队，
+    同时运行的下载数量不会超过 max_workers。队列内容来自 tasks 表中
+    status 为 pending 的记录，服务重启后会重新排队。
+
+    任务出队后先通过 state.claim_task 原子认领，只有认领成功的进程才会下载。
+    共享模式下还会定期从数据库拉取其他进程提交的等待中任务。
+
+    每个（限流分组，租户）有自己的堆，出队时只考虑 limiter 允许开始的分组和未达到并发/每日流量
+    上限的租户，被限流的分组或租户不会阻塞其他任务。被推迟的任务（例如磁盘空间不足）先放在
+    按到期时间排序的堆中，到期后再进入所属的堆。
+
+    优先级高的任务总是先开始；同一优先级内，多个租户之间按加权公平排队（start-time fair queuing）：
+    每个租户有一个虚拟时间，每开始一个任务增加 1/weight，总是选择虚拟时间最小的租户，
+    空闲后重新提交的租户从当前虚拟时间开始，不会因为之前空闲而连续占用名额。
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self._heaps: Dict[Tuple[str, str], List[List[Any]]] = {}
+        self._delayed: List[Tuple[float, List[Any]]] = []
+        self._entries: Dict[str, List[Any]] = {}
+        self._options: Dict[str, Dict[str, Any]] = {}
+        self._active: Dict[str, float] = {}
+        self._counter = itertools.count()
+        # 加权公平排队：各租户的虚拟时间、最近开始的任务的虚拟开始时间，以及各租户正在进行的下载数
+        self._vtime: Dict[str, float] = {}
+        self._vclock = 0.0
+        self._tenant_active: Dict[str, int] = collections.defaultdict(int)
+        self._wakeup: Optional[asyncio.Event] = None
+        self._workers: List[asyncio.Task] = []
+        self.stats: Dict[str, float] = {
+            "submitted": 0,
+            "started": 0,
+            "claim_conflicts": 0,
+            "completed": 0,
+            "failed": 0,
+            "canceled": 0,
+            "retried": 0,
+            "total_wait_seconds": 0.0,
+            "total_run_seconds": 0.0,
+        }
+        # 按错误类别统计的自动重试次数
+        self.retries_by_error: Dict[str, int] = collections.defaultdict(int)
+
+    def submit(self, task: Task, quiet: bool = False, delay: float = 0.0) -> None:
+        """将任务加入等待队列；delay 大于 0 时任务在 delay 秒后才能开始"""
+        self.remove(task.id)
+        group = task_group(task.url)
+        tenant = task.tenant or DEFAULT_TENANT
+        entry = [-task.priority, task.created_at or "", next(self._counter), task.id, time.monotonic(), group, tenant]
+        self._entries[task.id] = entry
+        self._options[task.id] = {"quiet": quiet}
+        if delay > 0:
+            heapq.heappush(self._delayed, (time.monotonic() + delay, entry))
+        else:
+            heapq.heappush(self._heaps.setdefault((group, tenant), []), entry)
+        self.stats["submitted"] += 1
+        self.wake()
+
+    def wake(self) -> None:
+        """唤醒等待中的工作协程重新检查队列"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def remove(self, task_id: str) -> bool:
+        """从等待队列中移除任务，返回任务是否仍在排队"""
+        entry = self._entries.pop(task_id, None)
+        self._options.pop(task_id, None)
+        if entry is None:
+            return False
+        # 惰性删除：堆中的条目在出队时被跳过
+        entry[3] = None
+        return True
+
+    def is_queued(self, task_id: str) -> bool:
+        return task_id in self._entries
+
+    def is_active(self, task_id: str) -> bool:
+        return task_id in self._active
+
+    def queued_task_ids(self) -> List[str]:
+        return [entry[3] for entry in sorted(self._entries.values())]
+
+    def queue_positions(self, tenant: Optional[str] = None) -> List[Tuple[str, int]]:
+        """按队列顺序返回 (任务ID, 在整个队列中的位置)；tenant 不为空时只返回该租户的任务"""
+        return [
+            (entry[3], index + 1)
+            for index, entry in enumerate(sorted(self._entries.values()))
+            if tenant is None or entry[6] == tenant
+        ]
+
+    def queued_by_group(self) -> Dict[str, int]:
+        return dict(collections.Counter(entry[5] for entry in self._entries.values()))
+
+    def queued_by_tenant(self) -> Dict[str, int]:
+        return dict(collections.Counter(entry[6] for entry in self._entries.values()))
+
+    def active_by_tenant(self) -> Dict[str, int]:
+        return {tenant: count for tenant, count in self._tenant_active.items() if count}
+
+    def position(self, task_id: str) -> Optional[int]:
+        """返回任务在队列中的位置（从 1 开始），不在队列中时返回 None"""
+        entry = self._entries.get(task_id)
+        if entry is None:
+            return None
+        return 1 + sum(1 for other in self._entries.values() if other[:3] < entry[:3])
+
+    def metrics(self) -> Dict[str, Any]:
+        started = self.stats["started"]
+        finished = self.stats["completed"] + self.stats["failed"] + self.stats["canceled"]
+        return {
+            "max_workers": self.max_workers,
+            "active": len(self._active),
+            "queued": len(self._entries),
+            "utilization": round(len(self._active) / self.max_workers, 4),
+            "submitted": int(self.stats["submitted"]),
+            "started": int(started),
+            "completed": int(self.stats["completed"]),
+            "failed": int(self.stats["failed"]),
+            "canceled": int(self.stats["canceled"]),
+            "retried": int(self.stats["retried"]),
+            "retries_by_error": dict(self.retries_by_error),
+            "claim_conflicts": int(self.stats["claim_conflicts"]),
+            "avg_wait_seconds": round(self.stats["total_wait_seconds"] / started, 3) if started else None,
+            "avg_run_seconds": round(self.stats["total_run_seconds"] / finished, 3) if finished else None,
+        }
+
+    def start(self) -> None:
+        """启动工作协程，恢复被中断的任务，并把数据库中等待中的任务重新排队"""
+        if self._workers:
+            return
+        self._wakeup = asyncio.Event()
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="download")
+        state.recover_interrupted_tasks()
+        self._enqueue_pending(state.list_pending_tasks())
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.max_workers)]
+        self._workers.append(asyncio.create_task(self._sync_tenant_usage()))
+        if state.shared:
+            state.start_heartbeat()
+            self._workers.append(asyncio.create_task(self._poll_shared_queue()))
+
+    async def stop(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._wakeup = None
+        state.stop_heartbeat()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def _enqueue_pending(self, tasks: List[Task]) -> None:
+        for task in tasks:
+            if not self.is_queued(task.id) and not self.is_active(task.id):
+                self.submit(task)
+
+    async def _poll_shared_queue(self) -> None:
+        """共享模式下定期拉取数据库中等待中的任务（包括其他进程提交的任务）"""
+        while True:
+            await asyncio.sleep(state.poll_interval)
+            idle = self.max_workers - len(self._active)
+            if idle <= 0:
+                continue
+            try:
+                # 多取一些候选任务：一部分可能会被其他进程抢先认领，已在本地排队的任务可能正被分组限流
+                pending = await run_in_threadpool(state.list_pending_tasks, len(self._entries) + idle * 2)
+            except Exception as e:
+                print(f"Error polling shared task queue: {e}")
+                continue
+            self._enqueue_pending(pending)
+
+    async def _sync_tenant_usage(self) -> None:
+        """定期在线程池中同步租户的每日用量，出队时只读取内存中的用量"""
+        while True:
+            await asyncio.sleep(tenants.usage_refresh)
+            try:
+                await run_in_threadpool(tenants.sync)
+            except Exception as e:
+                print(f"Error syncing tenant usage: {e}")
+                continue
+            # 其他进程的用量或日期变化可能使等待配额的任务可以开始
+            self.wake()
+
+    def _pop_next(self) -> Tuple[Optional[Tuple[str, float, str, str, List[Any]]], Optional[float]]:
+        """
+        取出限流和租户配额允许开始的、排序最靠前的任务，并占用其分组和租户的名额。
+        没有可以开始的任务时返回需要等待的秒数（None 表示等待新任务或下载结束）。
+        """
+        now = time.monotonic()
+        best: Optional[List[Any]] = None
+        best_rank: Optional[Tuple[Any, ...]] = None
+        # 到期的推迟任务放回所属的堆
+        while self._delayed and self._delayed[0][0] <= now:
+            _, entry = heapq.heappop(self._delayed)
+            if entry[3] is not None and self._entries.get(entry[3]) is entry:
+                heapq.heappush(self._heaps.setdefault((entry[5], entry[6]), []), entry)
+        wait: Optional[float] = self._delayed[0][0] - now if self._delayed else None
+        group_delays: Dict[str, Optional[float]] = {}
+        tenant_delays: Dict[str, Optional[float]] = {}
+        for key, heap in list(self._heaps.items()):
+            # 惰性删除：跳过已移除的条目
+            while heap and (heap[0][3] is None or self._entries.get(heap[0][3]) is not heap[0]):
+                heapq.heappop(heap)
+            if not heap:
+                del self._heaps[key]
+                continue
+            group, tenant = key
+            if group not in group_delays:
+                group_delays[group] = limiter.ready_in(group, now)
+            if tenant not in tenant_delays:
+                tenant_delays[tenant] = self._tenant_ready_in(tenant)
+            if group_delays[group] is None or tenant_delays[tenant] is None:
+                continue
+            delay = max(group_delays[group], tenant_delays[tenant])
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            head = heap[0]
+            rank = (head[0], self._virtual_start(tenant), head[1], head[2])
+            if best_rank is None or rank < best_rank:
+                best, best_rank = head, rank
+        if best is None:
+            return None, wait
+        group, tenant = best[5], best[6]
+        heapq.heappop(self._heaps[(group, tenant)])
+        del self._entries[best[3]]
+        limiter.acquire(group, now)
+        start = self._virtual_start(tenant)
+        self._vclock = start
+        self._vtime[tenant] = start + 1.0 / tenants.config(tenant)["weight"]
+        self._tenant_active[tenant] += 1
+        return (best[3], best[4], group, tenant, best), None
+
+    def _requeue(self, task_id: str, entry: List[Any], options: Dict[str, Any], delay: float) -> None:
+        """把出队后未能开始的任务放回队列，delay 秒后再试；期间重新提交过的任务不受影响"""
+        if task_id in self._entries:
+            return
+        self._entries[task_id] = entry
+        self._options[task_id] = options
+        heapq.heappush(self._delayed, (time.monotonic() + delay, entry))
+        self.wake()
+
+    def _virtual_start(self, tenant: str) -> float:
+        return max(self._vtime.get(tenant, 0.0), self._vclock)
+
+    def _tenant_ready_in(self, tenant: str) -> Optional[float]:
+        """租户的下一个任务还需等待多少秒才能开始；达到并发上限（需等待下载结束）时返回 None"""
+        max_concurrent = tenants.config(tenant)["max_concurrent"]
+        if max_concurrent and self._tenant_active[tenant] >= max_concurrent:
+            return None
+        return tenants.quota_reset_in(tenant)
+
+    def _release(self, group: str, tenant: str) -> None:
+        limiter.release(group)
+        self._tenant_active[tenant] = max(0, self._tenant_active[tenant] - 1)
+        self.wake()
+
+    def retry(self, task_id: str, group: str, error: Exception, error_code: str, attempts: int, quiet: bool = False) -> bool:
+        """
+        自动重试失败的下载，attempts 为包括本次在内的失败次数。
+
+        - rate_limited：暂停整个分组（见 DownloadLimiter.record_throttle），任务立即回到队列，
+          分组恢复后才会开始，最多重试 limiter.max_retries 次
+        - network：按 retry_policy 的指数退避加随机抖动推迟任务，最多重试 retry_policy.max_retries 次
+
+        等待期间任务处于 pending 状态，不占用下载名额。不可重试的错误、超过重试次数、
+        任务已取消或已删除时返回 False，由调用方设置最终状态。
+        """
+        if error_code == "rate_limited":
+            pause = limiter.record_throttle(group)
+            if attempts > limiter.max_retries:
+                return False
+            delay = 0.0
+            progress = {"status": "throttled", "retry_in": round(pause, 1)}
+        elif error_code == "network" and attempts <= retry_policy.max_retries:
+            delay = retry_policy.delay(attempts)
+            progress = {"status": "retrying", "retry_in": round(delay, 1)}
+        else:
+            return False
+        progress.update({"retries": attempts, "error": str(error), "error_code": error_code})
+        if not self.defer(task_id, progress, delay=delay, quiet=quiet, error_code=error_code, attempts=attempts):
+            return False
+        self.stats["retried"] += 1
+        self.retries_by_error[error_code] += 1
+        return True
+
+    def defer(self, task_id: str, progress: Dict[str, Any], delay: float = 0.0, quiet: bool = False,
+              error_code: Optional[str] = None, attempts: Optional[int] = None) -> bool:
+        """
+        把已认领的任务放回 pending 并重新排队，delay 秒后才能再次开始；progress 合并到任务进度中说明原因。
+        任务已取消或已删除时返回 False，由调用方设置最终状态。
+        """
+        if state.is_cancel_requested(task_id):
+            return False
+        task = state.get_task(task_id)
+        if task is None:
+            return False
+        merged = dict(task.progress or {})
+        merged.update(progress)
+        state.update_task(task_id, "pending", progress=merged, error_code=error_code, attempts=attempts)
+        task = state.get_task(task_id)
+        if task is None or task.status != "pending":
+            return False
+        self.submit(task, quiet=quiet, delay=delay)
+        return True
+
+    async def _worker(self) -> None:
+        while True:
+            item, delay = self._pop_next()
+            if item is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            task_id, enqueued_at, group, tenant, entry = item
+            options = self._options.pop(task_id, {})
+            # 原子认领任务，已被取消、删除或被其他进程认领的任务直接跳过
+            try:
+                task = await run_in_threadpool(state.claim_task, task_id)
+            except Exception as e:
+                # 任务已出队但在数据库中仍是 pending：释放名额，稍后重新认领，避免任务在重启前一直卡住
+                print(f"Error claiming task {task_id}: {e}")
+                self._release(group, tenant)
+                self._requeue(task_id, entry, options, state.poll_interval)
+                continue
+            if task is None:
+                self.stats["claim_conflicts"] += 1
+                self._release(group, tenant)
+                continue
+
+            started_at = time.monotonic()
+            self.stats["started"] += 1
+            self.stats["total_wait_seconds"] += started_at - enqueued_at
+            self._active[task_id] = started_at
+            try:
+                await process_download_task(
+                    task_id=task_id,
+                    url=task.url,
+                    output_path=task.output_path,
+                    format=task.format,
+                    quiet=options.get("quiet", False),
+                    download_options=task.download_options,
+                    tenant=tenant,
+                )
+            except Exception as e:
+                print(f"Error running task {task_id}: {e}")
+            finally:
+                self._active.pop(task_id, None)
+                self._release(group, tenant)
+                run_seconds = time.monotonic() - started_at
+                self.stats["total_run_seconds"] += run_seconds
+                finished = state.get_task(task_id)
+                metrics.record_task(task_id, finished.status if finished else "deleted", run_seconds)
+                if finished:
+                    self.record_finished(task_id, finished.status)
+
+    def record_finished(self, task_id: str, status: str) -> None:
+        """统计结束的任务；交给后处理阶段的任务在后处理结束时才统计"""
+        if status in TERMINAL_STATUSES:
+            self.stats[status] += 1
+
+# 创建全局下载调度器
+scheduler = DownloadScheduler(get_env_int("YTDLP_MAX_CONCURRENT_DOWNLOADS", 3))
+
+class FormatSelectedPP(PostProcessor):
+    """在格式选择之后、下载开始之前调用 callback，传入选定格式的信息"""
+
+    def __init__(self, callback: Callable[[Dict[str, Any]], None]):
+        super().__init__()
+        self._callback = callback
+
+    def run(self, info):
+        self._callback(info)
+        return [], info
+
+class StagedYoutubeDL(yt_dlp.YoutubeDL):
+    """
+    下载完成后不在下载线程中运行 ffmpeg 合并和修复，而是把这些步骤连同预设的
+    后处理步骤记录到 postprocess_jobs，由后处理阶段（PostProcessPool）执行。
+    每个下载的文件对应一个作业：{"filepath": 输出文件, "info": 文件信息, "steps": [(后处理器类名, 参数)]}。
+    """
+
+    def __init__(self, params: Dict[str, Any], postprocess_jobs: Optional[List[Dict[str, Any]]] = None,
+                 presets: Optional[List[Tuple[str, Dict[str, Any]]]] = None):
+        super().__init__(params)
+        self.postprocess_jobs = postprocess_jobs if postprocess_jobs is not None else []
+        self.presets = presets or []
+
+    def post_process(self, filename, info, files_to_move=None):
+        steps = [(type(pp).__name__, {}) for pp in info.pop('__postprocessors', None) or []] + self.presets
+        if steps:
+            job_info = self.sanitize_info({**info, 'filepath': filename})
+            # 格式列表与后处理无关，不随作业保存
+            job_info.pop('formats', None)
+            self.postprocess_jobs.append({"filepath": filename, "info": job_info, "steps": steps})
+        return super().post_process(filename, info, files_to_move)
+
+class YoutubeDLPool:
+    """
+    复用 YoutubeDL 实例。
+
+    每个实例初始化时要加载提取器列表、创建 cookie jar 和 HTTP 连接，提取器实例中还缓存了
+    播放器 JS 和签名函数等数据。实例按选项（不含每个任务不同的选项）分组保存，任务结束后
+    放回池中，下一个选项相同的任务直接取用，保留已建立的 HTTP 连接和提取器的缓存；
+    yt-dlp 的磁盘缓存目录（cachedir）可以通过 YTDLP_CACHE_DIR 放到持久化的卷上。
+
+    取出时按本次任务重新设置 params（输出模板、格式、进度钩子等）并清除上一个任务留下的
+    钩子、后处理器和计数；运行中抛出异常的实例不再放回池中。每组最多保留 max_idle 个空闲实例，
+    max_idle 为 0 时每次都创建新实例。
+    """
+
+    MAX_PROFILES = 32
+
+    def __init__(self, max_idle: int, cachedir: Optional[str] = None):
+        self.max_idle = max_idle
+        self.cachedir = cachedir
+        # 选项键 -> 空闲实例；最久未使用的选项组在超过 MAX_PROFILES 时被关闭
+        self._idle: "collections.OrderedDict[Tuple[str, str], List[yt_dlp.YoutubeDL]]" = collections.OrderedDict()
+        # 实例 -> (初始化后的选项, 初始化后的后处理器)
+        self._base: Dict[int, Tuple[Dict[str, Any], Dict[str, List[Any]]]] = {}
+        self._lock = threading.Lock()
+        self.stats: Dict[str, int] = {"created": 0, "reused": 0, "discarded": 0}
+
+    def _reset(self, ydl: yt_dlp.YoutubeDL, task_params: Dict[str, Any]) -> None:
+        """恢复创建时的选项并应用本次任务的选项；params 换成新的字典，之前任务持有的引用不再生效"""
+        base_params, base_pps = self._base[id(ydl)]
+        params = copy.deepcopy(base_params)
+        params.update(task_params)
+        ydl.params = params
+        ydl._parse_outtmpl()
+        selector = params.get('format')
+        ydl.format_selector = selector if selector in (None, '-') or callable(selector) else ydl.build_format_selector(selector)
+        ydl._pps = {when: list(pps) for when, pps in base_pps.items()}
+        ydl._post_hooks = list(params.get('post_hooks') or [])
+        ydl._progress_hooks = list(params.get('progress_hooks') or [])
+        ydl._postprocessor_hooks = list(params.get('postprocessor_hooks') or [])
+        ydl._download_retcode = 0
+        ydl._num_downloads = 0
+        ydl._num_videos = 0
+        ydl._playlist_level = 0
+        ydl._playlist_urls = set()
+        ydl._printed_messages = set()
+
+    @contextlib.contextmanager
+    def checkout(self, params: Dict[str, Any], task_params: Optional[Dict[str, Any]] = None,
+                 cls: type = yt_dlp.YoutubeDL):
+        """
+        取出（或创建）一个以 params 创建的 cls 实例，并应用 task_params；退出时放回池中。
+        task_params 中是每个任务不同、不参与分组的选项，例如 outtmpl、format 和 progress_hooks。
+        """
+        params = dict(params)
+        if self.cachedir:
+            params.setdefault('cachedir', self.cachedir)
+        key = (cls.__name__, json.dumps(params, sort_keys=True, default=repr))
+        ydl: Optional[yt_dlp.YoutubeDL] = None
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                ydl = idle.pop()
+                self._idle.move_to_end(key)
+                self.stats["reused"] += 1
+        if ydl is None:
+            ydl = cls(copy.deepcopy(params))
+            # YoutubeDL 初始化时会补全 params（默认请求头、输出模板等），保存补全后的选项
+            base = (copy.deepcopy(ydl.params), {when: list(pps) for when, pps in ydl._pps.items()})
+            with self._lock:
+                self._base[id(ydl)] = base
+                self.stats["created"] += 1
+        try:
+            self._reset(ydl, task_params or {})
+            yield ydl
+        except BaseException:
+            self._discard(ydl)
+            raise
+        self._reset(ydl, {})
+        self._release(key, ydl)
+
+    def _release(self, key: Tuple[str, str], ydl: yt_dlp.YoutubeDL) -> None:
+        evicted: List[yt_dlp.YoutubeDL] = []
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(ydl)
+                self._idle.move_to_end(key)
+            else:
+                evicted.append(ydl)
+            while len(self._idle) > self.MAX_PROFILES:
+                _, instances = self._idle.popitem(last=False)
+                evicted.extend(instances)
+        for instance in evicted:
+            self._discard(instance)
+
+    def _discard(self, ydl: yt_dlp.YoutubeDL) -> None:
+        with self._lock:
+            self._base.pop(id(ydl), None)
+            self.stats["discarded"] += 1
+        try:
+            ydl.close()
+        except Exception as e:
+            print(f"Error closing YoutubeDL instance: {e}")
+
+    def close(self) -> None:
+        """关闭所有空闲实例（保存 cookie，关闭 HTTP 连接）"""
+        with self._lock:
+            instances = [ydl for idle in self._idle.values() for ydl in idle]
+            self._idle.clear()
+        for ydl in instances:
+            self._discard(ydl)
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            idle = sum(len(instances) for instances in self._idle.values())
+            profiles = len(self._idle)
+        return {"max_idle": self.max_idle, "idle": idle, "profiles": profiles, **self.stats}
+
+# 创建全局 YoutubeDL 实例池
+ydl_pool = YoutubeDLPool(get_env_int("YTDLP_YDL_POOL_SIZE", 8, minimum=0), os.environ.get("YTDLP_CACHE_DIR", "").strip() or None)
+
+def download_video(url: str, output_path: str = "./downloads", format: str = "best", quiet: bool = False, progress_hook: Optional[Callable[[Dict[str, Any]], None]] = None, on_ydl: Optional[Callable[[yt_dlp.YoutubeDL], None]] = None, content_store: Optional["ContentStore"] = None, task_id: Optional[str] = None, download_options: Optional[Dict[str, Any]] = None, on_selected: Optional[Callable[[Dict[str, Any]], None]] = None, postprocess_jobs: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+    """
+    Download a video from the specified URL using yt-dlp.
+    
+    Args:
+        url (str): The URL of the video to download
+        output_path (str): Directory where the video will be saved
+        format (str): Video format to download (e.g., "best", "bestvideo+bestaudio", "mp4")
+        quiet (bool): If True, suppress output
+        progress_hook (Callable): Called with yt-dlp progress updates
+        on_ydl (Callable): Called with the YoutubeDL instance before downloading (used to adjust its rate limit)
+        content_store (ContentStore): If given, reuse an identical earlier download and store this one
+        task_id (str): Task that references the stored file (required with content_store)
+        download_options (Dict): Resolved download profile (fragment concurrency, chunk size, external downloader...)
+        on_selected (Callable): Called with the selected format information right before the download starts
+        postprocess_jobs (List): If given, ffmpeg post-processing (merge, fixups and the presets in download_options)
+            is not run here but appended to this list for run_postprocessors
+        
+    Returns:
+        Dict[str, Any]: Information about the downloaded video
+    """
+    # Create output directory if it doesn't exist
+    os.makedirs(output_path, exist_ok=True)
+    
+    progress_hooks = []
+    if progress_hook:
+        progress_hooks.append(progress_hook)
+    
+    ydl_opts = {
+        'quiet': quiet,
+        'no_warnings': quiet,
+        'no_abort_on_error': True,
+        # 文件名由标题和格式确定，重启后沿用 .part/.ytdl 缓存断点续传
+        'continuedl': True,
+        'nopart': False,
+        **build_download_params(download_options),
+    }
+    # 每个任务不同的选项，不参与实例池的分组
+    task_opts = {
+        'outtmpl': os.path.join(output_path, '%(title).180s.%(ext)s'),
+        'format': format,
+        # 添加进度钩子来处理文件名
+        'progress_hooks': progress_hooks,
+    }
+    
+    with ydl_pool.checkout(ydl_opts, task_opts, StagedYoutubeDL if postprocess_jobs is not None else yt_dlp.YoutubeDL) as ydl:
+        if postprocess_jobs is not None:
+            ydl.postprocess_jobs = postprocess_jobs
+            ydl.presets = postprocess_presets(download_options)
+        if on_ydl:
+            on_ydl(ydl)
+        if on_selected:
+            ydl.add_post_processor(FormatSelectedPP(on_selected), when='before_dl')
+        # 只提取一次：优先使用 /info 缓存的结果，否则提取后写入缓存供 /info、/formats 复用
+        info = info_cache.get(url)
+        if info is None:
+            info = ydl.sanitize_info(ydl.extract_info(url, download=False))
+            info_cache.put(url, info)
+        try:
+            return download_extracted_info(ydl, url, info, format, output_path, content_store, task_id, download_options, postprocess_jobs)
+        except DownloadCancelled:
+            raise
+        except Exception:
+            # 下载失败时丢弃缓存的信息：签名地址可能已经失效（过期时间不一定在可识别的查询参数中），
+            # 重试时重新提取，而不是一直使用同一份失效的信息
+            info_cache.invalidate(url)
+            raise
+
+def download_extracted_info(ydl: yt_dlp.YoutubeDL, url: str, info: Dict[str, Any], format: str, output_path: str,
+                   content_store: Optional["ContentStore"], task_id: Optional[str], download_options: Optional[Dict[str, Any]],
+                   postprocess_jobs: Optional[List[Dict[str, Any]]]) -> Dict[str, Any]:
+    """download_video 的格式选择和下载部分，使用已经提取的 info"""
+    # 缓存中的字典是共享的，下载过程会修改 info，因此使用副本
+    info = copy.deepcopy(info)
+    
+    # 单个视频使用安全的文件名；播放列表保留默认模板，避免所有条目写入同一个文件
+    if info.get('_type', 'video') == 'video':
+        ydl.params['outtmpl']['default'] = build_safe_outtmpl(info, format, output_path)
+    
+    key = None
+    if content_store is not None and task_id and info.get('_type', 'video') == 'video':
+        # 先只做格式选择得到内容键；相同内容已经下载过时直接链接到输出目录
+        selected = ydl.process_ie_result(copy.deepcopy(info), download=False)
+        key = content_key(selected, url)
+        presets = postprocess_presets(download_options)
+        if key and presets:
+            # 后处理预设改变了输出内容
+            key += ":" + json.dumps(presets, sort_keys=True)
+        blob = content_store.lookup(key) if key else None
+        if blob:
+            target = ydl.prepare_filename(selected)
+            if presets:
+                # 转封装、转码后的扩展名以存储的文件为准
+                target = os.path.splitext(target)[0] + os.path.splitext(blob)[1]
+                selected['ext'] = os.path.splitext(blob)[1].lstrip('.')
+            content_store.link(task_id, key, blob, target)
+            selected['filepath'] = target
+            selected['requested_downloads'] = [{'filepath': target, 'format_id': selected.get('format_id'), 'ext': selected.get('ext')}]
+            return ydl.sanitize_info(selected)
+    
+    # 使用同一份信息完成格式选择和下载，不再重复提取
+    result = ydl.process_ie_result(info, download=True)
+    if key and postprocess_jobs:
+        # 输出文件在后处理之后才是最终内容，由后处理阶段存入内容存储
+        for job in postprocess_jobs:
+            job["content_key"] = key
+    elif key:
+        path = (result.get('requested_downloads') or [{}])[0].get('filepath')
+        if path and os.path.isfile(path):
+            content_store.ingest(task_id, key, path)
+    return ydl.sanitize_info(result)
+
+def run_postprocessors(jobs: List[Dict[str, Any]], quiet: bool = False,
+                       on_step: Optional[Callable[[int, int, str], None]] = None) -> List[Dict[str, Any]]:
+    """
+    依次执行 StagedYoutubeDL 记录的后处理作业，返回每个作业处理后的文件信息。
+    后处理器按类名在新的 YoutubeDL 中重新创建，不依赖下载时的实例；被合并、转换的原文件由 yt-dlp 删除。
+    on_step 在每个步骤开始前调用，参数为 (已完成的步骤数, 总步骤数, 后处理器类名)，可以抛出异常中止。
+    """
+    total = sum(len(job["steps"]) for job in jobs)
+    index = 0
+    infos: List[Dict[str, Any]] = []
+    with ydl_pool.checkout({'quiet': quiet, 'no_warnings': quiet}) as ydl:
+        for job in jobs:
+            info = copy.deepcopy(job["info"])
+            for name, options in job["steps"]:
+                if on_step:
+                    on_step(index, total, name)
+                info = ydl.run_pp(getattr(yt_dlp.postprocessor, name)(ydl, **options), info)
+                index += 1
+            info.pop('__files_to_move', None)
+            infos.append(info)
+    return infos
+
+def postprocess_job_files(job: Dict[str, Any]) -> List[str]:
+    """后处理作业涉及的文件：输出文件、待合并的各个格式和已下载的缩略图"""
+    info = job["info"]
+    files = [job["filepath"], *(info.get('__files_to_merge') or [])]
+    files.extend(thumbnail['filepath'] for thumbnail in info.get('thumbnails') or [] if thumbnail.get('filepath'))
+    return files
+
+def apply_postprocess_results(result: Dict[str, Any], replacements: Dict[str, Dict[str, Any]]) -> None:
+    """把后处理后的文件路径和扩展名写回下载结果中引用原输出文件的位置"""
+    entries = [result, *(result.get('requested_downloads') or [])]
+    for entry in result.get('entries') or []:
+        if entry:
+            entries.extend([entry, *(entry.get('requested_downloads') or [])])
+    for entry in entries:
+        for key in ('filepath', '_filename', 'filename'):
+            final = replacements.get(entry.get(key))
+            if final:
+                entry[key] = final['filepath']
+                entry['ext'] = final.get('ext') or entry.get('ext')
+
+class PostProcessPool:
+    """
+    后处理阶段：下载完成后的 ffmpeg 合并、修复、转封装、转码和嵌入缩略图。
+
+    下载线程只负责下载，需要后处理的任务在下载结束后交给本阶段并立即释放下载名额，
+    耗时的合并或转码不会占用下载并发。本阶段有独立的并发上限（默认与 CPU 核数相同），
+    每个线程驱动一个 ffmpeg 子进程，编码工作在子进程中并行进行。
+    排队和处理中的任务状态为 postprocessing，progress.postprocess 中报告当前步骤；
+    取消请求在当前步骤结束后生效。
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self._queued: Dict[str, float] = {}
+        self._active: Dict[str, float] = {}
+        self._runs: Set[asyncio.Task] = set()
+        self.stats: Dict[str, float] = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "canceled": 0,
+            "total_wait_seconds": 0.0,
+            "total_run_seconds": 0.0,
+        }
+
+    def start(self) -> None:
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="postprocess")
+
+    async def stop(self) -> None:
+        # 未完成的任务保持 postprocessing 状态，下次启动时重新排队
+        for run in list(self._runs):
+            run.cancel()
+        await asyncio.gather(*self._runs, return_exceptions=True)
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def is_active(self, task_id: str) -> bool:
+        return task_id in self._queued or task_id in self._active
+
+    def submit(self, task_id: str, jobs: List[Dict[str, Any]], result: Dict[str, Any], quiet: bool = False) -> None:
+        """把下载完成的任务交给后处理阶段（在事件循环中调用）"""
+        task = state.get_task(task_id)
+        progress = dict(task.progress or {}) if task else {}
+        progress["files"] = sorted({path for job in jobs for path in postprocess_job_files(job)})
+        progress["postprocess"] = {"status": "queued", "step": 0, "steps": sum(len(job["steps"]) for job in jobs)}
+        state.update_task(task_id, "postprocessing", progress=progress)
+        self._queued[task_id] = time.monotonic()
+        self.stats["submitted"] += 1
+        run = asyncio.create_task(self._run(task_id, jobs, result, quiet))
+        self._runs.add(run)
+        run.add_done_callback(self._runs.discard)
+
+    def _process(self, task_id: str, jobs: List[Dict[str, Any]], result: Dict[str, Any], quiet: bool) -> Dict[str, Any]:
+        """在后处理线程中执行：运行全部作业，更新下载结果，并把最终文件存入内容存储"""
+
+        def on_step(index: int, total: int, name: str) -> None:
+            if index == 0:
+                self._active[task_id] = time.monotonic()
+                self._queued.pop(task_id, None)
+            if state.is_cancel_requested(task_id):
+                raise DownloadCancelled("Canceled by user")
+            task = state.get_task(task_id)
+            progress = dict(task.progress or {}) if task else {}
+            progress["postprocess"] = {
+                "status": "processing",
+                "step": index + 1,
+                "steps": total,
+                "postprocessor": name,
+                "percent": round(100.0 * index / total, 1),
+            }
+            state.update_task(task_id, "postprocessing", progress=progress)
+
+        infos = run_postprocessors(jobs, quiet=quiet, on_step=on_step)
+        apply_postprocess_results(result, {job["filepath"]: info for job, info in zip(jobs, infos)})
+        for job, info in zip(jobs, infos):
+            path = info.get('filepath')
+            if content_store is not None and job.get("content_key") and path and os.path.isfile(path):
+                content_store.ingest(task_id, job["content_key"], path)
+        return result
+
+    async def _run(self, task_id: str, jobs: List[Dict[str, Any]], result: Dict[str, Any], quiet: bool) -> None:
+        enqueued_at = self._queued[task_id]
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(
+                self.executor, lambda: self._process(task_id, jobs, result, quiet)
+            )
+            state.update_task(task_id, "completed", result=result)
+        except DownloadCancelled as e:
+            state.update_task(task_id, "canceled", error=str(e))
+        except Exception as e:
+            task = state.get_task(task_id)
+            state.update_task(task_id, "failed", error=f"Post-processing failed: {e}", error_code="postprocessing",
+                              attempts=(task.attempts if task else 0) + 1)
+        finally:
+            self._queued.pop(task_id, None)
+            started_at = self._active.pop(task_id, None)
+            now = time.monotonic()
+            finished = state.get_task(task_id)
+            status = finished.status if finished else "deleted"
+            if started_at is not None:
+                self.stats["total_wait_seconds"] += started_at - enqueued_at
+                self.stats["total_run_seconds"] += now - started_at
+                metrics.record_postprocess(status, now - started_at)
+            if status in TERMINAL_STATUSES:
+                self.stats[status] += 1
+                scheduler.record_finished(task_id, status)
+            disk_guard.release(task_id)
+            state.clear_cancel(task_id)
+
+    def metrics(self) -> Dict[str, Any]:
+        finished = self.stats["completed"] + self.stats["failed"] + self.stats["canceled"]
+        return {
+            "max_workers": self.max_workers,
+            "active": len(self._active),
+            "queued": len(self._queued),
+            "utilization": round(len(self._active) / self.max_workers, 4),
+            "submitted": int(self.stats["submitted"]),
+            "completed": int(self.stats["completed"]),
+            "failed": int(self.stats["failed"]),
+            "canceled": int(self.stats["canceled"]),
+            "avg_wait_seconds": round(self.stats["total_wait_seconds"] / finished, 3) if finished else None,
+            "avg_run_seconds": round(self.stats["total_run_seconds"] / finished, 3) if finished else None,
+        }
+
+# 创建全局后处理阶段，并发上限默认等于 CPU 核数
+postprocessor = PostProcessPool(get_env_int("YTDLP_MAX_CONCURRENT_POSTPROCESS", os.cpu_count() or 1))
+
+def build_safe_outtmpl(info: Dict[str, Any], format: str, output_path: str) -> str:
+    """
+    根据视频标题生成 yt-dlp 的输出模板。
+
+    扩展名保留为 %(ext)s，由 yt-dlp 在按 format 选定格式后填充；标题和目录中的 % 需要转义。
+    """
+    title = info.get('title') or 'video'
+    placeholder_ext = 'ext'
+    safe_filename = create_safe_filename(title, format, placeholder_ext)
+    stem = safe_filename[:-len(placeholder_ext) - 1]
+    return os.path.join(output_path.replace('%', '%%'), stem.replace('%', '%%') + '.%(ext)s')
+
+# 签名流地址中表示过期时间（Unix 时间戳）的查询参数
+SIGNED_URL_EXPIRY_PARAMS = ("expire", "expires", "Expires", "exp")
+
+def get_signed_url_expiry(info: Dict[str, Any]) -> Optional[float]:
+    """返回视频信息中签名流地址最早的过期时间，没有签名地址时返回 None"""
+    urls = [info.get("url")]
+    for fmt in info.get("formats") or []:
+        urls.append(fmt.get("url"))
+    for fmt in info.get("requested_formats") or []:
+        urls.append(fmt.get("url"))
+    expiry: Optional[float] = None
+    for url in urls:
+        if not url or "?" not in url:
+            continue
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query)
+        for param in SIGNED_URL_EXPIRY_PARAMS:
+            for value in query.get(param, []):
+                try:
+                    timestamp = float(value)
+                except ValueError:
+                    continue
+                expiry = timestamp if expiry is None else min(expiry, timestamp)
+    return expiry
+
+class InfoCache:
+    """
+    视频信息提取缓存。
+
+    以规范化后的URL为键，条目在 ttl 秒后过期，并且不会晚于其中签名流地址的过期时间；
+    超过 max_entries 时淘汰最久未使用的条目。相同URL的并发请求只会触发一次提取（single-flight）。
+    persist 为 True 时额外写入 SQLite 的 info_cache 表，重启后仍然有效。
+    返回的字典在调用方之间共享，不要直接修改。
+    """
+
+    # 距离签名地址过期不足该秒数时视为已过期，留出下载开始前的余量
+    EXPIRY_MARGIN = 60.0
+
+    def __init__(self, ttl: float, max_entries: int, store: Optional[TaskStore] = None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.store = store
+        self._entries: "collections.OrderedDict[str, Tuple[float, Dict[str, Any]]]" = collections.OrderedDict()
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.stats: Dict[str, int] = {
+            "hits": 0,
+            "misses": 0,
+            "coalesced": 0,
+            "persistent_hits": 0,
+            "expired": 0,
+            "evictions": 0,
+            "invalidations": 0,
+        }
+        if self.store is not None:
+            self.store.execute('''
+            CREATE TABLE IF NOT EXISTS info_cache (
+                key TEXT PRIMARY KEY,
+                info TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+            ''')
+            self.store.execute("DELETE FROM info_cache WHERE expires_at < ?", (time.time(),))
+
+    def expires_at(self, info: Dict[str, Any], now: float) -> float:
+        expires_at = now + self.ttl
+        signed_expiry = get_signed_url_expiry(info)
+        if signed_expiry is not None:
+            expires_at = min(expires_at, signed_expiry - self.EXPIRY_MARGIN)
+        return expires_at
+
+    def _lookup(self, key: str, now: float) -> Optional[Dict[str, Any]]:
+        """在持有锁的情况下查找内存中的条目"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, info = entry
+        if expires_at <= now:
+            del self._entries[key]
+            self.stats["expired"] += 1
+            return None
+        self._entries.move_to_end(key)
+        return info
+
+    def _remember(self, key: str, info: Dict[str, Any], expires_at: float) -> None:
+        """在持有锁的情况下写入内存条目"""
+        self._entries[key] = (expires_at, info)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def _load_persistent(self, key: str, now: float) -> Optional[Tuple[float, Dict[str, Any]]]:
+        if self.store is None:
+            return None
+        rows = self.store.execute("SELECT info, expires_at FROM info_cache WHERE key = ? AND expires_at > ?", (key, now))
+        if not rows:
+            return None
+        return rows[0][1], json.loads(rows[0][0])
+
+    def peek(self, url: str) -> Optional[Dict[str, Any]]:
+        """只查找内存中的条目，不访问数据库，可以在事件循环中调用"""
+        with self._lock:
+            info = self._lookup(normalize_url(url), time.time())
+            if info is not None:
+                self.stats["hits"] += 1
+            return info
+
+    def get(self, url: str) -> Optional[Dict[str, Any]]:
+        key = normalize_url(url)
+        now = time.time()
+        with self._lock:
+            info = self._lookup(key, now)
+            if info is not None:
+                self.stats["hits"] += 1
+                return info
+        persisted = self._load_persistent(key, now)
+        with self._lock:
+            if persisted is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["persistent_hits"] += 1
+            self._remember(key, persisted[1], persisted[0])
+        return persisted[1]
+
+    def put(self, url: str, info: Dict[str, Any]) -> None:
+        """缓存一次提取的结果；签名地址已经（或即将）过期的结果不缓存"""
+        key = normalize_url(url)
+        now = time.time()
+        expires_at = self.expires_at(info, now)
+        if expires_at <= now:
+            return
+        with self._lock:
+            self._remember(key, info, expires_at)
+        if self.store is not None:
+            try:
+                self.store.execute(
+                    "INSERT OR REPLACE INTO info_cache (key, info, expires_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(info), expires_at),
+                )
+            except Exception as e:
+                print(f"Error saving video info to cache: {e}")
+
+    def invalidate(self, url: str) -> None:
+        """丢弃 URL 的缓存条目，例如下载时发现其中的流地址已经失效"""
+        key = normalize_url(url)
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.stats["invalidations"] += 1
+        if self.store is not None:
+            try:
+                self.store.execute("DELETE FROM info_cache WHERE key = ?", (key,))
+            except Exception as e:
+                print(f"Error removing video info from cache: {e}")
+
+    def get_or_extract(self, url: str, extract: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+        """返回缓存的视频信息，未命中时调用 extract；并发的相同请求共享同一次提取"""
+        key = normalize_url(url)
+        now = time.time()
+        with self._lock:
+            info = self._lookup(key, now)
+            if info is not None:
+                self.stats["hits"] += 1
+                return info
+            inflight = self._inflight.get(key)
+            if inflight is None:
+                future: Future = Future()
+                self._inflight[key] = future
+            else:
+                self.stats["coalesced"] += 1
+        if inflight is not None:
+            return inflight.result()
+
+        try:
+            persisted = self._load_persistent(key, now)
+            if persisted is not None:
+                with self._lock:
+                    self.stats["persistent_hits"] += 1
+                    self._remember(key, persisted[1], persisted[0])
+                info = persisted[1]
+            else:
+                with self._lock:
+                    self.stats["misses"] += 1
+                info = extract()
+                self.put(url, info)
+            future.set_result(info)
+            return info
+        except BaseException as e:
+            future.set_exception(e)
+            # 没有其他等待者时也要取出异常，避免 "exception was never retrieved" 警告
+            future.exception()
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["coalesced"] + self.stats["persistent_hits"] + self.stats["misses"]
+            served = lookups - self.stats["misses"]
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "persistent": self.store is not None,
+                "inflight": len(self._inflight),
+                **self.stats,
+                "hit_ratio": round(served / lookups, 4) if lookups else None,
+            }
+
+# 视频信息缓存，/info 与 /formats 共享
+info_cache = InfoCache(
+    ttl=get_env_float("YTDLP_INFO_CACHE_TTL", 300.0),
+    max_entries=get_env_int("YTDLP_INFO_CACHE_SIZE", 256),
+    store=state.store if get_env_bool("YTDLP_INFO_CACHE_PERSIST", False) else None,
+)
+
+def get_cached_video_info(url: str) -> Dict[str, Any]:
+    """通过缓存获取视频信息，未命中时执行一次完整提取"""
+    return info_cache.get_or_extract(url, lambda: get_video_info(url))
+
+def get_video_info(url: str, quiet: bool = False) -> Dict[str, Any]:
+    """
+    Get information about a video without downloading it.
+    
+    Args:
+        url (str): The URL of the video
+        quiet (bool): If True, suppress output
+        
+    Returns:
+        Dict[str, Any]: Information about the video
+    """
+    ydl_opts = {
+        'quiet': quiet,
         'no_warnings': quiet,
         'skip_download': True,
     }
     
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+    started_at = time.perf_counter()
+    try:
+        with ydl_pool.checkout(ydl_opts) as ydl:
+            info = ydl.extract_info(url, download=False)
+            return ydl.sanitize_info(info)
+    finally:
+        metrics.record_extraction(time.perf_counter() - started_at)
+
+def get_playlist_entries(url: str, quiet: bool = True) -> Optional[List[str]]:
+    """
+    List the entry URLs of a playlist with a flat extraction (entries are not resolved).
+
+    Args:
+        url (str): The URL of the playlist
+        quiet (bool): If True, suppress output
+
+    Returns:
+        Optional[List[str]]: Entry URLs, or None if the URL is a single video
+    """
+    ydl_opts = {
+        'quiet': quiet,
+        'no_warnings': quiet,
+        'skip_download': True,
+        'extract_flat': 'in_playlist',
+    }
+
+    with ydl_pool.checkout(ydl_opts) as ydl:
         info = ydl.extract_info(url, download=False)
-        return ydl.sanitize_info(info)
+        if info.get('_type') not in ('playlist', 'multi_video'):
+            # 单个视频已经完整提取过，缓存起来供下载复用
+            info_cache.put(url, ydl.sanitize_info(info))
+            return None
+    entries = []
+    for entry in info.get('entries') or []:
+        entry_url = entry.get('webpage_url') or entry.get('url') if entry else None
+        if entry_url and entry_url.startswith(('http://', 'https://')):
+            entries.append(entry_url)
+    return entries
 
 def list_available_formats(url: str) -> List[Dict[str, Any]]:
     """
@@ -364,12 +3347,126 @@ def list_available_formats(url: str) -> List[Dict[str, Any]]:
     Returns:
         List[Dict[str, Any]]: List of available formats
     """
-    info = get_video_info(url)
+    info = get_cached_video_info(url)
     if not info:
         return []
     
     return info.get('formats', [])
 
+class ExtractionTimeout(Exception):
+    pass
+
+class ClientDisconnected(Exception):
+    pass
+
+class ExtractionPool:
+    """
+    专用于 /info、/formats 的提取线程池。
+
+    提取在事件循环之外执行，同时运行的数量不超过 max_workers；每个请求最多等待
+    timeout 秒，客户端断开连接后立即停止等待（尚未开始的提取会被取消）。
+    记录排队等待与总耗时的直方图，用于判断线程池是否饱和。
+    """
+
+    def __init__(self, max_workers: int, timeout: float):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="extract")
+        self.latency = LatencyHistogram()
+        self.queue_wait = LatencyHistogram()
+        self._lock = threading.Lock()
+        self.stats: Dict[str, int] = {"submitted": 0, "queued": 0, "running": 0, "timeouts": 0, "disconnects": 0, "errors": 0}
+
+    async def run(self, request: Optional[Request], func: Callable[[], Any]) -> Any:
+        submitted_at = time.monotonic()
+
+        def job() -> Any:
+            started_at = time.monotonic()
+            self.queue_wait.observe(started_at - submitted_at)
+            with self._lock:
+                self.stats["queued"] -= 1
+                self.stats["running"] += 1
+            try:
+                return func()
+            finally:
+                with self._lock:
+                    self.stats["running"] -= 1
+                self.latency.observe(time.monotonic() - submitted_at)
+
+        with self._lock:
+            self.stats["submitted"] += 1
+            self.stats["queued"] += 1
+        pending = self.executor.submit(job)
+        extraction = asyncio.wrap_future(pending)
+        watchers = {extraction}
+        disconnect = None
+        if request is not None:
+            disconnect = asyncio.ensure_future(wait_for_disconnect(request))
+            watchers.add(disconnect)
+        try:
+            done, _ = await asyncio.wait(watchers, timeout=self.timeout, return_when=asyncio.FIRST_COMPLETED)
+            if extraction in done:
+                try:
+                    return extraction.result()
+                except Exception:
+                    with self._lock:
+                        self.stats["errors"] += 1
+                    raise
+            # 已经开始的提取无法中断，会在后台完成并写入缓存；尚未开始的会被取消
+            cancelled = pending.cancel()
+            with self._lock:
+                if cancelled:
+                    self.stats["queued"] -= 1
+                if disconnect is not None and disconnect in done:
+                    self.stats["disconnects"] += 1
+                    raise ClientDisconnected()
+                self.stats["timeouts"] += 1
+            raise ExtractionTimeout(f"Extraction timed out after {self.timeout:g}s")
+        finally:
+            if disconnect is not None:
+                disconnect.cancel()
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+        return {
+            "max_workers": self.max_workers,
+            "timeout": self.timeout,
+            "saturated": stats["running"] >= self.max_workers,
+            **stats,
+            "queue_wait_seconds": self.queue_wait.snapshot(),
+            "latency_seconds": self.latency.snapshot(),
+        }
+
+async def wait_for_disconnect(request: Request) -> None:
+    """等待客户端断开连接（GET 请求没有请求体，后续的 receive 只会收到断开消息）"""
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+extraction_pool = ExtractionPool(
+    max_workers=get_env_int("YTDLP_EXTRACT_WORKERS", 4),
+    timeout=get_env_float("YTDLP_EXTRACT_TIMEOUT", 60.0, minimum=1.0),
+)
+
+async def run_extraction(request: Optional[Request], func: Callable[[], Any]) -> Any:
+    """在提取线程池中执行 func，超时返回 504，客户端断开返回 499"""
+    try:
+        return await extraction_pool.run(request, func)
+    except ExtractionTimeout as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except ClientDisconnected:
+        # 客户端已经断开，返回值不会被读取
+        raise HTTPException(status_code=499, detail="Client closed request")
+
+async def fetch_video_info(request: Request, url: str) -> Dict[str, Any]:
+    """在提取线程池中获取视频信息；内存缓存命中时直接返回"""
+    info = info_cache.peek(url)
+    if info is not None:
+        return info
+    return await run_extraction(request, lambda: get_cached_video_info(url))
+
 def build_progress_payload(progress_data: Dict[str, Any]) -> Dict[str, Any]:
     total = progress_data.get("total_bytes") or progress_data.get("total_bytes_estimate")
     downloaded = progress_data.get("downloaded_bytes")
@@ -389,6 +3486,76 @@ def build_progress_payload(progress_data: Dict[str, Any]) -> Dict[str, Any]:
         "filename": progress_data.get("filename"),
     }
 
+class ProgressTracker:
+    """
+    对单个任务的 yt-dlp 进度回调做节流和平滑。
+
+    每次回调都会记录采样点，但只有距离上次上报超过 min_interval 秒，或进度
+    前进了 min_percent 个百分点时才生成新的进度数据；finished 事件和文件切换
+    总是上报。速度与剩余时间根据最近 window 秒内的采样计算，比 yt-dlp 的瞬时值更稳定。
+    """
+
+    def __init__(self, min_interval: float, min_percent: float = 0.0, window: float = 5.0):
+        self.min_interval = min_interval
+        self.min_percent = min_percent
+        self.window = window
+        self._samples: "collections.deque[Tuple[float, int]]" = collections.deque()
+        self._filename: Optional[str] = None
+        self._last_emit: Optional[float] = None
+        self._last_percent: Optional[float] = None
+
+    def _record(self, now: float, downloaded: Optional[int]) -> None:
+        if downloaded is None:
+            return
+        self._samples.append((now, downloaded))
+        while len(self._samples) > 2 and now - self._samples[0][0] > self.window:
+            self._samples.popleft()
+
+    def smoothed_speed(self) -> Optional[float]:
+        if len(self._samples) < 2:
+            return None
+        (first_time, first_bytes), (last_time, last_bytes) = self._samples[0], self._samples[-1]
+        if last_time <= first_time:
+            return None
+        return max(0.0, (last_bytes - first_bytes) / (last_time - first_time))
+
+    def update(self, progress_data: Dict[str, Any], now: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """记录一次回调，需要上报时返回进度数据，否则返回 None"""
+        now = time.monotonic() if now is None else now
+        filename = progress_data.get("filename")
+        file_changed = filename != self._filename
+        if file_changed:
+            # 合并格式会依次下载多个文件，切换文件时重新计算速度
+            self._samples.clear()
+            self._filename = filename
+            self._last_percent = None
+        self._record(now, progress_data.get("downloaded_bytes"))
+
+        payload = build_progress_payload(progress_data)
+        finished = progress_data.get("status") == "finished"
+        if not (finished or file_changed or self._last_emit is None):
+            due = now - self._last_emit >= self.min_interval
+            percent = payload["percent"]
+            advanced = (
+                self.min_percent > 0
+                and percent is not None
+                and self._last_percent is not None
+                and percent - self._last_percent >= self.min_percent
+            )
+            if not (due or advanced):
+                return None
+
+        speed = self.smoothed_speed()
+        if speed is not None:
+            payload["speed"] = round(speed, 2)
+            total = payload["total_bytes"] or payload["total_bytes_estimate"]
+            downloaded = payload["downloaded_bytes"]
+            if total and downloaded is not None and speed > 0:
+                payload["eta"] = max(0, int((total - downloaded) / speed))
+        self._last_emit = now
+        self._last_percent = payload["percent"]
+        return payload
+
 def is_within_directory(path: str, base_dir: str) -> bool:
     try:
         return os.path.commonpath([path, base_dir]) == base_dir
@@ -428,24 +3595,217 @@ def expand_cache_paths(base_path: str) -> Set[str]:
             expanded.add(pattern)
     return expanded
 
-def delete_task_files(task: Task) -> int:
-    raw_paths: List[Optional[str]] = []
-    if task.result:
-        for key in ("filepath", "_filename", "filename", "requested_filename"):
-            raw_paths.append(task.result.get(key))
-        for entry in task.result.get("requested_downloads") or []:
-            raw_paths.append(entry.get("filepath") or entry.get("filename"))
-    if task.progress:
-        raw_paths.append(task.progress.get("filename"))
+def collect_task_file_paths(task: Task) -> Set[str]:
+    """收集任务相关的所有文件路径（包括 .part / .ytdl / 分片缓存），仅限输出目录内"""
+    raw_paths: List[Optional[str]] = []
+    result = state.load_result(task)
+    if result:
+        for key in ("filepath", "_filename", "filename", "requested_filename"):
+            raw_paths.append(result.get(key))
+        for entry in result.get("requested_downloads") or []:
+            raw_paths.append(entry.get("filepath") or entry.get("filename"))
+    if task.progress:
+        raw_paths.append(task.progress.get("filename"))
+        # 后处理阶段记录的输入文件（待合并的各个格式、缩略图等）
+        raw_paths.extend(task.progress.get("files") or [])
+
+    output_dir = os.path.abspath(task.output_path)
+    candidates = normalize_candidate_paths(raw_paths, task.output_path)
+    file_paths: Set[str] = set()
+    for base_path in candidates:
+        for path in expand_cache_paths(base_path):
+            abs_path = os.path.abspath(path)
+            if is_within_directory(abs_path, output_dir):
+                file_paths.add(abs_path)
+    return file_paths
+
+def get_partial_download_bytes(task: Task) -> int:
+    """统计任务已下载但未完成的缓存字节数（.part 与分片文件），用于断点续传"""
+    total = 0
+    for path in collect_task_file_paths(task):
+        name = os.path.basename(path)
+        if not (name.endswith(".part") or "-Frag" in name):
+            continue
+        try:
+            total += os.path.getsize(path)
+        except OSError:
+            continue
+    return total
+
+def content_key(info: Dict[str, Any], url: str) -> Optional[str]:
+    """
+    由提取器、视频ID和选定的格式组成内容键，相同键的下载结果完全相同。
+    通用提取器的ID只是文件名，改用规范化后的页面地址。
+    """
+    extractor = info.get('extractor_key')
+    video_id = info.get('id')
+    format_id = info.get('format_id')
+    if not (extractor and video_id and format_id):
+        return None
+    if extractor == 'Generic':
+        video_id = normalize_url(info.get('webpage_url') or url)
+    return f"{extractor}:{video_id}:{format_id}:{info.get('ext')}"
+
+def clone_file(src: str, dst: str) -> None:
+    """在 dst 创建 src 的硬链接；跨文件系统时尝试 reflink，都不支持时复制"""
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            import fcntl
+            # FICLONE：btrfs/xfs 等文件系统上共享数据块的副本
+            fcntl.ioctl(fdst.fileno(), 0x40049409, fsrc.fileno())
+            return
+        except (ImportError, OSError):
+            pass
+        shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+
+class ContentStore:
+    """
+    已下载文件的内容寻址存储。
+
+    每个内容键对应目录中的一个文件（blob），任务的输出文件是它的硬链接，因此
+    同一个视频下载到不同的 output_path，或不同的 format 字符串选中相同格式时只下载一次。
+    content_blobs 记录每个 blob 的引用计数，content_refs 记录任务使用的 blob；
+    最后一个引用它的任务被删除时才删除 blob。
+    """
+
+    def __init__(self, store: TaskStore, directory: str):
+        self.store = store
+        self.directory = os.path.abspath(directory)
+        self.stats: Dict[str, int] = {"hits": 0, "misses": 0, "stored": 0, "removed": 0}
+        os.makedirs(self.directory, exist_ok=True)
+        self.store.execute('''
+        CREATE TABLE IF NOT EXISTS content_blobs (
+            key TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0
+        )
+        ''')
+        self.store.execute('''
+        CREATE TABLE IF NOT EXISTS content_refs (
+            task_id TEXT PRIMARY KEY,
+            key TEXT NOT NULL,
+            path TEXT NOT NULL
+        )
+        ''')
+
+    def blob_path(self, key: str, ext: Optional[str]) -> str:
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest[:2], f"{digest}.{ext or 'bin'}")
+
+    def lookup(self, key: str) -> Optional[str]:
+        """返回内容键对应的 blob 路径；文件已不存在时返回 None"""
+        rows = self.store.execute("SELECT path FROM content_blobs WHERE key = ?", (key,))
+        if rows and os.path.isfile(rows[0][0]):
+            self.stats["hits"] += 1
+            return rows[0][0]
+        self.stats["misses"] += 1
+        return None
+
+    def link(self, task_id: str, key: str, blob: str, target: str) -> None:
+        """把 blob 链接到任务的输出路径并记录引用"""
+        os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+        if not (os.path.exists(target) and os.path.samefile(blob, target)):
+            tmp_path = f"{target}.{uuid.uuid4().hex[:8]}.tmp"
+            clone_file(blob, tmp_path)
+            os.replace(tmp_path, target)
+        self._add_ref(task_id, key, blob, target)
+
+    def ingest(self, task_id: str, key: str, path: str) -> None:
+        """把刚下载完成的文件放入存储，并记录任务的引用"""
+        blob = self.blob_path(key, os.path.splitext(path)[1].lstrip("."))
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        try:
+            os.link(path, blob)
+            self.stats["stored"] += 1
+        except FileExistsError:
+            # 其他任务同时下载了相同内容，改为链接到已有的 blob，不保留两份数据
+            self.link(task_id, key, blob, path)
+            return
+        except OSError:
+            # 不支持硬链接（例如跨文件系统）时保存一份副本
+            tmp_path = f"{blob}.{uuid.uuid4().hex[:8]}.tmp"
+            clone_file(path, tmp_path)
+            os.replace(tmp_path, blob)
+            self.stats["stored"] += 1
+        self._add_ref(task_id, key, blob, path)
+
+    def _add_ref(self, task_id: str, key: str, blob: str, path: str) -> None:
+        size = os.path.getsize(blob)
+        with self.store.transaction() as conn:
+            row = conn.execute("SELECT key FROM content_refs WHERE task_id = ?", (task_id,)).fetchone()
+            if row is not None and row[0] == key:
+                conn.execute("UPDATE content_refs SET path = ? WHERE task_id = ?", (os.path.abspath(path), task_id))
+                return
+            released = self._release(conn, task_id) if row is not None else None
+            conn.execute(
+                "INSERT INTO content_blobs (key, path, size, refcount) VALUES (?, ?, ?, 1) "
+                "ON CONFLICT(key) DO UPDATE SET path = excluded.path, size = excluded.size, refcount = refcount + 1",
+                (key, blob, size),
+            )
+            conn.execute("INSERT OR REPLACE INTO content_refs (task_id, key, path) VALUES (?, ?, ?)", (task_id, key, os.path.abspath(path)))
+        if released:
+            self._remove_blob(released)
+
+    def _release(self, conn: sqlite3.Connection, task_id: str) -> Optional[str]:
+        """在事务中删除任务的引用；blob 不再被引用时删除记录并返回其路径"""
+        row = conn.execute("SELECT key FROM content_refs WHERE task_id = ?", (task_id,)).fetchone()
+        if row is None:
+            return None
+        conn.execute("DELETE FROM content_refs WHERE task_id = ?", (task_id,))
+        conn.execute("UPDATE content_blobs SET refcount = refcount - 1 WHERE key = ?", (row[0],))
+        blob = conn.execute("SELECT path FROM content_blobs WHERE key = ? AND refcount <= 0", (row[0],)).fetchone()
+        if blob is None:
+            return None
+        conn.execute("DELETE FROM content_blobs WHERE key = ?", (row[0],))
+        return blob[0]
+
+    def release(self, task_id: str) -> None:
+        """任务被删除时释放引用，最后一个引用释放后删除 blob"""
+        with self.store.transaction() as conn:
+            released = self._release(conn, task_id)
+        if released:
+            self._remove_blob(released)
+
+    def _remove_blob(self, path: str) -> None:
+        try:
+            os.remove(path)
+            self.stats["removed"] += 1
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Error deleting stored file {path}: {e}")
+
+    def paths_in_use(self, paths: Set[str], task_id: str) -> Set[str]:
+        """返回 paths 中仍被其他任务作为输出文件使用的路径"""
+        if not paths:
+            return set()
+        rows = self.store.execute(
+            f"SELECT path FROM content_refs WHERE task_id != ? AND path IN ({', '.join('?' for _ in paths)})",
+            (task_id, *paths),
+        )
+        return {row[0] for row in rows}
+
+    def metrics(self) -> Dict[str, Any]:
+        rows = self.store.execute("SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(refcount), 0) FROM content_blobs")
+        blobs, size, refs = rows[0]
+        return {"directory": self.directory, "blobs": blobs, "bytes": size, "references": refs, **self.stats}
+
+# 内容寻址存储目录，为空时不启用
+CONTENT_STORE_DIR = os.environ.get("YTDLP_CONTENT_STORE_DIR", "").strip()
+content_store = ContentStore(state.store, CONTENT_STORE_DIR) if CONTENT_STORE_DIR else None
 
-    output_dir = os.path.abspath(task.output_path)
-    candidates = normalize_candidate_paths(raw_paths, task.output_path)
-    file_paths: Set[str] = set()
-    for base_path in candidates:
-        for path in expand_cache_paths(base_path):
-            abs_path = os.path.abspath(path)
-            if is_within_directory(abs_path, output_dir):
-                file_paths.add(abs_path)
+def delete_task_files(task: Task) -> int:
+    file_paths = collect_task_file_paths(task)
+    if content_store is not None:
+        # 与其他任务共用的输出文件保留，只释放本任务对 blob 的引用
+        file_paths -= content_store.paths_in_use(file_paths, task.id)
+        content_store.release(task.id)
 
     deleted = 0
     for path in sorted(file_paths, key=len, reverse=True):
@@ -457,25 +3817,450 @@ def delete_task_files(task: Task) -> int:
             print(f"Error deleting file {path}: {e}")
     return deleted
 
+class RetentionPolicy(BaseModel):
+    ttl: Optional[float] = Field(None, gt=0, description="Evict files not served for this many seconds")
+    quota: Optional[int] = Field(None, ge=0, description="Maximum bytes of completed files in the directory")
+    min_free: Optional[int] = Field(None, ge=0, description="Evict files while the volume has less free space than this")
+
+def task_disk_usage(task: Task) -> int:
+    """任务在输出目录中的文件占用的字节数"""
+    total = 0
+    for path in collect_task_file_paths(task):
+        try:
+            total += os.path.getsize(path)
+        except OSError:
+            continue
+    return total
+
+class RetentionEngine:
+    """
+    按输出目录自动清理已完成任务的文件。
+
+    每个目录（或 default）可以配置三种策略，任务按最后一次被访问（没有访问记录时为完成时间）排序：
+    - ttl：超过 ttl 秒没有被访问的任务
+    - quota：目录中已完成任务的文件总大小超过 quota 时，从最久未访问的任务开始清理
+    - min_free：卷的可用空间低于 min_free 时，同样从最久未访问的任务开始清理
+    清理与 DELETE /task 相同：通过 delete_task_files 删除文件并删除任务记录，之后再次提交相同链接会重新下载。
+    访问时间先记录在内存中，每次清理前写入 task_access 表。
+    """
+
+    def __init__(self, store: TaskStore, policies: Dict[str, Dict[str, Any]], interval: float):
+        self.store = store
+        self.policies = {
+            name if name == "default" else os.path.abspath(name): policy
+            for name, policy in policies.items()
+            if policy
+        }
+        self.interval = interval
+        self._accessed: Dict[str, float] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self.stats: Dict[str, Any] = {"runs": 0, "evicted_tasks": 0, "evicted_bytes": 0, "last_run": None}
+        self.store.execute('''
+        CREATE TABLE IF NOT EXISTS task_access (
+            task_id TEXT PRIMARY KEY,
+            accessed_at REAL NOT NULL
+        )
+        ''')
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.policies)
+
+    def policy_for(self, output_path: str) -> Optional[Dict[str, Any]]:
+        return self.policies.get(os.path.abspath(output_path)) or self.policies.get("default")
+
+    def touch(self, task_id: str) -> None:
+        """记录任务的文件被访问"""
+        if self.enabled:
+            self._accessed[task_id] = time.time()
+
+    def wake(self) -> None:
+        """立即执行一次清理（例如有任务因空间不足被推迟）"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _flush_access(self) -> None:
+        accessed, self._accessed = self._accessed, {}
+        with self.store.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO task_access (task_id, accessed_at) VALUES (?, ?) "
+                "ON CONFLICT(task_id) DO UPDATE SET accessed_at = MAX(accessed_at, excluded.accessed_at)",
+                list(accessed.items()),
+            )
+            conn.execute("DELETE FROM task_access WHERE task_id NOT IN (SELECT id FROM tasks)")
+
+    def select_evictions(self, policy: Dict[str, Any], directory: str, entries: List[Tuple[str, float]],
+                         size_of: Callable[[str], int], now: float) -> List[str]:
+        """
+        按策略选出需要清理的任务。entries 为 (任务ID, 最后访问时间)，size_of 返回任务文件的大小。
+        """
+        entries = sorted(entries, key=lambda entry: entry[1])
+        evicted: List[str] = []
+        ttl = policy.get("ttl")
+        if ttl:
+            evicted = [task_id for task_id, used_at in entries if now - used_at > ttl]
+            entries = entries[len(evicted):]
+        quota = policy.get("quota")
+        if quota is not None:
+            total = sum(size_of(task_id) for task_id, _ in entries)
+            while entries and total > quota:
+                task_id, _ = entries.pop(0)
+                evicted.append(task_id)
+                total -= size_of(task_id)
+        min_free = policy.get("min_free")
+        if min_free is not None:
+            # 已选出的任务删除后释放的空间也计入
+            free = shutil.disk_usage(directory).free + sum(size_of(task_id) for task_id in evicted)
+            while entries and free < min_free:
+                task_id, _ = entries.pop(0)
+                evicted.append(task_id)
+                free += size_of(task_id)
+        return evicted
+
+    def run_once(self) -> int:
+        """执行一次清理，返回清理的任务数"""
+        self._flush_access()
+        rows = self.store.execute(
+            "SELECT t.id, t.output_path, t.timestamp, a.accessed_at FROM tasks t "
+            "LEFT JOIN task_access a ON a.task_id = t.id WHERE t.status = 'completed' AND t.kind = 'video'"
+        )
+        by_directory: Dict[str, List[Tuple[str, float]]] = {}
+        for task_id, output_path, timestamp, accessed_at in rows:
+            try:
+                completed_at = datetime.datetime.fromisoformat(timestamp).timestamp()
+            except (TypeError, ValueError):
+                completed_at = 0.0
+            by_directory.setdefault(os.path.abspath(output_path), []).append((task_id, max(accessed_at or 0.0, completed_at)))
+
+        evicted = 0
+        now = time.time()
+        for directory, entries in by_directory.items():
+            policy = self.policy_for(directory)
+            if not policy or not os.path.isdir(directory):
+                continue
+            sizes: Dict[str, int] = {}
+
+            def size_of(task_id: str) -> int:
+                if task_id not in sizes:
+                    task = state.get_task(task_id)
+                    sizes[task_id] = task_disk_usage(task) if task else 0
+                return sizes[task_id]
+
+            for task_id in self.select_evictions(policy, directory, entries, size_of, now):
+                task = state.get_task(task_id)
+                if task is None or task.status != "completed":
+                    continue
+                size = size_of(task_id)
+                discard_task(task)
+                if task.parent_id:
+                    state.refresh_parent(task.parent_id)
+                evicted += 1
+                self.stats["evicted_tasks"] += 1
+                self.stats["evicted_bytes"] += size
+        self.stats["runs"] += 1
+        self.stats["last_run"] = datetime.datetime.now().isoformat()
+        if evicted:
+            print(f"Retention evicted {evicted} task(s)")
+        return evicted
+
+    async def run(self) -> None:
+        """每 interval 秒或被 wake 唤醒时执行一次清理"""
+        self._wakeup = asyncio.Event()
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                try:
+                    await run_in_threadpool(self.run_once)
+                except Exception as e:
+                    print(f"Error applying retention policies: {e}")
+        finally:
+            self._wakeup = None
+
+    def metrics(self) -> Dict[str, Any]:
+        return {"policies": dict(self.policies), "interval": self.interval, **self.stats}
+
+def load_retention_policies() -> Dict[str, Dict[str, Any]]:
+    """
+    从 YTDLP_RETENTION（JSON）读取各输出目录的保留策略，例如
+    {"./downloads": {"ttl": 604800, "quota": 107374182400}, "default": {"min_free": 10737418240}}
+    """
+    raw = os.environ.get("YTDLP_RETENTION")
+    if not raw:
+        return {}
+    try:
+        return {
+            directory: RetentionPolicy(**policy).model_dump(exclude_none=True)
+            for directory, policy in json.loads(raw).items()
+        }
+    except Exception as e:
+        print(f"Invalid YTDLP_RETENTION, ignoring: {e}")
+        return {}
+
+retention = RetentionEngine(state.store, load_retention_policies(), get_env_float("YTDLP_RETENTION_INTERVAL", 300.0, minimum=1.0))
+
+# 常见媒体类型，部分系统的 mimetypes 数据库中没有
+for _ext, _type in ((".mkv", "video/x-matroska"), (".webm", "video/webm"), (".m4a", "audio/mp4"),
+                    (".opus", "audio/ogg"), (".flv", "video/x-flv"), (".ts", "video/mp2t")):
+    mimetypes.add_type(_type, _ext)
+
+def resolve_task_file(task: Task) -> Optional[str]:
+    """从已完成任务的 result 中找出最终输出文件的路径"""
+    result = state.load_result(task)
+    if not result:
+        return None
+    requested = (result.get("requested_downloads") or [{}])[0]
+    filename = requested.get("filepath") or requested.get("filename") or result.get("requested_filename")
+    if not filename:
+        # 尝试构建可能的文件路径
+        title = result.get("title", "video")
+        ext = result.get("ext", "mp4")
+        filename = os.path.join(task.output_path, f"{title}.{ext}")
+    return filename
+
+class ServedFile(NamedTuple):
+    path: str
+    stat_result: os.stat_result
+    media_type: str
+    checked_at: float
+
+class ServedFileCache:
+    """
+    已完成任务输出文件的元数据缓存（路径、大小、修改时间、媒体类型）。
+
+    条目在 revalidate_after 秒内直接复用，之后才重新 stat 一次；任务被删除或重启时失效。
+    """
+
+    def __init__(self, revalidate_after: float, max_entries: int = 10000):
+        self.revalidate_after = revalidate_after
+        self.max_entries = max_entries
+        self._entries: "collections.OrderedDict[str, ServedFile]" = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, task: Task) -> Optional[ServedFile]:
+        """返回任务文件的元数据，文件不存在时返回 None"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(task.id)
+            if entry is not None and now - entry.checked_at < self.revalidate_after:
+                self._entries.move_to_end(task.id)
+                return entry
+        path = entry.path if entry is not None else resolve_task_file(task)
+        if not path:
+            return None
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            self.invalidate(task.id)
+            return None
+        if not stat.S_ISREG(stat_result.st_mode):
+            return None
+        media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        entry = ServedFile(path, stat_result, media_type, now)
+        with self._lock:
+            self._entries[task.id] = entry
+            self._entries.move_to_end(task.id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, task_id: str) -> None:
+        with self._lock:
+            self._entries.pop(task_id, None)
+
+served_files = ServedFileCache(get_env_float("YTDLP_FILE_CACHE_REVALIDATE", 30.0))
+
+class MediaFileResponse(FileResponse):
+    """
+    媒体文件响应，在 Starlette FileResponse（Range/多段 Range/HEAD）的基础上：
+    服务器支持 ASGI http.response.zerocopy 扩展时使用 sendfile 零拷贝发送，
+    否则使用更大的读取块以降低大文件传输的 CPU 开销。
+    """
+
+    chunk_size = 1024 * 1024
+
+    async def __call__(self, scope, receive, send) -> None:
+        self._zerocopy = "http.response.zerocopy" in (scope.get("extensions") or {})
+
+        async def send_fixed(message) -> None:
+            # Starlette 的 416 响应中 Content-Range 缺少单位，按 RFC 7233 补上 "bytes "
+            if message["type"] == "http.response.start" and message["status"] == 416:
+                message["headers"] = [(key, b"bytes " + value if key == b"content-range" and value.startswith(b"*/") else value)
+                                      for key, value in message["headers"]]
+            await send(message)
+
+        await super().__call__(scope, receive, send_fixed)
+
+    async def _send_zerocopy(self, send, offset: int, count: int) -> None:
+        with open(self.path, "rb") as file:
+            await send({"type": "http.response.zerocopy", "file": file, "offset": offset, "count": count, "more_body": False})
+
+    async def _handle_simple(self, send, send_header_only: bool) -> None:
+        if not self._zerocopy or send_header_only:
+            return await super()._handle_simple(send, send_header_only)
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        await self._send_zerocopy(send, 0, self.stat_result.st_size)
+
+    async def _handle_single_range(self, send, start: int, end: int, file_size: int, send_header_only: bool) -> None:
+        if not self._zerocopy or send_header_only:
+            return await super()._handle_single_range(send, start, end, file_size, send_header_only)
+        self.headers["content-range"] = f"bytes {start}-{end - 1}/{file_size}"
+        self.headers["content-length"] = str(end - start)
+        await send({"type": "http.response.start", "status": 206, "headers": self.raw_headers})
+        await self._send_zerocopy(send, start, end - start)
+
+    async def _handle_multiple_ranges(self, send, ranges: List[Tuple[int, int]], file_size: int, send_header_only: bool) -> None:
+        # Starlette 把 multipart/byteranges 写进了 Content-Range 且长度少算一个字节，
+        # 这里按 RFC 7233 放在 Content-Type 中并重新计算长度
+        boundary = secrets.token_hex(13)
+        _, header_generator = self.generate_multipart(ranges, boundary, file_size, self.headers["content-type"])
+        trailer = f"\n--{boundary}--\n".encode("latin-1")
+        content_length = len(trailer) + sum(len(header_generator(start, end)) + (end - start) + 1 for start, end in ranges)
+        self.headers["content-type"] = f"multipart/byteranges; boundary={boundary}"
+        self.headers["content-length"] = str(content_length)
+        await send({"type": "http.response.start", "status": 206, "headers": self.raw_headers})
+        if send_header_only:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+        async with await anyio.open_file(self.path, mode="rb") as file:
+            for start, end in ranges:
+                await send({"type": "http.response.body", "body": header_generator(start, end), "more_body": True})
+                await file.seek(start)
+                while start < end:
+                    chunk = await file.read(min(self.chunk_size, end - start))
+                    if not chunk:
+                        break
+                    start += len(chunk)
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                await send({"type": "http.response.body", "body": b"\n", "more_body": True})
+            await send({"type": "http.response.body", "body": trailer, "more_body": False})
+
+def is_not_modified(request: Request, etag: str, last_modified: float) -> bool:
+    """根据 If-None-Match / If-Modified-Since 判断客户端缓存是否仍然有效"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags or f"W/{etag}" in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(last_modified) <= since
+    return False
+
+# 边下边传：没有新数据时检查文件的间隔、等待下载开始写文件的最长时间和每次读取的大小
+STREAM_POLL_INTERVAL = get_env_float("YTDLP_STREAM_POLL_INTERVAL", 0.25, minimum=0.01)
+STREAM_START_TIMEOUT = get_env_float("YTDLP_STREAM_START_TIMEOUT", 300.0, minimum=1.0)
+STREAM_CHUNK_SIZE = 256 * 1024
+
+class StreamAborted(Exception):
+    pass
+
+def stream_source(task: Task) -> Optional[Tuple[str, str]]:
+    """
+    返回下载中的任务可以边下边传的 (临时文件, 最终文件)。
+    还没开始写文件、或需要后处理（最终文件在合并、转换后才出现）时返回 None。
+    """
+    progress = task.progress or {}
+    filename = progress.get("filename")
+    if task.status != "downloading" or not filename or progress.get("merge"):
+        return None
+    return f"{filename}.part", filename
+
+def open_stream_source(partial_path: str, final_path: str) -> Optional[BinaryIO]:
+    """打开正在写入的 .part 文件；已经重命名为最终文件时打开最终文件"""
+    for path in (partial_path, final_path):
+        try:
+            return open(path, "rb")
+        except FileNotFoundError:
+            continue
+    return None
+
+async def follow_download(handle: BinaryIO, partial_path: str, final_path: str,
+                          get_status: Callable[[], Optional[str]]) -> AsyncIterator[bytes]:
+    """
+    跟随正在写入的文件读取数据，直到 yt-dlp 把 .part 重命名为最终文件。
+    重命名不影响已打开的文件，因此重命名之后读到文件末尾即为完整内容。
+    下载失败、被取消、被删除或文件被截断（重新下载）时抛出 StreamAborted。
+    下一块数据在客户端收下上一块之后才读取，慢客户端不会让数据堆积在内存中。
+    """
+    position = 0
+    try:
+        while True:
+            chunk = await run_in_threadpool(handle.read, STREAM_CHUNK_SIZE)
+            if chunk:
+                position += len(chunk)
+                yield chunk
+                continue
+            renamed = await run_in_threadpool(lambda: not os.path.exists(partial_path) and os.path.exists(final_path))
+            if renamed:
+                while True:
+                    chunk = await run_in_threadpool(handle.read, STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        return
+                    yield chunk
+            status = get_status()
+            if status not in ("downloading", "postprocessing", "completed"):
+                raise StreamAborted(f"Download stopped: {status or 'deleted'}")
+            if os.fstat(handle.fileno()).st_size < position:
+                raise StreamAborted("Download restarted from the beginning")
+            await asyncio.sleep(STREAM_POLL_INTERVAL)
+    finally:
+        handle.close()
+
 def require_api_key(
+    connection: HTTPConnection,
     x_api_key: Optional[str] = Header(None, alias="X-API-Key"),
     authorization: Optional[str] = Header(None),
 ) -> None:
-    api_key = os.getenv("YTDLP_API_KEY")
-    if not api_key:
-        return
-    if x_api_key == api_key:
+    """
+    按 API 密钥识别租户和是否为管理员，保存在 connection.state.tenant / connection.state.admin；
+    没有配置密钥时所有请求属于 default 租户并具有管理员权限
+    """
+    if not tenants.auth_required:
+        connection.state.tenant = DEFAULT_TENANT
+        connection.state.admin = True
         return
-    if authorization and authorization.startswith("Bearer "):
-        token = authorization.split(" ", 1)[1]
-        if token == api_key:
-            return
-    raise HTTPException(status_code=401, detail="Invalid API key")
+    key = x_api_key
+    tenant = tenants.authenticate(key)
+    if tenant is None and authorization and authorization.startswith("Bearer "):
+        key = authorization.split(" ", 1)[1]
+        tenant = tenants.authenticate(key)
+    if tenant is None:
+        raise HTTPException(status_code=401, detail="Invalid API key")
+    connection.state.tenant = tenant
+    connection.state.admin = tenants.is_admin(key)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    events.bind(asyncio.get_running_loop())
+    scheduler.start()
+    postprocessor.start()
+    lag_monitor = asyncio.create_task(metrics.monitor_event_loop()) if metrics.enabled else None
+    retention_loop = asyncio.create_task(retention.run()) if retention.enabled else None
+    try:
+        yield
+    finally:
+        if lag_monitor is not None:
+            lag_monitor.cancel()
+        if retention_loop is not None:
+            retention_loop.cancel()
+        await scheduler.stop()
+        await postprocessor.stop()
+        ydl_pool.close()
+        await run_in_threadpool(tenants.sync)
+        events.bind(None)
 
 app = FastAPI(
     title="yt-dlp API",
     description="API for downloading videos using yt-dlp",
     dependencies=[Depends(require_api_key)],
+    lifespan=lifespan,
 )
 
 class DownloadRequest(BaseModel):
@@ -483,74 +4268,281 @@ class DownloadRequest(BaseModel):
     output_path: str = "./downloads"
     format: str = "bestvideo+bestaudio/best"
     quiet: bool = False
+    # 播放列表展开为子任务，而不是作为一个任务整体下载
+    playlist: bool = False
+    download_profile: Optional[DownloadProfile] = None
+    priority: PriorityLevel = "normal"
+
+# 一次批量提交最多包含的链接数
+BATCH_MAX_ITEMS = get_env_int("YTDLP_BATCH_MAX_ITEMS", 10000)
+
+class BatchDownloadRequest(BaseModel):
+    urls: List[str] = Field(..., min_length=1)
+    output_path: str = "./downloads"
+    format: str = "bestvideo+bestaudio/best"
+    quiet: bool = False
+    playlist: bool = False
+    download_profile: Optional[DownloadProfile] = None
+    priority: PriorityLevel = "normal"
+
+# SSE 连接在没有事件时发送心跳的间隔
+SSE_KEEPALIVE_SECONDS = get_env_float("YTDLP_SSE_KEEPALIVE", 15.0, minimum=1.0)
 
-async def process_download_task(task_id: str, url: str, output_path: str, format: str, quiet: bool):
+# 进度上报频率：每个任务每秒最多上报次数、按百分比触发的阈值以及平滑速度的时间窗口
+PROGRESS_MAX_RATE = get_env_float("YTDLP_PROGRESS_MAX_RATE", 2.0, minimum=0.01)
+PROGRESS_MIN_PERCENT = get_env_float("YTDLP_PROGRESS_MIN_PERCENT", 0.0)
+PROGRESS_WINDOW = get_env_float("YTDLP_PROGRESS_WINDOW", 5.0, minimum=0.1)
+
+async def process_download_task(task_id: str, url: str, output_path: str, format: str, quiet: bool, download_options: Optional[Dict[str, Any]] = None,
+                                tenant: str = DEFAULT_TENANT):
     """Asynchronously process download task"""
+    group = task_group(url)
+    # 需要 ffmpeg 后处理的任务交给后处理阶段，取消请求由后处理阶段继续处理
+    handed_off = False
     try:
         if state.is_cancel_requested(task_id):
             state.update_task(task_id, "canceled", error="Canceled by user")
             return
 
+        tracker = ProgressTracker(
+            min_interval=1.0 / PROGRESS_MAX_RATE,
+            min_percent=PROGRESS_MIN_PERCENT,
+            window=PROGRESS_WINDOW,
+        )
+        # 选定的格式需要合并、或任务有后处理预设时，最终文件在后处理之后才出现，流式接口不能边下边传
+        selected: Dict[str, Any] = {}
+
+        def on_selected(info: Dict[str, Any]) -> None:
+            selected["merge"] = bool(info.get("requested_formats") or postprocess_presets(download_options))
+            # 开始下载前检查磁盘空间；后处理会先写出完整的新文件再删除原文件，因此按两倍估算
+            estimate = estimate_download_size(info)
+            if estimate and selected["merge"]:
+                estimate *= 2
+            disk_guard.admit(task_id, output_path, estimate)
+
         def progress_hook(progress_data: Dict[str, Any]) -> None:
             status = progress_data.get("status")
             if status not in ("downloading", "finished"):
                 return
+            metrics.record_progress(task_id, group, progress_data)
+            disk_guard.record_progress(task_id, progress_data.get("filename"), progress_data.get("downloaded_bytes") or 0)
+            tenants.record_progress(task_id, tenant, progress_data.get("filename"), progress_data.get("downloaded_bytes") or 0)
             if state.is_cancel_requested(task_id):
                 raise DownloadCancelled("Canceled by user")
-            progress = build_progress_payload(progress_data)
-            state.update_task(task_id, "downloading", progress=progress)
+            progress = tracker.update(progress_data)
+            if progress is not None:
+                progress.update(selected)
+                state.update_task(task_id, "downloading", progress=progress)
 
         state.update_task(task_id, "downloading")
+        postprocess_jobs: List[Dict[str, Any]] = []
         loop = asyncio.get_event_loop()
-        with ThreadPoolExecutor() as executor:
-            result = await loop.run_in_executor(
-                executor,
-                lambda: download_video(
-                    url=url,
-                    output_path=output_path,
-                    format=format,
-                    quiet=quiet,
-                    progress_hook=progress_hook,
-                )
+        result = await loop.run_in_executor(
+            scheduler.executor,
+            lambda: download_video(
+                url=url,
+                output_path=output_path,
+                format=format,
+                quiet=quiet,
+                progress_hook=progress_hook,
+                on_ydl=lambda ydl: limiter.attach(task_id, group, ydl.params),
+                content_store=content_store,
+                task_id=task_id,
+                download_options=download_options,
+                on_selected=on_selected,
+                postprocess_jobs=postprocess_jobs,
             )
-        state.update_task(task_id, "completed", result=result)
+        )
+        limiter.record_success(group)
+        if postprocess_jobs:
+            postprocessor.submit(task_id, postprocess_jobs, result, quiet=quiet)
+            handed_off = True
+        else:
+            state.update_task(task_id, "completed", result=result)
+    except InsufficientDiskSpace as e:
+        # 空间不足时推迟任务，等待保留策略清理旧文件或其他下载结束后再试
+        progress = {"status": "waiting_for_disk", "required_bytes": e.required, "available_bytes": e.available,
+                    "retry_in": DISK_RECHECK_INTERVAL}
+        if not scheduler.defer(task_id, progress, delay=DISK_RECHECK_INTERVAL, quiet=quiet):
+            canceled = state.is_cancel_requested(task_id)
+            state.update_task(task_id, "canceled" if canceled else "failed", error="Canceled by user" if canceled else str(e))
+        retention.wake()
     except DownloadCancelled as e:
         state.update_task(task_id, "canceled", error=str(e))
     except Exception as e:
-        state.update_task(task_id, "failed", error=str(e))
+        # 暂时性错误（网络、限流）自动重试，重试时 yt-dlp 从已下载的 .part 文件继续
+        error_code = classify_error(e)
+        task = state.get_task(task_id)
+        attempts = (task.attempts if task else 0) + 1
+        if not scheduler.retry(task_id, group, e, error_code, attempts, quiet=quiet):
+            canceled = state.is_cancel_requested(task_id)
+            state.update_task(task_id, "canceled" if canceled else "failed", error="Canceled by user" if canceled else str(e),
+                              error_code=error_code, attempts=attempts)
     finally:
-        state.clear_cancel(task_id)
+        limiter.detach(task_id)
+        tenants.finish(task_id)
+        if not handed_off:
+            disk_guard.release(task_id)
+            state.clear_cancel(task_id)
 
-@app.post("/download", response_class=JSONResponse)
-async def api_download_video(request: DownloadRequest):
+async def enqueue_new_tasks(tasks: List[Task], quiet: bool) -> None:
+    """把新建的任务加入下载队列；限流分组在线程池中预先计算，大批量提交时不会阻塞事件循环"""
+    await run_in_threadpool(lambda: [task_group(task.url) for task in tasks])
+    for task in tasks:
+        scheduler.submit(task, quiet=quiet)
+
+def resolve_download_options(profile: Optional[DownloadProfile]) -> Optional[Dict[str, Any]]:
+    """解析请求中的下载配置，不合法时返回 400"""
+    try:
+        return download_profiles.resolve(profile)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def request_tenant(connection: HTTPConnection) -> str:
+    """require_api_key 识别出的调用方租户"""
+    return getattr(connection.state, "tenant", DEFAULT_TENANT)
+
+def check_daily_quota(tenant: str) -> None:
+    """租户当天流量已用完时返回 429（Retry-After 为距离配额重置的秒数）"""
+    reset_in = tenants.quota_reset_in(tenant)
+    if reset_in:
+        tenants.rejected[tenant] += 1
+        raise HTTPException(status_code=429, detail="Daily download quota exceeded", headers={"Retry-After": str(int(reset_in) + 1)})
+
+def admit_request(http_request: Request, priority: str) -> Tuple[str, int]:
     """
-    Submit a video download task and return a task ID to track progress.
+    检查提交请求的租户能否再提交任务，返回 (租户, 任务优先级)。
+    优先级超过租户允许的上限时返回 403，当天流量已用完时返回 429。
+    """
+    tenant = request_tenant(http_request)
+    max_priority = tenants.config(tenant)["max_priority"]
+    if PRIORITY_LEVELS[priority] > PRIORITY_LEVELS[max_priority]:
+        raise HTTPException(status_code=403, detail=f"Priority {priority} is not allowed for this API key (max {max_priority})")
+    check_daily_quota(tenant)
+    return tenant, PRIORITY_LEVELS[priority]
+
+def request_is_admin(connection: HTTPConnection) -> bool:
+    return getattr(connection.state, "admin", False)
+
+def can_access(connection: HTTPConnection, task: Task) -> bool:
+    """调用方是否可以查看和管理任务：任务属于调用方租户，或调用方是管理员"""
+    return request_is_admin(connection) or (task.tenant or DEFAULT_TENANT) == request_tenant(connection)
+
+async def get_owned_task(http_request: HTTPConnection, task_id: str) -> Task:
+    """返回调用方可以访问的任务；其他租户的任务与不存在的任务一样返回 404"""
+    task = await run_in_threadpool(state.get_task, task_id)
+    if not task or not can_access(http_request, task):
+        raise HTTPException(status_code=404, detail=f"Task with ID {task_id} not found")
+    return task
+
+async def submit_download(http_request: Optional[Request], url: str, output_path: str, format: str, quiet: bool, playlist: bool,
+                          download_options: Optional[Dict[str, Any]] = None, tenant: str = DEFAULT_TENANT, priority: int = 0) -> Dict[str, Any]:
+    """
+    提交单个链接；playlist 为 True 且链接是播放列表时展开为父任务和子任务。
+    已存在的相同任务保留其原来的下载参数、优先级和租户。
     """
-    # 如果有相同的url和output_path的任务已经存在，直接返回该任务
-    existing_task = next((task for task in state.tasks.values() if task.format == request.format and task.url == request.url and task.output_path == request.output_path), None)
+    if playlist:
+        existing = await run_in_threadpool(state.find_playlist, url, output_path, format, tenant)
+        if existing:
+            return {"task_id": existing.id, "created": False}
+        entries = await run_extraction(http_request, lambda: get_playlist_entries(url))
+        if entries is not None:
+            parent_id, children = await run_in_threadpool(
+                lambda: state.add_playlist(url, output_path, format, entries, priority, download_options=download_options, tenant=tenant)
+            )
+            await enqueue_new_tasks([task for _, task in children if task is not None], quiet)
+            return {"task_id": parent_id, "created": bool(children), "entries": len(entries)}
+
+    # 如果同一租户相同的url、output_path和format的任务已经存在，直接返回该任务
+    existing_task = await run_in_threadpool(state.find_duplicate, url, output_path, format, tenant)
     if existing_task:
-        return {"status": "success", "task_id": existing_task.id}
-    task_id = state.add_task(request.url, request.output_path, request.format)
+        return {"task_id": existing_task.id, "created": False}
+    # 并发提交相同任务时由数据库唯一索引去重，返回先创建的任务
+    task_id = await run_in_threadpool(
+        lambda: state.add_task(url, output_path, format, priority, download_options=download_options, tenant=tenant)
+    )
+    task = await run_in_threadpool(state.get_task, task_id)
     
-    # Asynchronously execute download task
-    asyncio.create_task(process_download_task(
-        task_id=task_id,
-        url=request.url,
-        output_path=request.output_path,
-        format=request.format,
-        quiet=request.quiet
-    ))
+    # 加入下载队列，由调度器按并发上限依次执行
+    if task and task.status == "pending" and not scheduler.is_queued(task_id):
+        scheduler.submit(task, quiet=quiet)
     
-    return {"status": "success", "task_id": task_id}
+    return {"task_id": task_id, "created": True}
+
+@app.post("/download", response_class=JSONResponse)
+async def api_download_video(request: DownloadRequest, http_request: Request):
+    """
+    Submit a video download task and return a task ID to track progress.
+    With playlist=true a playlist is expanded into one child task per entry and
+    the returned task ID is the parent task.
+    """
+    tenant, priority = admit_request(http_request, request.priority)
+    download_options = resolve_download_options(request.download_profile)
+    try:
+        submitted = await submit_download(http_request, request.url, request.output_path, request.format, request.quiet, request.playlist, download_options,
+                                          tenant=tenant, priority=priority)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return {"status": "success", "task_id": submitted["task_id"]}
+
+@app.post("/download/batch", response_class=JSONResponse)
+async def api_download_batch(request: BatchDownloadRequest, http_request: Request):
+    """
+    Submit many URLs in one request. Tasks are created in a single transaction;
+    URLs that already have a task return the existing task ID.
+    With playlist=true each playlist URL is expanded into child tasks.
+    """
+    if len(request.urls) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Too many URLs in one batch (max {BATCH_MAX_ITEMS})")
+
+    tenant, priority = admit_request(http_request, request.priority)
+    download_options = resolve_download_options(request.download_profile)
+    items: List[Dict[str, Any]] = []
+    if not request.playlist:
+        results = await run_in_threadpool(
+            lambda: state.add_tasks(request.urls, request.output_path, request.format, priority, download_options=download_options, tenant=tenant)
+        )
+        await enqueue_new_tasks([task for _, task in results if task is not None], request.quiet)
+        items = [
+            {"url": url, "task_id": task_id, "created": task is not None}
+            for url, (task_id, task) in zip(request.urls, results)
+        ]
+    else:
+        # 同时展开的链接数不超过提取线程池的大小，排在后面的链接不会在线程池队列中等到超时
+        expanding = asyncio.Semaphore(extraction_pool.max_workers)
+
+        async def submit(url: str) -> Dict[str, Any]:
+            async with expanding:
+                return await submit_download(http_request, url, request.output_path, request.format, request.quiet, True, download_options,
+                                             tenant=tenant, priority=priority)
+
+        submitted = await asyncio.gather(*(submit(url) for url in request.urls), return_exceptions=True)
+        for url, result in zip(request.urls, submitted):
+            if isinstance(result, HTTPException):
+                items.append({"url": url, "error": result.detail})
+            elif isinstance(result, Exception):
+                items.append({"url": url, "error": str(result)})
+            else:
+                items.append({"url": url, **result})
+
+    return {
+        "status": "success",
+        "data": {
+            "tasks": items,
+            "created": sum(1 for item in items if item.get("created")),
+            "existing": sum(1 for item in items if item.get("created") is False),
+            "failed": sum(1 for item in items if "error" in item),
+        },
+    }
 
 @app.get("/task/{task_id}", response_class=JSONResponse)
-async def get_task_status(task_id: str):
+async def get_task_status(task_id: str, http_request: Request):
     """
     Get the status of a specific download task.
     """
-    task = state.get_task(task_id)
-    if not task:
-        raise HTTPException(status_code=404, detail=f"Task with ID {task_id} not found")
+    task = await get_owned_task(http_request, task_id)
     
     response = {
         "status": "success",
@@ -561,70 +4553,229 @@ async def get_task_status(task_id: str):
             "progress": task.progress
         }
     }
+    if task.parent_id:
+        response["data"]["parent_id"] = task.parent_id
+    if task.tenant:
+        response["data"]["tenant"] = task.tenant
+    if task.download_options:
+        response["data"]["download_options"] = task.download_options
+    if task.kind == "playlist":
+        # 播放列表的进度由子任务实时汇总，子任务列表通过 /tasks?parent_id= 查询
+        response["data"]["kind"] = task.kind
+        response["data"]["progress"] = await run_in_threadpool(state.playlist_progress, task.id)
+        if task.status in ("failed", "canceled") and task.error:
+            response["data"]["error"] = task.error
+        return response
     
-    if task.status == "completed" and task.result:
+    if task.status == "completed" and await run_in_threadpool(state.load_result, task):
         response["data"]["result"] = task.result
     elif task.status in ("failed", "canceled") and task.error:
         response["data"]["error"] = task.error
+    if task.attempts:
+        response["data"]["attempts"] = task.attempts
+    if task.error_code and task.status != "completed":
+        response["data"]["error_code"] = task.error_code
     
     return response
 
+def format_sse(event: Dict[str, Any]) -> str:
+    return f"event: task\ndata: {json.dumps(event)}\n\n"
+
+@app.get("/task/{task_id}/events")
+async def stream_task_events(task_id: str, http_request: Request):
+    """
+    Stream progress and status changes of a task as Server-Sent Events.
+    The stream ends once the task reaches a terminal status or is deleted.
+    """
+    task = await get_owned_task(http_request, task_id)
+
+    subscription = events.subscribe({task_id})
+    snapshot = task_event(task)
+
+    async def event_stream():
+        try:
+            yield format_sse(snapshot)
+            if snapshot["status"] in TERMINAL_STATUSES:
+                return
+            while True:
+                pending = await subscription.get(timeout=SSE_KEEPALIVE_SECONDS)
+                if not pending:
+                    yield ": keepalive\n\n"
+                    continue
+                for event in pending:
+                    yield format_sse(event)
+                    if event["status"] in TERMINAL_STATUSES or event["status"] == "deleted":
+                        return
+        finally:
+            events.unsubscribe(subscription)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.websocket("/events")
+async def websocket_task_events(websocket: WebSocket, task_ids: Optional[str] = Query(None)):
+    """
+    Multiplexed task event stream over WebSocket.
+
+    Without task_ids all tasks of the caller's tenant (all tenants for an admin key) are streamed.
+    Clients can change the set at runtime by sending {"subscribe": [...]} / {"unsubscribe": [...]};
+    {"subscribe": null} streams all tasks.
+    """
+    await websocket.accept()
+    initial = {task_id for task_id in task_ids.split(",") if task_id} if task_ids else None
+    subscription = events.subscribe(initial, tenant=None if request_is_admin(websocket) else request_tenant(websocket))
+
+    async def offer_snapshot(task_id: str) -> None:
+        task = await run_in_threadpool(state.get_task, task_id)
+        if task and can_access(websocket, task):
+            subscription.offer(task_event(task))
+
+    def is_id_list(value: Any) -> bool:
+        return isinstance(value, list) and all(isinstance(item, str) for item in value)
+
+    async def receive_commands() -> None:
+        while True:
+            text = await websocket.receive_text()
+            try:
+                message = json.loads(text)
+            except ValueError:
+                message = None
+            # 格式错误的命令只回复错误消息，不影响已有的订阅和连接
+            if not isinstance(message, dict):
+                await websocket.send_json({"type": "error", "detail": "Commands must be JSON objects"})
+                continue
+            ids = message.get("subscribe")
+            removed = message.get("unsubscribe")
+            if (ids is not None and not is_id_list(ids)) or (removed is not None and not is_id_list(removed)):
+                await websocket.send_json({"type": "error", "detail": "subscribe and unsubscribe must be lists of task IDs"})
+                continue
+            if "subscribe" in message:
+                if ids is None:
+                    subscription.task_ids = None
+                else:
+                    subscription.task_ids = (subscription.task_ids or set()) | set(ids)
+                    for task_id in ids:
+                        await offer_snapshot(task_id)
+            if removed and subscription.task_ids is not None:
+                subscription.task_ids -= set(removed)
+
+    async def send_events() -> None:
+        if initial:
+            for task_id in initial:
+                await offer_snapshot(task_id)
+        while True:
+            pending = await subscription.get()
+            # 等待发送完成后才取下一批，慢客户端期间的事件在缓冲区中按任务合并
+            await websocket.send_json({"type": "tasks", "data": pending, "dropped": subscription.dropped})
+
+    try:
+        async with anyio.create_task_group() as task_group:
+            task_group.start_soon(send_events)
+            try:
+                await receive_commands()
+            except WebSocketDisconnect:
+                pass
+            # 客户端断开后停止发送
+            task_group.cancel_scope.cancel()
+    finally:
+        events.unsubscribe(subscription)
+
 @app.post("/task/{task_id}/stop", response_class=JSONResponse)
-async def stop_task(task_id: str):
+async def stop_task(task_id: str, http_request: Request):
     """
     Request to stop a running download task.
     """
-    task = state.get_task(task_id)
-    if not task:
-        raise HTTPException(status_code=404, detail=f"Task with ID {task_id} not found")
+    task = await get_owned_task(http_request, task_id)
 
-    if not state.request_cancel(task_id):
-        return {"status": "success", "data": {"id": task.id, "status": task.status}}
+    if task.kind == "playlist":
+        # 取消播放列表的所有子任务
+        for child_id in await run_in_threadpool(state.cancel_children, task_id):
+            scheduler.remove(child_id)
+        task = await run_in_threadpool(state.get_task, task_id)
+        return {"status": "success", "data": {"id": task_id, "status": task.status if task else "canceled"}}
 
-    state.update_task(task_id, "canceling")
-    return {"status": "success", "data": {"id": task.id, "status": "canceling"}}
+    # 尚未开始的任务直接取消，不需要等待工作线程；运行中的任务（可能在其他进程中）置为 canceling
+    scheduler.remove(task_id)
+    status = await run_in_threadpool(state.cancel_task, task_id) or task.status
+    return {"status": "success", "data": {"id": task.id, "status": status}}
 
 @app.post("/task/{task_id}/restart", response_class=JSONResponse)
-async def restart_task(task_id: str, quiet: bool = False):
+async def restart_task(task_id: str, http_request: Request, quiet: bool = False):
     """
     Restart a finished/failed/canceled download task.
     """
-    task = state.get_task(task_id)
-    if not task:
-        raise HTTPException(status_code=404, detail=f"Task with ID {task_id} not found")
-    if task.status in ("pending", "downloading", "canceling"):
+    task = await get_owned_task(http_request, task_id)
+    if task.status in ("pending", *RUNNING_STATUSES):
         raise HTTPException(status_code=400, detail=f"Task is running. Stop it before restarting. Current status: {task.status}")
+    # 重新开始的任务与新提交的任务一样受每日配额限制
+    check_daily_quota(request_tenant(http_request))
 
-    restarted = state.restart_task(task_id)
+    if task.kind == "playlist":
+        # 重新下载失败或已取消的子任务，已完成的子任务保持不变
+        def restart_children() -> Tuple[List[Task], Optional[Task]]:
+            children = []
+            for child_id in state.child_ids(task_id, ("failed", "canceled")):
+                child = state.restart_task(child_id)
+                served_files.invalidate(child_id)
+                if child:
+                    children.append(child)
+            state.refresh_parent(task_id)
+            return children, state.get_task(task_id)
+
+        children, task = await run_in_threadpool(restart_children)
+        for child in children:
+            scheduler.submit(child, quiet=quiet)
+        return {"status": "success", "data": {"id": task_id, "status": task.status if task else "pending"}}
+
+    restarted = await run_in_threadpool(state.restart_task, task_id)
+    served_files.invalidate(task_id)
     if not restarted:
         raise HTTPException(status_code=404, detail=f"Task with ID {task_id} not found")
 
-    asyncio.create_task(process_download_task(
-        task_id=task_id,
-        url=restarted.url,
-        output_path=restarted.output_path,
-        format=restarted.format,
-        quiet=quiet
-    ))
+    scheduler.submit(restarted, quiet=quiet)
 
     return {"status": "success", "data": {"id": task.id, "status": "pending"}}
 
-@app.delete("/task/{task_id}", response_class=JSONResponse)
-async def delete_task(task_id: str):
+def discard_task(task: Task, dequeued: bool = False) -> Tuple[bool, int, bool]:
     """
-    Delete a task record. If task is running, request cancellation.
+    请求取消仍在运行的任务，删除其文件和记录；返回 (是否请求了取消, 删除的文件数, 记录是否已删除)。
+    dequeued 表示调用方已经在事件循环中把任务移出了等待队列。
     """
-    task = state.get_task(task_id)
-    if not task:
-        raise HTTPException(status_code=404, detail=f"Task with ID {task_id} not found")
-
     cancel_requested = False
-    if task.status in ("pending", "downloading", "canceling"):
-        cancel_requested = state.request_cancel(task_id)
+    if dequeued or scheduler.remove(task.id):
+        cancel_requested = True
+    elif task.status in ("pending", *RUNNING_STATUSES):
+        cancel_requested = state.request_cancel(task.id)
 
     deleted_files = delete_task_files(task)
-    if not state.delete_task(task_id):
-        raise HTTPException(status_code=404, detail=f"Task with ID {task_id} not found")
+    served_files.invalidate(task.id)
+    return cancel_requested, deleted_files, state.delete_task(task.id)
+
+@app.delete("/task/{task_id}", response_class=JSONResponse)
+async def delete_task(task_id: str, http_request: Request):
+    """
+    Delete a task record. If task is running, request cancellation.
+    Deleting a playlist deletes all of its child tasks.
+    """
+    task = await get_owned_task(http_request, task_id)
+
+    if task.kind == "playlist":
+        children = await run_in_threadpool(lambda: [child for child in map(state.get_task, state.child_ids(task_id)) if child])
+        dequeued = {child.id: scheduler.remove(child.id) for child in children}
+        results = await run_in_threadpool(lambda: [discard_task(child, dequeued[child.id]) for child in children])
+        cancel_requested = any(requested for requested, _, _ in results)
+        deleted_files = sum(count for _, count, _ in results)
+        if not await run_in_threadpool(state.delete_task, task_id):
+            raise HTTPException(status_code=404, detail=f"Task with ID {task_id} not found")
+    else:
+        cancel_requested, deleted_files, deleted = await run_in_threadpool(discard_task, task, scheduler.remove(task.id))
+        if not deleted:
+            raise HTTPException(status_code=404, detail=f"Task with ID {task_id} not found")
+        if task.parent_id:
+            await run_in_threadpool(state.refresh_parent, task.parent_id)
 
     return {
         "status": "success",
@@ -635,82 +4786,399 @@ async def delete_task(task_id: str):
         },
     }
 
-@app.get("/tasks", response_class=JSONResponse)
-async def list_all_tasks():
+def encode_cursor(position: Tuple[str, str]) -> str:
+    return base64.urlsafe_b64encode(json.dumps(list(position)).encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor: str) -> Tuple[str, str]:
+    try:
+        created_at, task_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return str(created_at), str(task_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+@app.get("/tasks")
+async def list_all_tasks(
+    http_request: Request,
+    limit: int = Query(100, ge=1, le=1000, description="Page size (JSON mode)"),
+    cursor: Optional[str] = Query(None, description="next_cursor returned by the previous page"),
+    status: Optional[List[str]] = Query(None, description="Filter by status, repeatable or comma separated"),
+    since: Optional[str] = Query(None, description="Only tasks created at or after this ISO timestamp"),
+    until: Optional[str] = Query(None, description="Only tasks created before this ISO timestamp"),
+    url_prefix: Optional[str] = Query(None, description="Only tasks whose URL starts with this prefix"),
+    parent_id: Optional[str] = Query(None, description="Only child tasks of this playlist task"),
+    tenant: Optional[str] = Query(None, description="Only tasks submitted by this tenant (admin keys only; defaults to the caller's tenant)"),
+    fields: Optional[str] = Query(None, description="Comma separated fields to return; result is excluded by default"),
+    order: str = Query("desc", pattern="^(asc|desc)$", description="Sort by creation time"),
+    format: str = Query("json", pattern="^(json|ndjson)$", description="json (paginated) or ndjson (streams all matches)"),
+):
+    """
+    List download tasks with cursor pagination, filters and field projection.
+    Only the caller's tenant's tasks are listed unless an admin key is used.
+    """
+    if not request_is_admin(http_request):
+        caller = request_tenant(http_request)
+        if tenant is not None and tenant != caller:
+            raise HTTPException(status_code=403, detail="Listing tasks of another tenant requires an admin API key")
+        tenant = caller
+    if fields:
+        selected = [field.strip() for field in fields.split(",") if field.strip()]
+        unknown = [field for field in selected if field not in TASK_FIELD_COLUMNS]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    else:
+        selected = DEFAULT_TASK_FIELDS
+    statuses = [item for value in status or [] for item in value.split(",") if item] or None
+    query = dict(
+        fields=selected,
+        statuses=statuses,
+        since=since,
+        until=until,
+        url_prefix=url_prefix,
+        parent_id=parent_id,
+        tenant=tenant,
+        cursor=decode_cursor(cursor) if cursor else None,
+        descending=order == "desc",
+    )
+
+    if format == "ndjson":
+        def ndjson_lines():
+            for _, item in state.store.iter_tasks(**query):
+                yield json.dumps(item) + "\n"
+
+        # 同步生成器由 Starlette 在线程池中迭代，不会阻塞事件循环
+        return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson")
+
+    def read_page() -> Dict[str, Any]:
+        page = list(state.store.iter_tasks(limit=limit + 1, **query))
+        next_cursor = encode_cursor(page[limit - 1][0]) if len(page) > limit else None
+        return {"status": "success", "data": [item for _, item in page[:limit]], "next_cursor": next_cursor}
+
+    return JSONResponse(await run_in_threadpool(read_page))
+
+@app.get("/queue", response_class=JSONResponse)
+async def get_queue(
+    http_request: Request,
+    task_id: Optional[str] = Query(None, description="Only return the queue position of this task"),
+    limit: int = Query(100, ge=0, le=1000, description="Maximum number of queued tasks to return"),
+):
+    """
+    Show download queue depth, worker pool, per-tenant and post-processing metrics and queue positions.
+    Only the caller's tenant and its queued tasks are listed unless an admin key is used;
+    positions are counted over the whole queue.
+    """
+    tenant = None if request_is_admin(http_request) else request_tenant(http_request)
+    snapshot = tenants.snapshot(scheduler.queued_by_tenant(), scheduler.active_by_tenant())
+    data: Dict[str, Any] = {
+        "pool": scheduler.metrics(),
+        "postprocess": postprocessor.metrics(),
+        "tenants": snapshot if tenant is None else {tenant: snapshot[tenant]},
+    }
+    if task_id is not None:
+        task = await get_owned_task(http_request, task_id)
+        data["task"] = {
+            "id": task_id,
+            "status": task.status,
+            "position": scheduler.position(task_id),
+        }
+    else:
+        queued = scheduler.queue_positions(tenant)
+        data["depth"] = len(queued)
+        data["tasks"] = [
+            {"id": queued_id, "position": position}
+            for queued_id, position in queued[:limit]
+        ]
+    return {"status": "success", "data": data}
+
+@app.get("/limits", response_class=JSONResponse)
+async def get_limits():
+    """
+    Show per-group (extractor or domain) download limits, usage and backoff state.
+    """
+    return {"status": "success", "data": limiter.snapshot(scheduler.queued_by_group())}
+
+@app.put("/limits", response_class=JSONResponse)
+async def update_limits(update: LimitsUpdate, http_request: Request):
+    """
+    Change download limits at runtime. Omitted fields keep their current value;
+    a group set to null falls back to the default limits. Requires an admin key.
+    """
+    if not request_is_admin(http_request):
+        raise HTTPException(status_code=403, detail="Changing limits requires an admin API key")
+    limiter.configure(update)
+    # 限制放宽后排队中的任务可能可以开始了
+    scheduler.wake()
+    return {"status": "success", "data": limiter.snapshot(scheduler.queued_by_group())}
+
+@app.get("/profiles", response_class=JSONResponse)
+async def get_download_profiles():
+    """
+    Show the server-side download profiles, the upper bounds for per-task
+    overrides and the allowed external downloaders.
+    """
+    return {"status": "success", "data": download_profiles.snapshot()}
+
+@app.get("/stats", response_class=JSONResponse)
+async def get_stats():
+    """
+    Internal statistics of the service caches and storage.
+    """
+    return {
+        "status": "success",
+        "data": {
+            "info_cache": info_cache.metrics(),
+            "extractor": extraction_pool.metrics(),
+            "task_store": dict(state.store.stats),
+            "content_store": content_store.metrics() if content_store is not None else None,
+            "disk": disk_guard.metrics(),
+            "retention": retention.metrics(),
+            "retry": retry_policy.snapshot(),
+            "ydl_pool": ydl_pool.metrics(),
+        },
+    }
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def format_prometheus_labels(labels: Dict[str, Any]) -> str:
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{key}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+def format_prometheus_value(value: float) -> str:
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+class PrometheusText:
+    """按 Prometheus 文本格式（0.0.4）拼接指标"""
+
+    def __init__(self):
+        self.lines: List[str] = []
+
+    def add(self, name: str, kind: str, help_text: str, samples: List[Tuple[Dict[str, Any], Optional[float]]]) -> None:
+        self.lines.append(f"# HELP {name} {help_text}")
+        self.lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            if value is not None:
+                self.lines.append(f"{name}{format_prometheus_labels(labels)} {format_prometheus_value(value)}")
+
+    def add_histogram(self, name: str, help_text: str, histograms: List[Tuple[Dict[str, Any], LatencyHistogram]]) -> None:
+        self.lines.append(f"# HELP {name} {help_text}")
+        self.lines.append(f"# TYPE {name} histogram")
+        for labels, histogram in histograms:
+            snapshot = histogram.snapshot()
+            for bound, count in snapshot["buckets"].items():
+                self.lines.append(f"{name}_bucket{format_prometheus_labels(dict(labels, le=bound))} {count}")
+            self.lines.append(f"{name}_sum{format_prometheus_labels(labels)} {format_prometheus_value(snapshot['sum'])}")
+            self.lines.append(f"{name}_count{format_prometheus_labels(labels)} {snapshot['count']}")
+
+    def render(self) -> str:
+        return "\n".join(self.lines) + "\n"
+
+def render_metrics() -> str:
+    """从各组件的统计生成 /metrics 的内容"""
+    out = PrometheusText()
+    pool = scheduler.metrics()
+    groups = limiter.snapshot(scheduler.queued_by_group())["groups"]
+    out.add("ytdlp_queue_depth", "gauge", "Tasks waiting in the download queue.", [({}, pool["queued"])])
+    out.add("ytdlp_queued_tasks", "gauge", "Queued tasks per limit group.",
+            [({"group": name}, group["queued"]) for name, group in groups.items()])
+    out.add("ytdlp_active_downloads", "gauge", "Downloads currently running.", [({}, pool["active"])])
+    out.add("ytdlp_group_active_downloads", "gauge", "Running downloads per limit group.",
+            [({"group": name}, group["active"]) for name, group in groups.items()])
+    out.add("ytdlp_max_concurrent_downloads", "gauge", "Size of the download worker pool.", [({}, pool["max_workers"])])
+    out.add("ytdlp_tasks_submitted_total", "counter", "Tasks added to the download queue.", [({}, pool["submitted"])])
+    out.add("ytdlp_tasks_finished_total", "counter", "Tasks that finished, by final status.",
+            [({"status": status}, pool[status]) for status in ("completed", "failed", "canceled")])
+    out.add("ytdlp_task_retries_total", "counter", "Failed downloads re-queued automatically, by error class.",
+            [({"error_code": code}, count) for code, count in sorted(pool["retries_by_error"].items())])
+    tenant_usage = tenants.snapshot(scheduler.queued_by_tenant(), scheduler.active_by_tenant())
+    out.add("ytdlp_tenant_queued_tasks", "gauge", "Queued tasks per tenant.",
+            [({"tenant": name}, tenant["queued"]) for name, tenant in tenant_usage.items()])
+    out.add("ytdlp_tenant_active_downloads", "gauge", "Running downloads per tenant.",
+            [({"tenant": name}, tenant["active"]) for name, tenant in tenant_usage.items()])
+    out.add("ytdlp_tenant_downloaded_bytes_today", "gauge", "Bytes downloaded by the tenant in the current UTC day.",
+            [({"tenant": name}, tenant["bytes_today"]) for name, tenant in tenant_usage.items()])
+    out.add("ytdlp_tenant_rejected_total", "counter", "Submissions rejected because the tenant's daily quota was used up.",
+            [({"tenant": name}, tenant["rejected"]) for name, tenant in tenant_usage.items()])
+    out.add("ytdlp_group_throttled_total", "counter", "Downloads that hit HTTP 429/403, per limit group.",
+            [({"group": name}, group["throttled"]) for name, group in groups.items()])
+    out.add("ytdlp_downloaded_bytes_total", "counter", "Bytes downloaded, per limit group (extractor).",
+            [({"group": group}, count) for group, count in sorted(metrics.downloaded_bytes.items())])
+    out.add("ytdlp_download_speed_bytes", "gauge", "Current download speed in bytes/s, per limit group (extractor).",
+            [({"group": group}, speed) for group, speed in sorted(metrics.download_speeds().items())])
+    out.add_histogram("ytdlp_task_duration_seconds", "Download run time by final task status.",
+                      [({"status": status}, histogram) for status, histogram in sorted(metrics.task_seconds.items())])
+    postprocess = postprocessor.metrics()
+    out.add("ytdlp_postprocess_queue_depth", "gauge", "Downloaded tasks waiting for post-processing.", [({}, postprocess["queued"])])
+    out.add("ytdlp_active_postprocessing", "gauge", "Post-processing jobs currently running.", [({}, postprocess["active"])])
+    out.add("ytdlp_max_concurrent_postprocessing", "gauge", "Size of the post-processing pool.", [({}, postprocess["max_workers"])])
+    out.add_histogram("ytdlp_postprocess_duration_seconds", "Post-processing run time by final task status.",
+                      [({"status": status}, histogram) for status, histogram in sorted(metrics.postprocess_seconds.items())])
+    disk = disk_guard.metrics()
+    out.add("ytdlp_disk_reserved_bytes", "gauge", "Disk space reserved for running downloads and not yet written.",
+            [({}, disk["reserved_bytes"])])
+    out.add("ytdlp_disk_deferred_total", "counter", "Downloads deferred because the volume was short on space.", [({}, disk["deferred"])])
+    out.add("ytdlp_retention_evicted_tasks_total", "counter", "Completed tasks removed by the retention policies.",
+            [({}, retention.stats["evicted_tasks"])])
+    out.add("ytdlp_retention_evicted_bytes_total", "counter", "Bytes freed by the retention policies.",
+            [({}, retention.stats["evicted_bytes"])])
+    out.add_histogram("ytdlp_extraction_duration_seconds", "Time spent in get_video_info.",
+                      [({}, metrics.extraction_seconds)])
+    out.add_histogram("ytdlp_extraction_queue_wait_seconds", "Time /info and /formats requests wait for an extraction worker.",
+                      [({}, extraction_pool.queue_wait)])
+    out.add_histogram("ytdlp_sqlite_write_duration_seconds", "Duration of batched task writes to SQLite.",
+                      [({}, state.store.write_seconds)])
+    out.add("ytdlp_task_saves_total", "counter", "Task state changes recorded.", [({}, state.store.stats["saves"])])
+    out.add("ytdlp_sqlite_rows_written_total", "counter", "Task rows written to SQLite.", [({}, state.store.stats["row_writes"])])
+    out.add("ytdlp_sqlite_flushes_total", "counter", "Batched SQLite write transactions.", [({}, state.store.stats["flushes"])])
+
+    info = info_cache.metrics()
+    caches = [("info", info["hits"] + info["persistent_hits"] + info["coalesced"], info["misses"])]
+    if content_store is not None:
+        caches.append(("content", content_store.stats["hits"], content_store.stats["misses"]))
+    out.add("ytdlp_cache_hits_total", "counter", "Cache lookups served from the cache.", [({"cache": name}, hits) for name, hits, _ in caches])
+    out.add("ytdlp_cache_misses_total", "counter", "Cache lookups that missed.", [({"cache": name}, misses) for name, _, misses in caches])
+    out.add("ytdlp_cache_hit_ratio", "gauge", "Share of cache lookups served from the cache.",
+            [({"cache": name}, hits / (hits + misses) if hits + misses else None) for name, hits, misses in caches])
+    out.add_histogram("ytdlp_event_loop_lag_seconds", "Delay of the event loop in waking up a sleeping task.",
+                      [({}, metrics.event_loop_lag)])
+    return out.render()
+
+@app.get("/metrics")
+async def get_metrics():
     """
-    List all download tasks and their status.
+    Service metrics in the Prometheus text format.
     """
-    tasks = state.list_tasks()
-    return {"status": "success", "data": tasks}
+    if not metrics.enabled:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    return Response(content=render_metrics(), media_type=PROMETHEUS_CONTENT_TYPE)
 
 @app.get("/info", response_class=JSONResponse)
-async def api_get_video_info(url: str = Query(..., description="The URL of the video")):
+async def api_get_video_info(request: Request, url: str = Query(..., description="The URL of the video")):
     """
     Get information about a video without downloading it.
     """
     try:
-        result = get_video_info(url)
+        result = await fetch_video_info(request, url)
         return {"status": "success", "data": result}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/formats", response_class=JSONResponse)
-async def api_list_formats(url: str = Query(..., description="The URL of the video")):
+async def api_list_formats(request: Request, url: str = Query(..., description="The URL of the video")):
     """
     List all available formats for a video.
     """
     try:
-        result = list_available_formats(url)
+        info = await fetch_video_info(request, url)
+        result = info.get('formats', []) if info else []
         return {"status": "success", "data": result}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/download/{task_id}/file", response_class=FileResponse)
-async def download_completed_video(task_id: str):
+@app.api_route("/download/{task_id}/file", methods=["GET", "HEAD"], response_class=FileResponse)
+async def download_completed_video(
+    task_id: str,
+    request: Request,
+    disposition: str = Query("attachment", pattern="^(attachment|inline)$", description="Content-Disposition type"),
+):
     """
     返回已完成下载任务的视频文件。
+    支持 HEAD、Range（单段与多段）以及 ETag/Last-Modified 条件请求。
     如果任务未完成或未找到，将返回相应的错误。
     """
-    task = state.get_task(task_id)
-    if not task:
-        raise HTTPException(status_code=404, detail=f"Task with ID {task_id} not found")
+    task = await get_owned_task(request, task_id)
     
     if task.status != "completed":
         raise HTTPException(status_code=400, detail=f"Task is not completed yet. Current status: {task.status}")
     
-    if not task.result:
+    if not await run_in_threadpool(state.load_result, task):
         raise HTTPException(status_code=500, detail="Task completed but no result information available")
     
-    # 获取文件路径
     try:
-        # 从结果中提取文件名和路径 tast.result.requested_downloads[0].filename
-        filename = task.result.get("requested_downloads", [{}])[0].get("filename")
-        if not filename:
-            requested_filename = task.result.get("requested_filename")
-            if requested_filename:
-                filename = requested_filename
-            else:
-                # 尝试构建可能的文件路径
-                title = task.result.get("title", "video")
-                ext = task.result.get("ext", "mp4")
-                filename = os.path.join(task.output_path, f"{title}.{ext}")
-        
-        # 检查文件是否存在
-        if not os.path.exists(filename):
-            raise HTTPException(status_code=404, detail="Video file not found on server")
-        
-        # 提取实际文件名用于Content-Disposition头
-        file_basename = os.path.basename(filename)
-        
-        # 返回文件
-        return FileResponse(
-            path=filename,
-            filename=file_basename,
-            media_type="application/octet-stream"
-        )
-    
+        served = await run_in_threadpool(served_files.get, task)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error accessing video file: {str(e)}")
+    if served is None:
+        raise HTTPException(status_code=404, detail="Video file not found on server")
+    retention.touch(task_id)
+    
+    response = MediaFileResponse(
+        path=served.path,
+        filename=os.path.basename(served.path),
+        media_type=served.media_type,
+        stat_result=served.stat_result,
+        content_disposition_type=disposition,
+    )
+    if is_not_modified(request, response.headers["etag"], served.stat_result.st_mtime):
+        headers = {key: response.headers[key] for key in ("etag", "last-modified")}
+        return Response(status_code=304, headers=headers)
+    return response
+
+@app.get("/download/{task_id}/stream")
+async def stream_task_file(
+    task_id: str,
+    request: Request,
+    disposition: str = Query("attachment", pattern="^(attachment|inline)$", description="Content-Disposition type"),
+):
+    """
+    边下边传：在下载进行中返回已经写入的数据，并跟随文件增长直到下载完成。
+    已完成的任务等同于 /download/{task_id}/file；需要合并多个格式或有后处理预设的任务等待后处理完成后再返回。
+    """
+    task = await get_owned_task(request, task_id)
+    if task.kind == "playlist":
+        raise HTTPException(status_code=400, detail="Playlist tasks have no single file to stream")
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + STREAM_START_TIMEOUT
+    subscription = events.subscribe({task_id})
+    try:
+        while True:
+            task = await run_in_threadpool(state.get_task, task_id)
+            if not task:
+                raise HTTPException(status_code=404, detail=f"Task with ID {task_id} not found")
+            if task.status == "completed":
+                return await download_completed_video(task_id, request, disposition)
+            if task.status in ("failed", "canceled"):
+                raise HTTPException(status_code=409, detail=f"Task {task.status}: {task.error}")
+            source = stream_source(task)
+            handle = await run_in_threadpool(open_stream_source, *source) if source else None
+            if handle is not None:
+                break
+            timeout = STREAM_POLL_INTERVAL * 4
+            # 只限制任务排队的时间；已经开始的下载（包括要等后处理完成的合并格式）一直等到结束
+            if task.status == "pending":
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise HTTPException(status_code=504, detail="Download did not start in time")
+                timeout = min(remaining, timeout)
+            # 进度更新或状态变化时立即重新检查；文件可能在两次进度更新之间才创建，因此同时定期轮询
+            await subscription.get(timeout=timeout)
+    finally:
+        events.unsubscribe(subscription)
+
+    partial_path, final_path = source
+
+    def get_status() -> Optional[str]:
+        current = state.get_task(task_id)
+        return current.status if current else None
+
+    filename = os.path.basename(final_path)
+    return StreamingResponse(
+        follow_download(handle, partial_path, final_path, get_status),
+        media_type=mimetypes.guess_type(final_path)[0] or "application/octet-stream",
+        headers={
+            "Content-Disposition": f"{disposition}; filename*=utf-8''{urllib.parse.quote(filename)}",
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        },
+    )
 
 def start_api():
     uvicorn.run(app, host="0.0.0.0", port=8000)
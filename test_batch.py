@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试批量提交和播放列表展开：批量去重、并发展开、父任务状态汇总和整体取消
+"""
+
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+from fastapi.testclient import TestClient
+
+import main
+from main import DownloadScheduler, ExtractionPool
+
+def make_state():
+    """创建使用临时任务库的 State"""
+    os.environ["YTDLP_TASK_DB"] = os.path.join(tempfile.mkdtemp(), "tasks.db")
+    try:
+        return main.State()
+    finally:
+        del os.environ["YTDLP_TASK_DB"]
+
+def test_add_tasks_deduplicates():
+    """同一批次内和已有任务重复的链接返回同一个任务ID，不重复创建"""
+    state = make_state()
+    existing_id = state.add_task("https://example.com/0", "./downloads", "best")
+    urls = ["https://example.com/0", "https://example.com/1", "https://www.example.com/1#t=10", "https://example.com/2"]
+    results = state.add_tasks(urls, "./downloads", "best")
+
+    assert results[0] == (existing_id, None)
+    assert results[1][1] is not None and results[2] == (results[1][0], None)
+    assert results[3][1] is not None
+    assert len(state.store.execute("SELECT id FROM tasks")) == 3
+
+def test_playlist_status_follows_children():
+    """父任务的状态和进度由子任务汇总得出"""
+    state = make_state()
+    urls = [f"https://example.com/pl/{i}" for i in range(3)]
+    parent_id, children = state.add_playlist("https://example.com/pl", "./downloads", "best", urls)
+    assert state.add_playlist("https://example.com/pl", "./downloads", "best", urls)[0] == parent_id
+    assert state.get_task(parent_id).status == "pending"
+
+    first, second, third = [task_id for task_id, _ in children]
+    assert state.claim_task(first) is not None
+    state.update_task(first, "downloading", progress={"percent": 50, "downloaded_bytes": 100})
+    parent = state.get_task(parent_id)
+    assert parent.status == "downloading"
+    assert state.playlist_progress(parent_id)["downloaded_bytes"] == 100
+
+    state.update_task(first, "completed")
+    state.update_task(second, "completed")
+    state.update_task(third, "failed", error="Video unavailable")
+    parent = state.get_task(parent_id)
+    assert parent.status == "failed"
+    assert parent.progress["completed"] == 2 and parent.progress["percent"] == 66.67
+
+def test_cancel_children():
+    """取消父任务时所有等待中的子任务在一次更新中被取消"""
+    state = make_state()
+    urls = [f"https://example.com/cancel/{i}" for i in range(5)]
+    parent_id, children = state.add_playlist("https://example.com/cancel", "./downloads", "best", urls)
+    assert sorted(state.cancel_children(parent_id)) == sorted(task_id for task_id, _ in children)
+    assert all(state.get_task(task_id).status == "canceled" for task_id, _ in children)
+    assert state.get_task(parent_id).status == "canceled"
+
+def test_cancel_children_in_postprocessing():
+    """正在后处理的子任务也会被取消，由后处理阶段在当前步骤结束后停止"""
+    state = make_state()
+    urls = [f"https://example.com/cancel-pp/{i}" for i in range(2)]
+    parent_id, children = state.add_playlist("https://example.com/cancel-pp", "./downloads", "best", urls)
+    running_id, pending_id = children[0][0], children[1][0]
+    assert state.claim_task(running_id)
+    state.update_task(running_id, "postprocessing")
+    assert state.cancel_children(parent_id) == [pending_id]
+    assert state.get_task(running_id).status == "canceling"
+    assert state.is_cancel_requested(running_id)
+    state.update_task(running_id, "canceled", error="Canceled by user")
+    assert state.get_task(parent_id).status == "canceled"
+
+def test_batch_playlists_share_extraction_pool():
+    """批量展开播放列表时同时提取的数量不超过线程池大小，排队的链接不会因等待线程而超时"""
+    original = (main.extraction_pool, main.scheduler, main.get_playlist_entries)
+    running, peak = [0], [0]
+    lock = threading.Lock()
+
+    def get_playlist_entries(url: str) -> list:
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.2)
+        with lock:
+            running[0] -= 1
+        return [url + "/1"]
+
+    # 6 个链接都排进 2 个线程的线程池时，最后两个要等待 0.6 秒，超过 0.5 秒的超时
+    main.extraction_pool, main.scheduler = ExtractionPool(max_workers=2, timeout=0.5), DownloadScheduler(1)
+    main.get_playlist_entries = get_playlist_entries
+    urls = [f"https://example.com/{uuid.uuid4()}" for _ in range(6)]
+    items = []
+    try:
+        response = TestClient(main.app).post("/download/batch", json={"urls": urls, "output_path": "./downloads", "playlist": True})
+        assert response.status_code == 200
+        data = response.json()["data"]
+        items = data["tasks"]
+        assert data["failed"] == 0 and data["created"] == 6
+        assert peak[0] == 2
+    finally:
+        main.extraction_pool.executor.shutdown(wait=True)
+        main.extraction_pool, main.scheduler, main.get_playlist_entries = original
+        for item in items:
+            if "task_id" not in item:
+                continue
+            for child_id in main.state.child_ids(item["task_id"]):
+                main.state.delete_task(child_id)
+            main.state.delete_task(item["task_id"])
+
+if __name__ == "__main__":
+    test_add_tasks_deduplicates()
+    test_playlist_status_follows_children()
+    test_cancel_children()
+    test_cancel_children_in_postprocessing()
+    test_batch_playlists_share_extraction_pool()
+    print("✅ 所有测试完成")
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试内容寻址存储：相同内容只保存一份，最后一个引用删除后才删除 blob
+"""
+
+import os
+import tempfile
+
+from main import ContentStore, TaskStore, content_key
+
+def test_content_key():
+    """通用提取器使用页面地址区分同名文件"""
+    info = {"extractor_key": "Youtube", "id": "dQw4w9WgXcQ", "format_id": "137+140", "ext": "mp4"}
+    assert content_key(info, "https://youtu.be/dQw4w9WgXcQ") == "Youtube:dQw4w9WgXcQ:137+140:mp4"
+    generic = {"extractor_key": "Generic", "id": "clip", "format_id": "mp4", "ext": "mp4"}
+    first = content_key(dict(generic, webpage_url="https://a.example.com/clip.mp4"), "")
+    second = content_key(dict(generic, webpage_url="https://b.example.com/clip.mp4"), "")
+    assert first != second
+
+def test_blob_removed_with_last_reference():
+    """多个任务链接同一个 blob，删除最后一个引用时 blob 被删除"""
+    root = tempfile.mkdtemp()
+    store = ContentStore(TaskStore(os.path.join(root, "tasks.db")), os.path.join(root, "store"))
+    downloaded = os.path.join(root, "a", "video.mp4")
+    os.makedirs(os.path.dirname(downloaded))
+    with open(downloaded, "wb") as f:
+        f.write(b"video data")
+
+    store.ingest("task-1", "key", downloaded)
+    blob = store.lookup("key")
+    assert blob is not None
+
+    copy_path = os.path.join(root, "b", "video.mp4")
+    store.link("task-2", "key", blob, copy_path)
+    assert os.path.samefile(copy_path, downloaded)
+    assert store.metrics()["references"] == 2
+    assert store.paths_in_use({downloaded, copy_path}, "task-1") == {copy_path}
+
+    store.release("task-1")
+    assert os.path.exists(blob)
+    store.release("task-2")
+    assert not os.path.exists(blob)
+    assert store.lookup("key") is None
+
+if __name__ == "__main__":
+    test_content_key()
+    test_blob_removed_with_last_reference()
+    print("✅ 所有测试完成")
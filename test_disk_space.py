@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试磁盘空间准入、推迟任务的重新排队，以及保留策略按 TTL/配额选出要清理的任务
+"""
+
+import shutil
+import tempfile
+import time
+
+import main
+from main import DiskSpaceGuard, DownloadScheduler, InsufficientDiskSpace, RetentionEngine, Task, estimate_download_size
+
+def test_estimate_download_size():
+    assert estimate_download_size({"filesize": 100}) == 100
+    assert estimate_download_size({"requested_formats": [{"filesize": 100}, {"filesize_approx": 50.5}]}) == 150
+    assert estimate_download_size({"requested_formats": [{"filesize": 100}, {}]}) is None
+
+def test_admission_counts_other_reservations():
+    """同一卷上其他下载尚未写入的预留空间不能再分配"""
+    root = tempfile.mkdtemp()
+    free = shutil.disk_usage(root).free
+    guard = DiskSpaceGuard(min_free=free - 1000)
+    guard.admit("a", root, 600)
+    try:
+        guard.admit("b", root, 600)
+    except InsufficientDiskSpace as e:
+        assert e.required == 600
+    else:
+        raise AssertionError("second download should be deferred")
+    # a 写入的数据已经计入卷的已用空间，预留随之减少
+    guard.record_progress("a", "a.mp4", 600)
+    assert guard.metrics()["reserved_bytes"] == 0
+    guard.release("a")
+    guard.admit("b", root, 600)
+
+def test_deferred_task_waits():
+    """推迟的任务在到期之前不会出队"""
+    scheduler = DownloadScheduler(1)
+    scheduler.submit(Task(id="t", url="https://example.com/v", output_path=".", format="best", status="pending"), delay=0.2)
+    assert scheduler.is_queued("t")
+    item, wait = scheduler._pop_next()
+    assert item is None and 0 < wait <= 0.2
+    time.sleep(wait)
+    item, _ = scheduler._pop_next()
+    assert item[0] == "t"
+    main.limiter.release(item[2])
+
+def test_retention_select_evictions():
+    root = tempfile.mkdtemp()
+    engine = RetentionEngine(main.state.store, {}, 300)
+    sizes = {"old": 400, "mid": 300, "new": 200}
+    entries = [("new", 900.0), ("old", 100.0), ("mid", 500.0)]
+    assert engine.select_evictions({"ttl": 600}, root, entries, sizes.get, 1000.0) == ["old"]
+    # 超过配额时从最久未访问的开始清理
+    assert engine.select_evictions({"quota": 400}, root, entries, sizes.get, 1000.0) == ["old", "mid"]
+    assert engine.select_evictions({"quota": 1000}, root, entries, sizes.get, 1000.0) == []
+
+if __name__ == "__main__":
+    test_estimate_download_size()
+    test_admission_counts_other_reservations()
+    test_deferred_task_waits()
+    test_retention_select_evictions()
+    print("✅ 所有测试完成")
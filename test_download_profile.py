@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试下载配置：命名配置与请求覆盖的合并、上限校验，以及随任务持久化
+"""
+
+import os
+import tempfile
+
+import main
+from main import DownloadProfile, DownloadProfiles, build_download_params
+
+def make_profiles() -> DownloadProfiles:
+    return DownloadProfiles(
+        profiles={
+            "default": {"concurrent_fragment_downloads": 4},
+            "aria": {"external_downloader": "aria2c", "external_downloader_args": ["-x", "8"]},
+        },
+        limits={"concurrent_fragment_downloads": 16},
+        external_downloaders={"aria2c"},
+    )
+
+def test_resolve_profile():
+    """请求字段覆盖命名配置，命名配置覆盖默认配置"""
+    profiles = make_profiles()
+    assert profiles.resolve() == {"concurrent_fragment_downloads": 4}
+    options = profiles.resolve(DownloadProfile(name="aria", concurrent_fragment_downloads=8, http_chunk_size=10485760))
+    assert options == {
+        "concurrent_fragment_downloads": 8,
+        "external_downloader": "aria2c",
+        "external_downloader_args": ["-x", "8"],
+        "http_chunk_size": 10485760,
+    }
+    # 换用内置下载器时不再带上外部下载器的参数
+    assert "external_downloader_args" not in profiles.resolve(DownloadProfile(name="aria", external_downloader="native"))
+
+def test_resolve_rejects_invalid():
+    """超过上限、未知配置或不允许的外部下载器被拒绝"""
+    profiles = make_profiles()
+    for requested in (
+        DownloadProfile(concurrent_fragment_downloads=64),
+        DownloadProfile(name="missing"),
+        DownloadProfile(external_downloader="curl"),
+    ):
+        try:
+            profiles.resolve(requested)
+        except ValueError:
+            continue
+        raise AssertionError(f"{requested} should be rejected")
+
+def test_build_download_params():
+    params = build_download_params({
+        "concurrent_fragment_downloads": 8,
+        "throttled_rate": 100000,
+        "external_downloader": "aria2c",
+        "external_downloader_args": ["-x", "8"],
+    })
+    assert params == {
+        "concurrent_fragment_downloads": 8,
+        "throttledratelimit": 100000,
+        "external_downloader": {"default": "aria2c"},
+        "external_downloader_args": {"aria2c": ["-x", "8"]},
+    }
+    assert build_download_params(None) == {}
+
+def test_options_persisted_with_task():
+    """下载参数随任务写入数据库，重新加载后保持不变"""
+    os.environ["YTDLP_TASK_DB"] = os.path.join(tempfile.mkdtemp(), "tasks.db")
+    try:
+        state = main.State()
+        task_id = state.add_task("https://example.com/v", "./downloads", "best", download_options={"concurrent_fragment_downloads": 8})
+        reloaded = main.State()
+    finally:
+        del os.environ["YTDLP_TASK_DB"]
+    assert reloaded.get_task(task_id).download_options == {"concurrent_fragment_downloads": 8}
+
+if __name__ == "__main__":
+    test_resolve_profile()
+    test_resolve_rejects_invalid()
+    test_build_download_params()
+    test_options_persisted_with_task()
+    print("✅ 所有测试完成")
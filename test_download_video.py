@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试下载只提取一次视频信息：复用 /info 缓存的结果，下载失败时丢弃缓存，以及安全的输出模板
+"""
+
+import contextlib
+import os
+import tempfile
+
+from yt_dlp.utils import DownloadError
+
+import main
+from main import InfoCache, build_safe_outtmpl, download_video
+
+INFO = {"id": "v", "title": "50% off: a/b?", "ext": "mp4", "_type": "video"}
+
+class FakeYDL:
+    """记录提取和下载调用的 YoutubeDL 替身"""
+
+    def __init__(self):
+        self.params = {"outtmpl": {"default": "%(title)s.%(ext)s"}}
+        self.extracted = 0
+        self.downloaded = []
+        self.fail = False
+
+    def extract_info(self, url, download=True):
+        assert not download
+        self.extracted += 1
+        return dict(INFO)
+
+    def sanitize_info(self, info):
+        return dict(info)
+
+    def process_ie_result(self, info, download=True):
+        if self.fail:
+            raise DownloadError("HTTP Error 403: Forbidden")
+        self.downloaded.append((info, self.params["outtmpl"]["default"]))
+        return {**info, "requested_downloads": [{"filepath": "/d/v.mp4"}]}
+
+def with_fake_ydl(test) -> None:
+    ydl = FakeYDL()
+    original_pool, original_cache = main.ydl_pool, main.info_cache
+
+    class Pool:
+        @contextlib.contextmanager
+        def checkout(self, params, task_params=None, cls=None):
+            yield ydl
+
+    main.ydl_pool, main.info_cache = Pool(), InfoCache(ttl=60, max_entries=10)
+    try:
+        test(ydl)
+    finally:
+        main.ydl_pool, main.info_cache = original_pool, original_cache
+
+def test_extract_once():
+    """下载时提取的信息写入缓存，之后的 /info 和下载直接复用"""
+    output_path = tempfile.mkdtemp()
+
+    def run(ydl: FakeYDL) -> None:
+        result = download_video("https://example.com/v", output_path, "best", quiet=True)
+        assert ydl.extracted == 1 and result["requested_downloads"][0]["filepath"] == "/d/v.mp4"
+        assert main.info_cache.peek("https://example.com/v")["title"] == INFO["title"]
+        download_video("https://example.com/v", output_path, "best", quiet=True)
+        assert ydl.extracted == 1 and len(ydl.downloaded) == 2
+        # 下载修改的是副本，缓存中的信息不变
+        ydl.downloaded[0][0]["title"] = "changed"
+        assert main.info_cache.peek("https://example.com/v")["title"] == INFO["title"]
+        assert ydl.downloaded[1][1] == build_safe_outtmpl(INFO, "best", output_path)
+
+    with_fake_ydl(run)
+
+def test_failed_download_drops_cached_info():
+    """下载失败后丢弃缓存的信息，重试时重新提取"""
+    def run(ydl: FakeYDL) -> None:
+        main.info_cache.put("https://example.com/v", dict(INFO))
+        ydl.fail = True
+        try:
+            download_video("https://example.com/v", tempfile.mkdtemp(), "best", quiet=True)
+        except DownloadError:
+            pass
+        else:
+            raise AssertionError("expected DownloadError")
+        assert ydl.extracted == 0 and main.info_cache.peek("https://example.com/v") is None
+        assert main.info_cache.metrics()["invalidations"] == 1
+        ydl.fail = False
+        download_video("https://example.com/v", tempfile.mkdtemp(), "best", quiet=True)
+        assert ydl.extracted == 1
+
+    with_fake_ydl(run)
+
+def test_safe_outtmpl():
+    """标题中的路径分隔符被替换，目录和标题中的 % 被转义，扩展名由 yt-dlp 填充"""
+    output_path = os.path.join(tempfile.mkdtemp(), "100%")
+    template = build_safe_outtmpl(INFO, "bestvideo+bestaudio", output_path)
+    directory, name = os.path.split(template)
+    assert directory == output_path.replace("%", "%%")
+    assert name == "bestvideo+bestaudio-50%% off_ a_b_.%(ext)s"
+    # 没有标题时使用 video，过长的标题被截断
+    assert os.path.basename(build_safe_outtmpl({}, "best", output_path)) == "best-video.%(ext)s"
+    assert len(os.path.basename(build_safe_outtmpl({"title": "x" * 500}, "best", output_path))) <= 200 + len(".%(ext)s") - len(".ext")
+
+if __name__ == "__main__":
+    test_extract_once()
+    test_failed_download_drops_cached_info()
+    test_safe_outtmpl()
+    print("✅ 所有测试完成")
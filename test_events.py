@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试任务事件的发布/订阅：慢订阅者只保留每个任务的最新事件，SSE 与 WebSocket 推送
+"""
+
+import asyncio
+import json
+import threading
+import uuid
+
+from fastapi.testclient import TestClient
+
+import main
+from main import TaskEventBroker
+
+def event(task_id: str, status: str, downloaded: int = 0) -> dict:
+    return {"id": task_id, "url": "u", "status": status, "progress": {"downloaded_bytes": downloaded}}
+
+def test_subscribe_and_unsubscribe():
+    """订阅者只收到关注的任务；取消订阅后不再收到事件"""
+    async def run() -> None:
+        broker = TaskEventBroker(10)
+        broker.bind(asyncio.get_running_loop())
+        watching = broker.subscribe({"a"})
+        everything = broker.subscribe()
+        assert broker.has_subscribers
+        broker.publish(event("a", "downloading"))
+        broker.publish(event("b", "downloading"))
+        assert [e["id"] for e in await watching.get(timeout=1)] == ["a"]
+        assert [e["id"] for e in await everything.get(timeout=1)] == ["a", "b"]
+        broker.unsubscribe(watching)
+        broker.unsubscribe(everything)
+        assert not broker.has_subscribers
+        broker.publish(event("a", "completed"))
+        assert await watching.get(timeout=0.05) == []
+
+    asyncio.run(run())
+
+def test_slow_subscriber_keeps_latest():
+    """没有及时取走的事件按任务合并为最新一条；缓冲的任务数超过上限时丢弃最旧的"""
+    async def run() -> None:
+        broker = TaskEventBroker(2)
+        broker.bind(asyncio.get_running_loop())
+        subscription = broker.subscribe()
+        for downloaded in range(5):
+            broker.publish(event("a", "downloading", downloaded))
+        pending = await subscription.get(timeout=1)
+        assert len(pending) == 1 and pending[0]["progress"]["downloaded_bytes"] == 4
+        assert subscription.dropped == 4
+        for task_id in ("a", "b", "c"):
+            broker.publish(event(task_id, "downloading"))
+        assert [e["id"] for e in await subscription.get(timeout=1)] == ["b", "c"]
+        assert subscription.dropped == 5
+
+    asyncio.run(run())
+
+def test_publish_from_thread():
+    """其他线程发布的事件转交给事件循环分发"""
+    async def run() -> None:
+        broker = TaskEventBroker(10)
+        broker.bind(asyncio.get_running_loop())
+        subscription = broker.subscribe()
+        thread = threading.Thread(target=broker.publish, args=(event("a", "completed"),))
+        thread.start()
+        pending = await subscription.get(timeout=1)
+        thread.join()
+        assert pending == [event("a", "completed")]
+
+    asyncio.run(run())
+
+def new_task() -> str:
+    """在服务启动之后创建任务，避免启动时被调度器排队下载"""
+    return main.state.add_task(f"https://example.com/{uuid.uuid4()}", "./downloads", "best")
+
+def test_sse_stream():
+    """SSE 先发送当前状态，任务结束后关闭"""
+    with TestClient(main.app) as client:
+        task_id = new_task()
+        try:
+            assert main.state.claim_task(task_id)
+            threading.Timer(0.3, main.state.update_task, args=(task_id, "completed")).start()
+            response = client.get(f"/task/{task_id}/events")
+        finally:
+            main.state.delete_task(task_id)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    statuses = [json.loads(line[len("data: "):])["status"] for line in response.text.splitlines() if line.startswith("data: ")]
+    assert statuses == ["downloading", "completed"]
+
+def test_websocket_subscribe():
+    """WebSocket 订阅命令立即推送任务的当前状态，之后推送其变化；取消订阅后不再推送"""
+    with TestClient(main.app) as client:
+        first, second = new_task(), new_task()
+        try:
+            with client.websocket_connect(f"/events?task_ids={second}") as websocket:
+                message = websocket.receive_json()
+                assert message["type"] == "tasks" and [e["id"] for e in message["data"]] == [second]
+
+                websocket.send_json({"subscribe": [first]})
+                message = websocket.receive_json()
+                assert [(e["id"], e["status"]) for e in message["data"]] == [(first, "pending")]
+                assert main.state.claim_task(first)
+                main.state.update_task(first, "downloading", progress={"downloaded_bytes": 10})
+                message = websocket.receive_json()
+                assert [(e["id"], e["status"], e["progress"]) for e in message["data"]] == [(first, "downloading", {"downloaded_bytes": 10})]
+
+                # 两个命令在同一条消息中按顺序处理，收到重新订阅的快照时取消订阅已经生效
+                websocket.send_json({"subscribe": [second], "unsubscribe": [first]})
+                message = websocket.receive_json()
+                assert [e["id"] for e in message["data"]] == [second]
+                main.state.update_task(first, "completed")
+                main.state.cancel_task(second)
+                message = websocket.receive_json()
+                assert [e["id"] for e in message["data"]] == [second]
+        finally:
+            main.state.delete_task(first)
+            main.state.delete_task(second)
+
+def test_websocket_rejects_malformed_commands():
+    """格式错误的命令收到错误消息，连接和已有的订阅不受影响"""
+    with TestClient(main.app) as client:
+        task_id = new_task()
+        try:
+            with client.websocket_connect("/events?task_ids=none") as websocket:
+                for command in ({"subscribe": task_id}, {"subscribe": 42}, {"subscribe": [task_id, 1]},
+                                {"unsubscribe": "none"}, ["subscribe"]):
+                    websocket.send_json(command)
+                    assert websocket.receive_json()["type"] == "error"
+                websocket.send_text("not json")
+                assert websocket.receive_json()["type"] == "error"
+
+                websocket.send_json({"subscribe": [task_id]})
+                message = websocket.receive_json()
+                assert message["type"] == "tasks" and [e["id"] for e in message["data"]] == [task_id]
+        finally:
+            main.state.delete_task(task_id)
+
+if __name__ == "__main__":
+    test_subscribe_and_unsubscribe()
+    test_slow_subscriber_keeps_latest()
+    test_publish_from_thread()
+    test_sse_stream()
+    test_websocket_subscribe()
+    test_websocket_rejects_malformed_commands()
+    print("✅ 所有测试完成")
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试 /info、/formats 的提取线程池：超时返回 504，客户端断开返回 499，排队中的提取被取消，以及统计和直方图
+"""
+
+import asyncio
+import threading
+
+from fastapi import HTTPException
+
+import main
+from main import ExtractionPool
+
+class DisconnectingRequest:
+    """delay 秒后报告客户端断开的请求替身"""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+
+    async def receive(self) -> dict:
+        await asyncio.sleep(self.delay)
+        return {"type": "http.disconnect"}
+
+def with_pool(test, max_workers: int = 1, timeout: float = 0.2) -> None:
+    """用临时的提取线程池运行 async test(pool, release)；release 放行所有阻塞中的提取"""
+    original = main.extraction_pool
+    pool = ExtractionPool(max_workers=max_workers, timeout=timeout)
+    release = threading.Event()
+    main.extraction_pool = pool
+    try:
+        asyncio.run(test(pool, release))
+    finally:
+        release.set()
+        pool.executor.shutdown(wait=True)
+        main.extraction_pool = original
+
+async def expect_http_error(status_code: int, coroutine) -> None:
+    try:
+        await coroutine
+    except HTTPException as e:
+        assert e.status_code == status_code, e.status_code
+    else:
+        raise AssertionError(f"expected HTTP {status_code}")
+
+def test_result_and_error():
+    """正常的提取返回结果；提取抛出的异常原样传出并计入 errors"""
+    async def run(pool: ExtractionPool, release: threading.Event) -> None:
+        assert await main.run_extraction(None, lambda: {"id": "v"}) == {"id": "v"}
+        try:
+            await main.run_extraction(None, lambda: 1 / 0)
+        except ZeroDivisionError:
+            pass
+        else:
+            raise AssertionError("expected ZeroDivisionError")
+        metrics = pool.metrics()
+        assert (metrics["submitted"], metrics["errors"], metrics["queued"], metrics["running"]) == (2, 1, 0, 0)
+
+    with_pool(run)
+
+def test_timeout_returns_504():
+    """超过 timeout 的提取返回 504；已经开始的提取在后台继续运行"""
+    async def run(pool: ExtractionPool, release: threading.Event) -> None:
+        finished = threading.Event()
+
+        def slow() -> None:
+            release.wait(5)
+            finished.set()
+
+        await expect_http_error(504, main.run_extraction(None, slow))
+        metrics = pool.metrics()
+        assert metrics["timeouts"] == 1 and metrics["running"] == 1 and metrics["saturated"]
+        release.set()
+        await asyncio.get_running_loop().run_in_executor(None, finished.wait, 5)
+        assert finished.is_set()
+
+    with_pool(run)
+
+def test_disconnect_returns_499():
+    """客户端断开后立即停止等待，返回 499，不计为超时"""
+    async def run(pool: ExtractionPool, release: threading.Event) -> None:
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        await expect_http_error(499, main.run_extraction(DisconnectingRequest(0.05), lambda: release.wait(5)))
+        assert loop.time() - started < 1
+        metrics = pool.metrics()
+        assert metrics["disconnects"] == 1 and metrics["timeouts"] == 0
+
+    with_pool(run, timeout=5)
+
+def test_queued_extraction_is_cancelled():
+    """线程池已满时排队的提取超时后被取消，不会再运行"""
+    async def run(pool: ExtractionPool, release: threading.Event) -> None:
+        calls = []
+        # 占住唯一的工作线程
+        blocker = pool.executor.submit(release.wait, 5)
+        await expect_http_error(504, main.run_extraction(None, lambda: calls.append(1)))
+        metrics = pool.metrics()
+        assert metrics["queued"] == 0 and metrics["timeouts"] == 1
+        release.set()
+        blocker.result(5)
+        # 已取消的提取不会在线程空闲后执行
+        await asyncio.get_running_loop().run_in_executor(None, pool.executor.submit(lambda: None).result)
+        assert calls == []
+
+    with_pool(run)
+
+def test_histograms():
+    """每次提取记录排队等待和总耗时；metrics 输出配置、统计和两个直方图"""
+    async def run(pool: ExtractionPool, release: threading.Event) -> None:
+        await asyncio.gather(*(main.run_extraction(None, lambda: None) for _ in range(3)))
+        metrics = pool.metrics()
+        assert metrics["max_workers"] == 2 and metrics["timeout"] == 5
+        assert metrics["submitted"] == 3 and not metrics["saturated"]
+        for name in ("queue_wait_seconds", "latency_seconds"):
+            histogram = metrics[name]
+            assert histogram["count"] == 3 and histogram["buckets"]["+Inf"] == 3
+            assert set(histogram["buckets"]) == {str(bound) for bound in main.LatencyHistogram.DEFAULT_BUCKETS} | {"+Inf"}
+
+    with_pool(run, max_workers=2, timeout=5)
+
+if __name__ == "__main__":
+    test_result_and_error()
+    test_timeout_returns_504()
+    test_disconnect_returns_499()
+    test_queued_extraction_is_cancelled()
+    test_histograms()
+    print("✅ 所有测试完成")
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试已完成任务的文件下载：多段 Range、无法满足的 Range 和条件请求
+"""
+
+import os
+import tempfile
+import uuid
+
+from fastapi.testclient import TestClient
+
+import main
+
+CONTENT = bytes(range(256)) * 40
+
+def completed_task() -> str:
+    """创建一个已完成、输出文件存在的任务"""
+    path = os.path.join(tempfile.mkdtemp(), "video.mp4")
+    with open(path, "wb") as f:
+        f.write(CONTENT)
+    task_id = main.state.add_task(f"https://example.com/{uuid.uuid4()}", os.path.dirname(path), "best")
+    main.state.update_task(task_id, "completed", result={"requested_downloads": [{"filepath": path}]})
+    return task_id
+
+def test_multiple_ranges():
+    """多段 Range 返回 multipart/byteranges，边界在 Content-Type 中，Content-Length 与实际长度一致"""
+    task_id = completed_task()
+    try:
+        response = TestClient(main.app).get(f"/download/{task_id}/file", headers={"Range": "bytes=0-9,100-199,-5"})
+        assert response.status_code == 206
+        content_type = response.headers["content-type"]
+        assert content_type.startswith("multipart/byteranges; boundary=")
+        boundary = content_type.split("boundary=", 1)[1]
+        assert "content-range" not in response.headers
+        assert int(response.headers["content-length"]) == len(response.content)
+        body = response.content
+        assert body.endswith(f"\n--{boundary}--\n".encode())
+        assert body.count(f"--{boundary}".encode()) == 4
+        size = len(CONTENT)
+        for start, end in ((0, 9), (100, 199), (size - 5, size - 1)):
+            part = f"Content-Range: bytes {start}-{end}/{size}\n\n".encode() + CONTENT[start:end + 1] + b"\n"
+            assert part in body
+    finally:
+        main.state.delete_task(task_id)
+
+def test_unsatisfiable_range():
+    """超出文件大小的 Range 返回 416"""
+    task_id = completed_task()
+    try:
+        response = TestClient(main.app).get(f"/download/{task_id}/file", headers={"Range": f"bytes={len(CONTENT) + 10}-"})
+        assert response.status_code == 416
+        assert response.headers["content-range"] == f"bytes */{len(CONTENT)}"
+    finally:
+        main.state.delete_task(task_id)
+
+def test_not_modified():
+    """If-None-Match 与 ETag 匹配时返回不带内容的 304"""
+    task_id = completed_task()
+    try:
+        client = TestClient(main.app)
+        response = client.get(f"/download/{task_id}/file")
+        assert response.status_code == 200 and response.content == CONTENT
+        etag = response.headers["etag"]
+        response = client.get(f"/download/{task_id}/file", headers={"If-None-Match": etag})
+        assert response.status_code == 304 and response.content == b""
+        assert response.headers["etag"] == etag
+        response = client.get(f"/download/{task_id}/file", headers={"If-None-Match": '"other"'})
+        assert response.status_code == 200
+    finally:
+        main.state.delete_task(task_id)
+
+if __name__ == "__main__":
+    test_multiple_ranges()
+    test_unsatisfiable_range()
+    test_not_modified()
+    print("✅ 所有测试完成")
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试视频信息缓存功能
+"""
+
+import threading
+import time
+
+from main import InfoCache, get_signed_url_expiry
+
+def test_hit_after_extract():
+    """规范化后相同的URL命中缓存"""
+    cache = InfoCache(ttl=60, max_entries=10)
+    calls = []
+    extract = lambda: calls.append(1) or {"id": "abc", "formats": []}
+    cache.get_or_extract("https://youtu.be/abc", extract)
+    info = cache.get_or_extract("https://www.youtube.com/watch?v=abc&t=5", extract)
+    assert info["id"] == "abc"
+    assert len(calls) == 1
+    assert cache.metrics()["hits"] == 1
+
+def test_single_flight():
+    """并发的相同请求只提取一次"""
+    cache = InfoCache(ttl=60, max_entries=10)
+    calls = []
+
+    def extract():
+        calls.append(1)
+        time.sleep(0.2)
+        return {"id": "slow"}
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(cache.get_or_extract("https://example.com/v", extract)))
+        for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert len(results) == 5
+    assert cache.metrics()["coalesced"] == 4
+
+def test_errors_not_cached():
+    """提取失败不会被缓存"""
+    cache = InfoCache(ttl=60, max_entries=10)
+
+    def fail():
+        raise ValueError("boom")
+
+    for _ in range(2):
+        try:
+            cache.get_or_extract("https://example.com/bad", fail)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("expected ValueError")
+    assert cache.metrics()["misses"] == 2
+
+def test_signed_url_expiry():
+    """签名地址即将过期的信息不缓存，TTL 不超过签名过期时间"""
+    now = time.time()
+    soon = {"formats": [{"url": f"https://cdn.example.com/v?expire={int(now + 30)}&sig=x"}]}
+    later = {"formats": [{"url": f"https://cdn.example.com/v?expire={int(now + 600)}"}, {"url": "https://cdn.example.com/plain"}]}
+    assert get_signed_url_expiry(later) == int(now + 600)
+    cache = InfoCache(ttl=3600, max_entries=10)
+    cache.put("https://example.com/soon", soon)
+    assert cache.get("https://example.com/soon") is None
+    cache.put("https://example.com/later", later)
+    assert cache.get("https://example.com/later") is later
+    assert cache.expires_at(later, now) <= now + 600
+
+def test_lru_eviction():
+    """超过容量时淘汰最久未使用的条目"""
+    cache = InfoCache(ttl=60, max_entries=2)
+    for name in ("a", "b", "c"):
+        cache.put(f"https://example.com/{name}", {"id": name})
+    assert cache.get("https://example.com/a") is None
+    assert cache.get("https://example.com/c")["id"] == "c"
+
+if __name__ == "__main__":
+    test_hit_after_extract()
+    test_single_flight()
+    test_errors_not_cached()
+    test_signed_url_expiry()
+    test_lru_eviction()
+    print("✅ 所有测试完成")
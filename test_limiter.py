@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试按分组的下载限流
+"""
+
+import asyncio
+import sqlite3
+import time
+import uuid
+
+import main
+from main import DownloadLimiter, DownloadScheduler, GroupLimits, LimitsUpdate, TokenBucket, classify_error, task_group
+
+def make_limiter(**default):
+    limits = {"max_concurrent": None, "rate": None, "burst": 1, "ratelimit": None}
+    limits.update(default)
+    return DownloadLimiter(limits, {}, None, backoff_base=10, backoff_max=25, max_retries=3)
+
+def test_task_group():
+    """同一站点的链接归为同一分组，通用链接按域名分组"""
+    assert task_group("https://youtu.be/dQw4w9WgXcQ") == "youtube"
+    assert task_group("https://www.youtube.com/playlist?list=PLx0sYbCqOb8TBPRdmBHs5Iftvv9TPboYG") == "youtube"
+    assert task_group("https://www.example.com/video.mp4") == "example.com"
+
+def test_token_bucket():
+    """令牌用完后按速率补充"""
+    bucket = TokenBucket(rate=2, burst=2)
+    # 使用固定的时间，避免单调时钟的值较大时浮点误差影响比较
+    now = bucket.updated = 1000.0
+    bucket.take(now)
+    bucket.take(now)
+    assert bucket.wait_time(now) == 0.5
+    assert bucket.wait_time(now + 0.5) == 0
+
+def test_concurrency_and_overrides():
+    """分组达到并发上限时需要等待，单独配置覆盖默认值"""
+    limiter = make_limiter(max_concurrent=1)
+    now = time.monotonic()
+    limiter.acquire("youtube", now)
+    assert limiter.ready_in("youtube", now) is None
+    assert limiter.ready_in("vimeo", now) == 0
+
+    limiter.configure(LimitsUpdate(groups={"youtube": GroupLimits(max_concurrent=2)}))
+    assert limiter.ready_in("youtube", now) == 0
+    limiter.configure(LimitsUpdate(groups={"youtube": None}))
+    assert limiter.ready_in("youtube", now) is None
+
+def test_backoff():
+    """429/403 使分组暂停，暂停时间翻倍但不超过上限，成功后重置"""
+    assert classify_error(Exception("ERROR: HTTP Error 429: Too Many Requests")) == "rate_limited"
+    assert classify_error(Exception("ERROR: Video unavailable")) != "rate_limited"
+    limiter = make_limiter()
+    assert [limiter.record_throttle("youtube") for _ in range(3)] == [10, 20, 25]
+    assert limiter.ready_in("youtube", time.monotonic()) > 20
+    limiter.record_success("youtube")
+    assert limiter.record_throttle("youtube") == 10
+
+def test_global_bandwidth_is_shared():
+    """总带宽平均分给正在进行的下载，分组上限更低时使用分组上限"""
+    limiter = make_limiter()
+    limiter.configure(LimitsUpdate(global_ratelimit=1000, groups={"vimeo": GroupLimits(ratelimit=200)}))
+    first, second = {}, {}
+    limiter.attach("a", "youtube", first)
+    assert first["ratelimit"] == 1000
+    limiter.attach("b", "vimeo", second)
+    assert (first["ratelimit"], second["ratelimit"]) == (500, 200)
+    limiter.detach("b")
+    assert first["ratelimit"] == 1000
+
+def test_claim_error_releases_slot():
+    """认领任务时数据库出错，分组和租户的名额被释放，任务稍后重新认领而不是一直卡在 pending"""
+    url = f"https://claim-{uuid.uuid4().hex[:8]}.example/video.mp4"
+    group = task_group(url)
+    main.limiter.configure(LimitsUpdate(groups={group: GroupLimits(max_concurrent=1)}))
+    task_id = main.state.add_task(url, "./downloads", "best")
+    scheduler = DownloadScheduler(1)
+    claims = []
+    original_claim, original_interval = main.state.claim_task, main.state.poll_interval
+
+    def failing_claim(claimed_id: str):
+        claims.append(claimed_id)
+        raise sqlite3.OperationalError("database is locked")
+
+    async def run() -> None:
+        scheduler._wakeup = asyncio.Event()
+        scheduler.submit(main.state.get_task(task_id))
+        worker = asyncio.create_task(scheduler._worker())
+        await asyncio.sleep(0.3)
+        # 数据库恢复后任务被认领（这里模拟已被其他进程认领，直接跳过）
+        main.state.claim_task = lambda claimed_id: None
+        await asyncio.sleep(0.2)
+        worker.cancel()
+        await asyncio.gather(worker, return_exceptions=True)
+
+    main.state.claim_task, main.state.poll_interval = failing_claim, 0.05
+    try:
+        asyncio.run(run())
+        assert len(claims) >= 2
+        assert main.limiter.snapshot()["groups"][group]["active"] == 0
+        assert scheduler.active_by_tenant() == {}
+        assert not scheduler.is_queued(task_id)
+    finally:
+        main.state.claim_task, main.state.poll_interval = original_claim, original_interval
+        main.limiter.configure(LimitsUpdate(groups={group: None}))
+        main.state.delete_task(task_id)
+
+if __name__ == "__main__":
+    test_task_group()
+    test_token_bucket()
+    test_concurrency_and_overrides()
+    test_backoff()
+    test_global_bandwidth_is_shared()
+    test_claim_error_releases_slot()
+    print("✅ 所有测试完成")
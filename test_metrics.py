@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试 Prometheus 指标：下载字节累计和文本格式输出
+"""
+
+from main import LatencyHistogram, Metrics, PrometheusText
+
+def test_downloaded_bytes():
+    """只累计新下载的字节，续传的缓存和新文件的第一次回调只作为基准"""
+    metrics = Metrics(enabled=True)
+    for downloaded in (500, 1500, 4000):
+        metrics.record_progress("a", "youtube", {"filename": "v.f137.mp4", "downloaded_bytes": downloaded, "speed": 100.0})
+    metrics.record_progress("a", "youtube", {"filename": "v.f140.m4a", "downloaded_bytes": 100})
+    metrics.record_progress("a", "youtube", {"filename": "v.f140.m4a", "downloaded_bytes": 300, "speed": 50.0})
+    assert metrics.downloaded_bytes["youtube"] == 3700
+    assert metrics.download_speeds() == {"youtube": 50.0}
+
+    metrics.record_task("a", "completed", 12.0)
+    assert metrics.download_speeds() == {}
+    assert metrics.task_seconds["completed"].snapshot()["count"] == 1
+
+    disabled = Metrics(enabled=False)
+    disabled.record_progress("a", "youtube", {"filename": "v.mp4", "downloaded_bytes": 100})
+    disabled.record_progress("a", "youtube", {"filename": "v.mp4", "downloaded_bytes": 200})
+    assert not disabled.downloaded_bytes
+
+def test_prometheus_text():
+    """计数器和直方图按 Prometheus 文本格式输出，标签值被转义"""
+    out = PrometheusText()
+    out.add("ytdlp_downloaded_bytes_total", "counter", "Bytes downloaded.", [({"group": 'a"b'}, 3000000)])
+    histogram = LatencyHistogram((0.1, 1.0))
+    histogram.observe(0.5)
+    out.add_histogram("ytdlp_extraction_duration_seconds", "Extraction time.", [({}, histogram)])
+    lines = out.render().splitlines()
+    assert 'ytdlp_downloaded_bytes_total{group="a\\"b"} 3000000' in lines
+    assert 'ytdlp_extraction_duration_seconds_bucket{le="0.1"} 0' in lines
+    assert 'ytdlp_extraction_duration_seconds_bucket{le="+Inf"} 1' in lines
+    assert "ytdlp_extraction_duration_seconds_count 1" in lines
+
+if __name__ == "__main__":
+    test_downloaded_bytes()
+    test_prometheus_text()
+    print("✅ 所有测试完成")
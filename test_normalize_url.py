@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试去重使用的URL规范化功能
+"""
+
+from main import normalize_url, make_dedup_key
+
+def test_youtube_variants():
+    """不同形式的 YouTube 链接规范化为同一个 watch 链接"""
+    expected = "https://youtube.com/watch?v=dQw4w9WgXcQ"
+    variants = [
+        "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+        "http://youtube.com/watch?v=dQw4w9WgXcQ&t=42s",
+        "https://youtu.be/dQw4w9WgXcQ?si=abcdef",
+        "https://m.youtube.com/watch?feature=share&v=dQw4w9WgXcQ",
+        "https://www.youtube.com/shorts/dQw4w9WgXcQ",
+        "https://www.youtube.com/embed/dQw4w9WgXcQ?start=10",
+        "  https://www.youtube.com/watch?v=dQw4w9WgXcQ&utm_source=newsletter#comments  ",
+    ]
+    for url in variants:
+        assert normalize_url(url) == expected, url
+
+def test_youtube_playlist_kept():
+    """播放列表参数会改变下载内容，必须保留"""
+    url = normalize_url("https://www.youtube.com/watch?v=dQw4w9WgXcQ&list=PL123&index=2")
+    assert url == "https://youtube.com/watch?list=PL123&v=dQw4w9WgXcQ"
+
+def test_generic_urls():
+    """其他站点只去掉 utm_*/fbclid/gclid 并排序查询参数"""
+    a = normalize_url("https://Example.com/video?id=1&b=2&utm_campaign=x&fbclid=y&gclid=z")
+    b = normalize_url("https://example.com/video?b=2&id=1")
+    assert a == b
+    assert normalize_url("https://example.com:8443/v?id=1") == "https://example.com:8443/v?id=1"
+    assert normalize_url("not a url") == "not a url"
+
+def test_generic_urls_keep_site_params():
+    """YouTube 的分享参数和 https 统一只用于 YouTube，其他站点的 ref/app 等参数和协议保持不变"""
+    url = "http://example.com/v?ref=a&app=b&si=c&feature=d&pp=e&spm=f"
+    assert normalize_url(url) == "http://example.com/v?app=b&feature=d&pp=e&ref=a&si=c&spm=f"
+    assert normalize_url("http://example.com/v") != normalize_url("https://example.com/v")
+    # 默认端口按各自的协议判断
+    assert normalize_url("http://example.com:80/v") == "http://example.com/v"
+    assert normalize_url("http://example.com:443/v") == "http://example.com:443/v"
+    assert normalize_url("https://www.youtube.com/@channel/videos?app=desktop&ref=x&view=0") == "https://youtube.com/@channel/videos?view=0"
+
+def test_dedup_key():
+    """去重键同时区分输出目录和格式"""
+    key = make_dedup_key("https://youtu.be/dQw4w9WgXcQ", "./downloads", "best")
+    assert key == make_dedup_key("https://www.youtube.com/watch?v=dQw4w9WgXcQ", "downloads", "best")
+    assert key != make_dedup_key("https://youtu.be/dQw4w9WgXcQ", "./other", "best")
+    assert key != make_dedup_key("https://youtu.be/dQw4w9WgXcQ", "./downloads", "worst")
+
+if __name__ == "__main__":
+    test_youtube_variants()
+    test_youtube_playlist_kept()
+    test_generic_urls()
+    test_generic_urls_keep_site_params()
+    test_dedup_key()
+    print("✅ 所有测试完成")
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试后处理阶段：下载时只记录 ffmpeg 后处理步骤，后处理预设的解析，以及处理结果写回下载结果
+"""
+
+import os
+import tempfile
+
+from yt_dlp.postprocessor import FFmpegMergerPP
+
+from main import (
+    DownloadProfile, DownloadProfiles, StagedYoutubeDL, apply_postprocess_results,
+    build_download_params, postprocess_job_files, postprocess_presets,
+)
+
+def test_presets():
+    """预设按 yt-dlp 命令行的顺序转换为后处理步骤，嵌入缩略图需要在下载时写入缩略图"""
+    options = DownloadProfiles({}, {}, set()).resolve(DownloadProfile(remux_video="mkv", embed_thumbnail=True))
+    assert postprocess_presets(options) == [("FFmpegVideoRemuxerPP", {"preferedformat": "mkv"}), ("EmbedThumbnailPP", {})]
+    assert build_download_params(options) == {"writethumbnail": True}
+    assert postprocess_presets(None) == []
+
+def test_reject_unsupported_format():
+    try:
+        DownloadProfiles({}, {}, set()).resolve(DownloadProfile(recode_video="exe"))
+    except ValueError:
+        return
+    raise AssertionError("unsupported format should be rejected")
+
+def test_merge_is_deferred():
+    """合并步骤被记录为作业而不是在下载线程中执行"""
+    root = tempfile.mkdtemp()
+    parts = [os.path.join(root, "v.f1.mp4"), os.path.join(root, "v.f2.m4a")]
+    for path in parts:
+        with open(path, "wb") as f:
+            f.write(b"data")
+    jobs = []
+    with StagedYoutubeDL({"quiet": True}, jobs, [("FFmpegVideoRemuxerPP", {"preferedformat": "mkv"})]) as ydl:
+        info = {"id": "v", "ext": "mp4", "__files_to_merge": parts, "__postprocessors": [FFmpegMergerPP(ydl)]}
+        ydl.post_process(os.path.join(root, "v.mp4"), info)
+    assert len(jobs) == 1
+    assert jobs[0]["steps"] == [("FFmpegMergerPP", {}), ("FFmpegVideoRemuxerPP", {"preferedformat": "mkv"})]
+    assert postprocess_job_files(jobs[0]) == [os.path.join(root, "v.mp4")] + parts
+    assert all(os.path.exists(path) for path in parts)
+    assert not os.path.exists(os.path.join(root, "v.mp4"))
+
+def test_apply_results():
+    result = {"filepath": "/d/v.mp4", "ext": "mp4", "requested_downloads": [{"filepath": "/d/v.mp4", "ext": "mp4"}]}
+    apply_postprocess_results(result, {"/d/v.mp4": {"filepath": "/d/v.mkv", "ext": "mkv"}})
+    assert result["filepath"] == "/d/v.mkv"
+    assert result["requested_downloads"][0] == {"filepath": "/d/v.mkv", "ext": "mkv"}
+
+if __name__ == "__main__":
+    test_presets()
+    test_reject_unsupported_format()
+    test_merge_is_deferred()
+    test_apply_results()
+    print("✅ 所有测试完成")
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试进度节流与速度平滑功能
+"""
+
+from main import ProgressTracker
+
+def make_event(downloaded, total=1000, status="downloading", filename="video.mp4", speed=None):
+    return {
+        "status": status,
+        "downloaded_bytes": downloaded,
+        "total_bytes": total,
+        "speed": speed,
+        "filename": filename,
+    }
+
+def test_throttle_by_interval():
+    """同一秒内的大量回调只上报一次"""
+    tracker = ProgressTracker(min_interval=1.0)
+    emitted = [tracker.update(make_event(i), now=i * 0.01) for i in range(100)]
+    reported = [payload for payload in emitted if payload is not None]
+    assert len(reported) == 1
+    assert tracker.update(make_event(150), now=1.5) is not None
+
+def test_finished_always_reported():
+    """finished 事件不受节流限制"""
+    tracker = ProgressTracker(min_interval=10.0)
+    assert tracker.update(make_event(10), now=0.0) is not None
+    assert tracker.update(make_event(20), now=0.1) is None
+    payload = tracker.update(make_event(1000, status="finished"), now=0.2)
+    assert payload is not None
+    assert payload["percent"] == 100.0
+
+def test_percent_threshold():
+    """进度前进超过阈值时立即上报"""
+    tracker = ProgressTracker(min_interval=10.0, min_percent=5.0)
+    assert tracker.update(make_event(0), now=0.0) is not None
+    assert tracker.update(make_event(30), now=0.1) is None
+    assert tracker.update(make_event(60), now=0.2) is not None
+
+def test_smoothed_speed_and_eta():
+    """速度按时间窗口平滑，忽略瞬时值"""
+    tracker = ProgressTracker(min_interval=0.0, window=5.0)
+    payload = None
+    for second in range(5):
+        payload = tracker.update(make_event(second * 100, speed=999999), now=float(second))
+    assert payload["speed"] == 100.0
+    assert payload["eta"] == 6
+
+def test_file_switch_resets_window():
+    """合并格式切换到下一个文件时重新开始计算"""
+    tracker = ProgressTracker(min_interval=10.0)
+    tracker.update(make_event(500, filename="video.f137.mp4"), now=0.0)
+    payload = tracker.update(make_event(10, filename="video.f140.m4a"), now=0.1)
+    assert payload is not None
+    assert payload["filename"] == "video.f140.m4a"
+
+if __name__ == "__main__":
+    test_throttle_by_interval()
+    test_finished_always_reported()
+    test_percent_threshold()
+    test_smoothed_speed_and_eta()
+    test_file_switch_resets_window()
+    print("✅ 所有测试完成")
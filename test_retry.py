@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试下载错误的分类、指数退避的等待时间，以及暂时性错误的任务被重新排队并记录失败次数
+"""
+
+import io
+import random
+import uuid
+
+from yt_dlp.networking import Response
+from yt_dlp.networking.exceptions import HTTPError, TransportError
+from yt_dlp.utils import DownloadError, ExtractorError, GeoRestrictedError, PostProcessingError
+
+import main
+from main import DownloadScheduler, RetryPolicy, classify_error
+
+def http_error(status: int) -> HTTPError:
+    return HTTPError(Response(io.BytesIO(), "https://example.com/v", {}, status=status))
+
+def wrapped(error: Exception) -> DownloadError:
+    """yt-dlp 报告错误时把原始异常放在 exc_info 中"""
+    return DownloadError(f"ERROR: {error}", exc_info=(type(error), error, None))
+
+def test_classify_by_exception():
+    assert classify_error(wrapped(TransportError("connection reset"))) == "network"
+    assert classify_error(wrapped(http_error(503))) == "network"
+    assert classify_error(wrapped(http_error(429))) == "rate_limited"
+    assert classify_error(wrapped(http_error(404))) == "unavailable"
+    assert classify_error(wrapped(GeoRestrictedError("blocked"))) == "geo_blocked"
+    assert classify_error(wrapped(PostProcessingError("Conversion failed!"))) == "postprocessing"
+    # 提取器错误的原因是网络错误时仍可重试
+    assert classify_error(wrapped(ExtractorError("Unable to download webpage", cause=TransportError("timed out")))) == "network"
+    assert classify_error(wrapped(ExtractorError("Private video", expected=True))) == "unavailable"
+
+def test_classify_by_message():
+    """分片下载失败等只以文本报告的错误"""
+    assert classify_error(DownloadError("ERROR: fragment 3 not found, unable to continue")) == "network"
+    assert classify_error(DownloadError("ERROR: Unable to download webpage: HTTP Error 429: Too Many Requests")) == "rate_limited"
+    assert classify_error(DownloadError("ERROR: [youtube] abc: Video unavailable")) == "unavailable"
+    assert classify_error(Exception("something else")) == "unknown"
+
+def test_backoff_delay():
+    """等待时间按次数翻倍，在上限的一半到全部之间随机"""
+    policy = RetryPolicy(max_retries=5, base=10.0, max_delay=60.0, rng=random.Random(1))
+    for attempts, ceiling in ((1, 10.0), (2, 20.0), (3, 40.0), (4, 60.0), (10, 60.0)):
+        delays = [policy.delay(attempts) for _ in range(50)]
+        assert all(ceiling / 2 <= delay <= ceiling for delay in delays)
+        assert len(set(delays)) > 1
+
+def test_retry_requeues_task():
+    """网络错误的任务回到 pending 并延迟排队，失败次数和错误类别写入数据库"""
+    state = main.state
+    task_id = state.add_task(f"https://example.com/{uuid.uuid4()}", "./downloads", "best")
+    assert state.claim_task(task_id)
+    scheduler = DownloadScheduler(1)
+    try:
+        assert scheduler.retry(task_id, "example.com", TransportError("timed out"), "network", 1)
+        task = state.get_task(task_id)
+        assert task.status == "pending" and task.progress["status"] == "retrying"
+        assert scheduler.is_queued(task_id)
+        item, wait = scheduler._pop_next()
+        assert item is None and wait > 0
+        rows = state.store.execute("SELECT attempts, error_code FROM tasks WHERE id = ?", (task_id,))
+        assert rows[0] == (1, "network")
+
+        # 超过重试次数或不可重试的错误交给调用方标记为失败
+        assert state.claim_task(task_id)
+        assert not scheduler.retry(task_id, "example.com", TransportError("timed out"), "network", main.retry_policy.max_retries + 1)
+        assert not scheduler.retry(task_id, "example.com", Exception("Video unavailable"), "unavailable", 1)
+        assert scheduler.metrics()["retries_by_error"] == {"network": 1}
+    finally:
+        scheduler.remove(task_id)
+        state.delete_task(task_id)
+
+if __name__ == "__main__":
+    test_classify_by_exception()
+    test_classify_by_message()
+    test_backoff_delay()
+    test_retry_requeues_task()
+    print("✅ 所有测试完成")
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试下载队列的顺序（优先级高者优先，同一优先级先进先出）和 /queue 队列快照
+"""
+
+import uuid
+
+from fastapi.testclient import TestClient
+
+import main
+from main import DownloadScheduler, Task
+
+def make_task(name: str, priority: int = 0, created_at: str = "2024-01-01T00:00:00") -> Task:
+    return Task(id=name, url=f"https://example.com/{name}", output_path=".", format="best", status="pending",
+                priority=priority, created_at=created_at)
+
+def pop_all(scheduler: DownloadScheduler) -> list:
+    popped = []
+    while True:
+        item, _ = scheduler._pop_next()
+        if item is None:
+            return popped
+        popped.append(item[0])
+        scheduler._release(item[2], item[3])
+
+def test_priority_then_fifo():
+    """优先级高的任务先开始；同一优先级按创建时间，创建时间相同时按提交顺序"""
+    scheduler = DownloadScheduler(1)
+    scheduler.submit(make_task("low", priority=-10, created_at="2024-01-01T00:00:00"))
+    scheduler.submit(make_task("late", created_at="2024-01-01T00:00:03"))
+    scheduler.submit(make_task("early", created_at="2024-01-01T00:00:01"))
+    scheduler.submit(make_task("high", priority=10, created_at="2024-01-01T00:00:05"))
+    scheduler.submit(make_task("tie-1", created_at="2024-01-01T00:00:02"))
+    scheduler.submit(make_task("tie-2", created_at="2024-01-01T00:00:02"))
+    scheduler.submit(make_task("removed", priority=10))
+    assert scheduler.remove("removed") and not scheduler.is_queued("removed")
+
+    expected = ["high", "early", "tie-1", "tie-2", "late", "low"]
+    assert scheduler.queued_task_ids() == expected
+    assert [scheduler.position(task_id) for task_id in expected] == [1, 2, 3, 4, 5, 6]
+    assert pop_all(scheduler) == expected
+    assert scheduler.queued_task_ids() == [] and scheduler.position("high") is None
+
+def test_queue_snapshot():
+    """/queue 返回队列深度和各任务的位置；指定 task_id 时只返回该任务的位置"""
+    original = main.scheduler
+    main.scheduler = DownloadScheduler(2)
+    task_ids = []
+    try:
+        for priority in (0, 0, main.PRIORITY_LEVELS["high"]):
+            task_id = main.state.add_task(f"https://example.com/{uuid.uuid4()}", "./downloads", "best", priority=priority)
+            task_ids.append(task_id)
+            main.scheduler.submit(main.state.get_task(task_id))
+        expected = [task_ids[2], task_ids[0], task_ids[1]]
+        client = TestClient(main.app)
+
+        data = client.get("/queue").json()["data"]
+        assert data["depth"] == 3
+        assert data["tasks"] == [{"id": task_id, "position": index + 1} for index, task_id in enumerate(expected)]
+        assert data["pool"]["max_workers"] == 2 and data["pool"]["queued"] == 3
+        assert data["tenants"][main.DEFAULT_TENANT]["queued"] == 3
+
+        data = client.get("/queue", params={"limit": 1}).json()["data"]
+        assert data["depth"] == 3 and [item["id"] for item in data["tasks"]] == expected[:1]
+
+        data = client.get("/queue", params={"task_id": task_ids[1]}).json()["data"]
+        assert data["task"] == {"id": task_ids[1], "status": "pending", "position": 3}
+        assert "tasks" not in data
+        assert client.get("/queue", params={"task_id": str(uuid.uuid4())}).status_code == 404
+    finally:
+        main.scheduler = original
+        for task_id in task_ids:
+            main.state.delete_task(task_id)
+
+if __name__ == "__main__":
+    test_priority_then_fifo()
+    test_queue_snapshot()
+    print("✅ 所有测试完成")
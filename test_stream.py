@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试边下边传：跟随 .part 文件读取，重命名后读完剩余数据；下载失败时中止
+"""
+
+import asyncio
+import os
+import tempfile
+import threading
+import time
+import types
+import uuid
+
+from fastapi import HTTPException
+
+import main
+from main import StreamAborted, Task, follow_download, open_stream_source, stream_source, stream_task_file
+
+main.STREAM_POLL_INTERVAL = 0.01
+
+async def collect(partial_path: str, final_path: str, get_status) -> bytes:
+    handle = open_stream_source(partial_path, final_path)
+    assert handle is not None
+    return b"".join([chunk async for chunk in follow_download(handle, partial_path, final_path, get_status)])
+
+def test_stream_source():
+    """需要合并格式或尚未开始写文件的任务不能边下边传"""
+    task = Task(id="a", url="u", output_path=".", format="best", status="downloading", progress={"filename": "/d/v.mp4"})
+    assert stream_source(task) == ("/d/v.mp4.part", "/d/v.mp4")
+    task.progress["merge"] = True
+    assert stream_source(task) is None
+    task.progress = None
+    assert stream_source(task) is None
+
+def test_follow_until_rename():
+    """写入过程中读取到的数据与最终文件完全一致"""
+    root = tempfile.mkdtemp()
+    final_path = os.path.join(root, "video.mp4")
+    partial_path = final_path + ".part"
+    content = os.urandom(main.STREAM_CHUNK_SIZE * 3 + 123)
+    with open(partial_path, "wb") as f:
+        f.write(content[:1000])
+
+    def writer() -> None:
+        with open(partial_path, "ab") as f:
+            for start in range(1000, len(content), 50000):
+                f.write(content[start:start + 50000])
+                f.flush()
+                time.sleep(0.005)
+        os.rename(partial_path, final_path)
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    streamed = asyncio.run(collect(partial_path, final_path, lambda: "downloading"))
+    thread.join()
+    assert streamed == content
+
+def test_abort_on_failure():
+    """下载失败后不再等待新数据"""
+    root = tempfile.mkdtemp()
+    partial_path = os.path.join(root, "video.mp4.part")
+    with open(partial_path, "wb") as f:
+        f.write(b"partial")
+    try:
+        asyncio.run(collect(partial_path, partial_path[:-5], lambda: "failed"))
+    except StreamAborted:
+        return
+    raise AssertionError("stream should be aborted")
+
+def stream_error(task_id: str, finish=None) -> HTTPException:
+    """调用边下边传接口，返回其 HTTP 错误；finish 在请求等待时于另一个线程中修改任务状态"""
+    async def run() -> None:
+        request = types.SimpleNamespace(state=types.SimpleNamespace(tenant=main.DEFAULT_TENANT))
+        await stream_task_file(task_id, request, "attachment")
+
+    if finish is not None:
+        threading.Timer(0.3, finish).start()
+    try:
+        asyncio.run(run())
+    except HTTPException as e:
+        return e
+    raise AssertionError("stream should fail")
+
+def test_start_timeout_only_while_pending():
+    """排队超时返回 504；已开始下载的合并格式一直等到结束，不会因为开始超时返回 504"""
+    state = main.state
+    original = main.STREAM_START_TIMEOUT
+    main.STREAM_START_TIMEOUT = 0.1
+    pending_id = state.add_task(f"https://example.com/{uuid.uuid4()}", "./downloads", "best")
+    merged_id = state.add_task(f"https://example.com/{uuid.uuid4()}", "./downloads", "bestvideo+bestaudio")
+    try:
+        assert stream_error(pending_id).status_code == 504
+        assert state.claim_task(merged_id)
+        state.update_task(merged_id, "downloading", progress={"filename": "/d/v.f137.mp4", "merge": True})
+        error = stream_error(merged_id, lambda: state.update_task(merged_id, "failed", error="boom"))
+        assert error.status_code == 409 and "boom" in error.detail
+    finally:
+        main.STREAM_START_TIMEOUT = original
+        state.delete_task(pending_id)
+        state.delete_task(merged_id)
+
+if __name__ == "__main__":
+    test_stream_source()
+    test_follow_until_rename()
+    test_abort_on_failure()
+    test_start_timeout_only_while_pending()
+    print("✅ 所有测试完成")
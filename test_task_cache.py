@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试任务缓存：已结束的任务按 LRU 淘汰，未结束的任务常驻，被淘汰的任务从数据库重新读取
+"""
+
+import os
+import tempfile
+import threading
+
+import main
+from main import Task, TaskCache
+
+def make_task(task_id: str, status: str = "completed") -> Task:
+    return Task(id=task_id, url=f"https://example.com/{task_id}", output_path=".", format="best", status=status)
+
+def test_lru_eviction():
+    """超过 max_size 时淘汰最久未访问的已结束任务，访问过的任务不会被淘汰"""
+    evicted = []
+    cache = TaskCache(2, on_evict=lambda task: evicted.append(task.id))
+    for task_id in ("a", "b"):
+        cache.put(make_task(task_id))
+    assert cache.get("a").id == "a"
+    cache.put(make_task("c"))
+    assert evicted == ["b"]
+    assert cache.get("b") is None and cache.get("a") is not None and cache.get("c") is not None
+
+    # 未结束的任务不计入 max_size，也不会被淘汰
+    for task_id in ("p1", "p2", "p3"):
+        cache.put(make_task(task_id, "pending"))
+    assert evicted == ["b"] and all(cache.get(task_id) for task_id in ("p1", "p2", "p3"))
+    # 任务结束后转为 LRU 管理
+    cache.put(make_task("p1", "failed"))
+    assert evicted == ["b", "a"]
+    assert cache.pop("c").id == "c" and cache.get("c") is None
+
+def test_evicted_task_is_refetched():
+    """被淘汰的已结束任务通过 get_task 从 SQLite 重新读取，结果和去重不受影响"""
+    os.environ.update(YTDLP_TASK_DB=os.path.join(tempfile.mkdtemp(), "tasks.db"), YTDLP_TASK_CACHE_SIZE="2")
+    try:
+        state = main.State()
+    finally:
+        for name in ("YTDLP_TASK_DB", "YTDLP_TASK_CACHE_SIZE"):
+            del os.environ[name]
+    task_ids = [state.add_task(f"https://example.com/{i}", "./downloads", "best") for i in range(3)]
+    for i, task_id in enumerate(task_ids):
+        assert state.claim_task(task_id)
+        state.update_task(task_id, "completed", result={"title": f"video {i}"})
+
+    first = task_ids[0]
+    assert state.tasks.get(first) is None and state.tasks.get(task_ids[2]) is not None
+    task = state.get_task(first)
+    assert task.status == "completed" and state.load_result(task) == {"title": "video 0"}
+    # 重新读取的任务再次进入缓存，淘汰此时最久未访问的任务
+    assert state.tasks.get(first) is task and state.tasks.get(task_ids[1]) is None
+    assert state.find_duplicate("https://example.com/1", "./downloads", "best").id == task_ids[1]
+    state.store.close()
+
+def test_lookups_do_not_wait_for_writes():
+    """按ID、去重键和父任务的查询使用只读连接，共享写连接被占用时不会阻塞"""
+    os.environ.update(YTDLP_TASK_DB=os.path.join(tempfile.mkdtemp(), "tasks.db"), YTDLP_TASK_CACHE_SIZE="1")
+    try:
+        state = main.State()
+    finally:
+        for name in ("YTDLP_TASK_DB", "YTDLP_TASK_CACHE_SIZE"):
+            del os.environ[name]
+    task_ids = [state.add_task(f"https://example.com/{i}", "./downloads", "best") for i in range(2)]
+    for task_id in task_ids:
+        assert state.claim_task(task_id)
+        state.update_task(task_id, "completed", result={"id": task_id})
+    assert state.tasks.get(task_ids[0]) is None
+
+    locked, release = threading.Event(), threading.Event()
+
+    def hold_lock() -> None:
+        with state.store._conn_lock:
+            locked.set()
+            release.wait(5)
+
+    holder = threading.Thread(target=hold_lock)
+    holder.start()
+    locked.wait(5)
+    results = []
+
+    def lookup() -> None:
+        task = state.get_task(task_ids[0])
+        results.append((task.status, state.load_result(task)))
+        results.append(state.find_duplicate("https://example.com/0", "./downloads", "best").id)
+        results.append(state.child_ids(task_ids[0]))
+
+    reader = threading.Thread(target=lookup)
+    reader.start()
+    reader.join(2)
+    finished = not reader.is_alive()
+    release.set()
+    holder.join()
+    reader.join()
+    assert finished, "lookups waited for the write connection"
+    assert results == [("completed", {"id": task_ids[0]}), task_ids[0], []]
+    state.store.close()
+
+if __name__ == "__main__":
+    test_lru_eviction()
+    test_evicted_task_is_refetched()
+    test_lookups_do_not_wait_for_writes()
+    print("✅ 所有测试完成")
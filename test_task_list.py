@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试任务列表：跨页的游标分页、状态和时间过滤，以及 ndjson 格式
+"""
+
+import json
+import os
+import tempfile
+
+from fastapi.testclient import TestClient
+
+import main
+
+def make_state():
+    """创建使用临时任务库的 State"""
+    os.environ["YTDLP_TASK_DB"] = os.path.join(tempfile.mkdtemp(), "tasks.db")
+    try:
+        return main.State()
+    finally:
+        del os.environ["YTDLP_TASK_DB"]
+
+def with_tasks(test) -> None:
+    """在包含 25 个任务（每第三个已取消）的临时任务库上运行 test(client, tasks)"""
+    original = main.state
+    main.state = make_state()
+    try:
+        for i in range(25):
+            task_id = main.state.add_task(f"https://example.com/{i}", "./downloads", "best")
+            if i % 3 == 0:
+                main.state.cancel_task(task_id)
+        rows = main.state.store.execute("SELECT id, status, created_at FROM tasks")
+        test(TestClient(main.app), [{"id": row[0], "status": row[1], "created_at": row[2]} for row in rows])
+    finally:
+        main.state = original
+
+def read_pages(client: TestClient, limit: int, **params) -> list:
+    """按 next_cursor 读完所有页，返回每页的数据"""
+    pages, cursor = [], None
+    while True:
+        response = client.get("/tasks", params=dict(params, limit=limit, **({"cursor": cursor} if cursor else {})))
+        assert response.status_code == 200
+        body = response.json()
+        pages.append(body["data"])
+        cursor = body["next_cursor"]
+        if cursor is None:
+            return pages
+
+def ordered(tasks: list, descending: bool = True) -> list:
+    return [task["id"] for task in sorted(tasks, key=lambda task: (task["created_at"], task["id"]), reverse=descending)]
+
+def test_cursor_pagination():
+    """分页结果与一次性查询完全一致，没有重复和遗漏；过滤条件在每一页都生效"""
+    def run(client: TestClient, tasks: list) -> None:
+        pages = read_pages(client, 7)
+        assert [len(page) for page in pages] == [7, 7, 7, 4]
+        assert [item["id"] for page in pages for item in page] == ordered(tasks)
+        assert "result" not in pages[0][0]
+
+        # 结果数恰好是页大小的整数倍时，最后一页之后没有多余的空页
+        pages = read_pages(client, 5, order="asc")
+        assert [len(page) for page in pages] == [5] * 5
+        assert [item["id"] for page in pages for item in page] == ordered(tasks, descending=False)
+
+        canceled = [task for task in tasks if task["status"] == "canceled"]
+        pages = read_pages(client, 4, status="canceled")
+        assert [item["id"] for page in pages for item in page] == ordered(canceled)
+
+        since = sorted(task["created_at"] for task in tasks)[10]
+        recent = [task for task in tasks if task["created_at"] >= since and task["status"] == "pending"]
+        pages = read_pages(client, 3, status="pending,downloading", since=since)
+        items = [item for page in pages for item in page]
+        assert [item["id"] for item in items] == ordered(recent)
+        assert all(item["status"] == "pending" and item["created_at"] >= since for item in items)
+
+        assert client.get("/tasks", params={"cursor": "not-a-cursor"}).status_code == 400
+
+    with_tasks(run)
+
+def test_ndjson():
+    """ndjson 返回所有匹配的任务，每行一个 JSON 对象，只包含请求的字段"""
+    def run(client: TestClient, tasks: list) -> None:
+        response = client.get("/tasks", params={"format": "ndjson", "fields": "id,status", "order": "asc", "limit": 5})
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        assert response.text.endswith("\n")
+        items = [json.loads(line) for line in response.text.splitlines()]
+        assert [item["id"] for item in items] == ordered(tasks, descending=False)
+        assert all(set(item) == {"id", "status"} for item in items)
+
+        response = client.get("/tasks", params={"format": "ndjson", "status": "canceled"})
+        assert len(response.text.splitlines()) == sum(task["status"] == "canceled" for task in tasks)
+
+    with_tasks(run)
+
+if __name__ == "__main__":
+    test_cursor_pagination()
+    test_ndjson()
+    print("✅ 所有测试完成")
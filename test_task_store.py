@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试任务库：批量写入进度、多进程共享时的原子认领、启动和租约过期时的回收，以及跨进程取消
+"""
+
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import main
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# 子进程：不断认领等待中的任务，输出认领到的任务ID
+CLAIM_WORKER = """
+import main
+claimed = []
+while True:
+    pending = main.state.list_pending_tasks(10)
+    if not pending:
+        break
+    for task in pending:
+        if main.state.claim_task(task.id):
+            claimed.append(task.id)
+            main.state.update_task(task.id, "completed", result={"worker": main.state.store.owner})
+print("\\n".join(claimed))
+"""
+
+# 子进程：认领一个任务后直接退出，模拟工作进程崩溃
+CRASH_WORKER = """
+import os
+import main
+task = main.state.list_pending_tasks(1)[0]
+assert main.state.claim_task(task.id)
+print(task.id, flush=True)
+os._exit(1)
+"""
+
+def make_state(db_file, lease_ttl=30.0):
+    """创建一个使用共享任务库的 State，相当于另一个工作进程"""
+    os.environ.update(YTDLP_TASK_DB=db_file, YTDLP_SHARED_STORE="true", YTDLP_LEASE_TTL=str(lease_ttl))
+    try:
+        return main.State()
+    finally:
+        for name in ("YTDLP_TASK_DB", "YTDLP_SHARED_STORE", "YTDLP_LEASE_TTL"):
+            del os.environ[name]
+
+def run_worker(db_file, script, lease_ttl=30.0):
+    env = dict(os.environ, YTDLP_TASK_DB=db_file, YTDLP_SHARED_STORE="true", YTDLP_LEASE_TTL=str(lease_ttl))
+    return subprocess.Popen([sys.executable, "-c", script], cwd=ROOT, env=env, stdout=subprocess.PIPE, text=True)
+
+def stored_row(db_file, task_id):
+    """用独立的连接读取数据库中已经写入的状态和进度"""
+    conn = sqlite3.connect(db_file)
+    try:
+        return conn.execute("SELECT status, progress FROM tasks WHERE id = ?", (task_id,)).fetchone()
+    finally:
+        conn.close()
+
+def test_progress_updates_are_batched():
+    """进度更新按任务合并后一次写入；状态变化和终态立即写入"""
+    db_file = os.path.join(tempfile.mkdtemp(), "tasks.db")
+    # 后台线程在测试期间不会写入
+    os.environ.update(YTDLP_TASK_DB=db_file, YTDLP_DB_FLUSH_INTERVAL="3600")
+    try:
+        state = main.State()
+    finally:
+        for name in ("YTDLP_TASK_DB", "YTDLP_DB_FLUSH_INTERVAL"):
+            del os.environ[name]
+    store = state.store
+    first = state.add_task("https://example.com/first", "./downloads", "best")
+    second = state.add_task("https://example.com/second", "./downloads", "best")
+    assert stored_row(db_file, first) == ("pending", None)
+    assert state.claim_task(first) and state.claim_task(second)
+    assert stored_row(db_file, first)[0] == "downloading"
+
+    writes, flushes = store.stats["row_writes"], store.stats["flushes"]
+    for downloaded in range(5):
+        state.update_task(first, "downloading", progress={"downloaded_bytes": downloaded})
+        state.update_task(second, "downloading", progress={"downloaded_bytes": downloaded})
+    assert stored_row(db_file, first) == ("downloading", None)
+    assert store.stats["row_writes"] == writes
+
+    store.flush()
+    assert store.stats["row_writes"] == writes + 2 and store.stats["flushes"] == flushes + 1
+    assert stored_row(db_file, first)[1] == '{"downloaded_bytes": 4}'
+
+    state.update_task(first, "downloading", progress={"downloaded_bytes": 10})
+    state.update_task(second, "failed", error="boom")
+    state.update_task(first, "completed", result={"title": "v"})
+    assert stored_row(db_file, second)[0] == "failed"
+    assert stored_row(db_file, first) == ("completed", '{"downloaded_bytes": 10}')
+    store.close()
+
+class LockedConnection:
+    """批量写入时报告数据库被锁定的连接，其他操作交给原连接"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def executemany(self, *args):
+        raise sqlite3.OperationalError("database is locked")
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+def test_failed_flush_is_retried():
+    """写入失败的任务放回待写入队列，终态在下一次写入时落库"""
+    db_file = os.path.join(tempfile.mkdtemp(), "tasks.db")
+    os.environ.update(YTDLP_TASK_DB=db_file, YTDLP_DB_FLUSH_INTERVAL="3600")
+    try:
+        state = main.State()
+    finally:
+        for name in ("YTDLP_TASK_DB", "YTDLP_DB_FLUSH_INTERVAL"):
+            del os.environ[name]
+    store = state.store
+    task_id = state.add_task("https://example.com/locked", "./downloads", "best")
+    assert state.claim_task(task_id)
+    conn, store.conn = store.conn, LockedConnection(store.conn)
+    try:
+        state.update_task(task_id, "completed", result={"title": "v"})
+    finally:
+        store.conn = conn
+    assert stored_row(db_file, task_id)[0] == "downloading"
+    assert store.stats["failed_flushes"] == 1
+
+    store.flush()
+    assert stored_row(db_file, task_id)[0] == "completed"
+    assert store.execute("SELECT lease_owner FROM tasks WHERE id = ?", (task_id,)) == [(None,)]
+    store.close()
+
+def test_claims_are_exclusive_across_processes():
+    """多个进程竞争同一个队列时每个任务只被认领一次"""
+    db_file = os.path.join(tempfile.mkdtemp(), "tasks.db")
+    state = make_state(db_file)
+    task_ids = {state.add_task(f"https://example.com/{i}", "./downloads", "best") for i in range(60)}
+
+    workers = [run_worker(db_file, CLAIM_WORKER) for _ in range(4)]
+    claimed = []
+    for worker in workers:
+        output, _ = worker.communicate(timeout=60)
+        assert worker.returncode == 0
+        claimed.extend(line for line in output.split() if line)
+
+    assert len(claimed) == len(set(claimed))
+    assert set(claimed) == task_ids
+    rows = state.store.execute("SELECT COUNT(*) FROM tasks WHERE status = 'completed' AND lease_owner IS NULL")
+    assert rows[0][0] == len(task_ids)
+
+def test_startup_recovers_interrupted_tasks():
+    """单进程模式重启时回收上次运行中的所有任务（不等待租约过期），并记录可续传的 .part 字节数"""
+    root = tempfile.mkdtemp()
+    db_file = os.path.join(root, "tasks.db")
+    output_path = os.path.join(root, "downloads")
+    os.makedirs(output_path)
+    os.environ["YTDLP_TASK_DB"] = db_file
+    try:
+        before = main.State()
+    finally:
+        del os.environ["YTDLP_TASK_DB"]
+    downloading, postprocessing, canceling, pending = [
+        before.add_task(f"https://example.com/{name}", output_path, "best")
+        for name in ("downloading", "postprocessing", "canceling", "pending")
+    ]
+    video = os.path.join(output_path, "v.mp4")
+    for suffix, size in ((".part", 1000), (".part-Frag1", 200), (".part-Frag2.part", 30), (".ytdl", 5)):
+        with open(video + suffix, "wb") as f:
+            f.write(b"x" * size)
+    for task_id in (downloading, postprocessing, canceling):
+        assert before.claim_task(task_id)
+    before.update_task(downloading, "downloading", progress={"filename": video, "downloaded_bytes": 1230})
+    before.update_task(postprocessing, "postprocessing")
+    assert before.cancel_task(canceling) == "canceling"
+    before.store.flush()
+
+    # 模拟进程崩溃后重启：租约仍未过期，但单进程模式下没有其他持有者
+    os.environ["YTDLP_TASK_DB"] = db_file
+    try:
+        after = main.State()
+    finally:
+        del os.environ["YTDLP_TASK_DB"]
+    recovered = after.recover_interrupted_tasks()
+    assert sorted(task.id for task in recovered) == sorted([downloading, postprocessing])
+
+    task = after.get_task(downloading)
+    assert task.status == "pending" and task.progress["status"] == "interrupted"
+    # 只统计 .part 和分片缓存，.ytdl 元数据不计入
+    assert task.progress["resumable_bytes"] == 1230 and task.progress["filename"] == video
+    assert after.get_task(postprocessing).progress["resumable_bytes"] == 0
+    assert after.get_task(canceling).status == "canceled"
+    assert after.get_task(pending).status == "pending"
+    assert stored_row(db_file, downloading)[0] == "pending"
+    # 已经回收的任务不会被再次回收，可以重新认领
+    assert after.recover_interrupted_tasks() == []
+    assert after.claim_task(downloading) is not None
+
+def test_stale_lease_is_reclaimed():
+    """崩溃进程的租约过期后，任务被其他进程回收并重新认领"""
+    db_file = os.path.join(tempfile.mkdtemp(), "tasks.db")
+    state = make_state(db_file, lease_ttl=1.0)
+    task_id = state.add_task("https://example.com/crash", "./downloads", "best")
+
+    worker = run_worker(db_file, CRASH_WORKER, lease_ttl=1.0)
+    output, _ = worker.communicate(timeout=60)
+    assert output.strip() == task_id
+    assert state.get_task(task_id).status == "downloading"
+    # 租约未过期前不会被回收
+    assert state.recover_interrupted_tasks(force=False) == []
+
+    time.sleep(1.2)
+    recovered = state.recover_interrupted_tasks(force=False)
+    assert [task.id for task in recovered] == [task_id]
+    assert state.get_task(task_id).progress["status"] == "interrupted"
+    assert state.claim_task(task_id) is not None
+
+def test_cancel_propagates_to_lease_owner():
+    """其他进程发出的取消通过心跳同步到持有租约的进程"""
+    db_file = os.path.join(tempfile.mkdtemp(), "tasks.db")
+    owner = make_state(db_file)
+    other = make_state(db_file)
+    task_id = other.add_task("https://example.com/cancel", "./downloads", "best")
+    assert owner.claim_task(task_id) is not None
+    assert other.claim_task(task_id) is None
+
+    assert other.cancel_task(task_id) == "canceling"
+    # 持有者的进度更新不会把 canceling 覆盖回 downloading
+    owner.update_task(task_id, "downloading", progress={"percent": 10})
+    owner.store.flush()
+    assert other.get_task(task_id).status == "canceling"
+
+    owner.heartbeat()
+    assert owner.is_cancel_requested(task_id)
+    owner.update_task(task_id, "canceled", error="Canceled by user")
+    assert other.get_task(task_id).status == "canceled"
+
+def test_deleted_task_is_not_resurrected():
+    """任务被其他进程删除后，持有者停止写入"""
+    db_file = os.path.join(tempfile.mkdtemp(), "tasks.db")
+    owner = make_state(db_file)
+    other = make_state(db_file)
+    task_id = other.add_task("https://example.com/delete", "./downloads", "best")
+    assert owner.claim_task(task_id) is not None
+
+    assert other.delete_task(task_id)
+    owner.heartbeat()
+    assert owner.is_cancel_requested(task_id)
+    owner.update_task(task_id, "canceled", error="Canceled by user")
+    owner.store.flush()
+    assert other.get_task(task_id) is None
+
+if __name__ == "__main__":
+    test_progress_updates_are_batched()
+    test_failed_flush_is_retried()
+    test_claims_are_exclusive_across_processes()
+    test_startup_recovers_interrupted_tasks()
+    test_stale_lease_is_reclaimed()
+    test_cancel_propagates_to_lease_owner()
+    test_deleted_task_is_not_resurrected()
+    print("✅ 所有测试完成")
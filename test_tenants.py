@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试 API 密钥识别租户、租户之间的加权公平排队、优先级，以及并发和每日流量配额
+"""
+
+import asyncio
+import os
+import tempfile
+import types
+import uuid
+
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import main
+from main import (DEFAULT_TENANT, DownloadScheduler, Task, TenantConfig, TenantRegistry, admit_request, make_dedup_key, restart_task,
+                  stop_task, submit_download)
+
+def registry(**configs) -> TenantRegistry:
+    return TenantRegistry({name: TenantConfig(**config).model_dump() for name, config in configs.items()}, None, main.state.store)
+
+def make_task(tenant: str, priority: int = 0) -> Task:
+    return Task(id=str(uuid.uuid4()), url="https://example.com/v", output_path=".", format="best", status="pending",
+                priority=priority, tenant=tenant)
+
+def pop_tenants(scheduler: DownloadScheduler, count: int):
+    popped = []
+    for _ in range(count):
+        item, _ = scheduler._pop_next()
+        if item is None:
+            break
+        popped.append(item[3])
+        scheduler._release(item[2], item[3])
+    return popped
+
+def test_authenticate():
+    tenants = TenantRegistry({"alice": TenantConfig(keys=["a1", "a2"]).model_dump()}, "legacy", main.state.store)
+    assert tenants.auth_required
+    assert tenants.authenticate("a2") == "alice"
+    assert tenants.authenticate("legacy") == DEFAULT_TENANT
+    assert tenants.authenticate("unknown") is None and tenants.authenticate(None) is None
+    # 配置中没有的租户使用默认值，快照中不包含密钥
+    assert tenants.config("bob")["weight"] == 1.0
+    assert "keys" not in tenants.snapshot({}, {})["alice"]
+    assert not TenantRegistry({}, None, main.state.store).auth_required
+
+def test_weighted_fair_queuing():
+    """权重为 2 的租户开始的任务是权重为 1 的两倍，排队较少的租户不会被大批量提交饿死"""
+    original = main.tenants
+    main.tenants = registry(alice={"weight": 2}, bob={"weight": 1})
+    try:
+        scheduler = DownloadScheduler(1)
+        for _ in range(20):
+            scheduler.submit(make_task("alice"))
+        for _ in range(3):
+            scheduler.submit(make_task("bob"))
+        popped = pop_tenants(scheduler, 9)
+        assert popped.count("alice") == 6 and popped.count("bob") == 3
+        # 优先级高的任务先于其他租户的任务开始
+        scheduler.submit(make_task("bob", priority=main.PRIORITY_LEVELS["high"]))
+        assert pop_tenants(scheduler, 1) == ["bob"]
+    finally:
+        main.tenants = original
+
+def test_tenant_limits():
+    """达到并发上限或用完当天流量的租户不再开始新任务，其他租户不受影响"""
+    busy, capped = f"busy-{uuid.uuid4()}", f"capped-{uuid.uuid4()}"
+    original = main.tenants
+    main.tenants = registry(**{busy: {"max_concurrent": 1}, capped: {"max_bytes_per_day": 100}})
+    try:
+        scheduler = DownloadScheduler(2)
+        scheduler.submit(make_task(busy))
+        scheduler.submit(make_task(busy))
+        item, _ = scheduler._pop_next()
+        assert item[3] == busy
+        assert scheduler._pop_next() == (None, None)
+        scheduler._release(item[2], item[3])
+
+        # 每个文件的第一次进度回调只作为基准
+        main.tenants.record_progress("t", capped, "v.mp4", 10)
+        main.tenants.record_progress("t", capped, "v.mp4", 160)
+        main.tenants.finish("t")
+        assert main.tenants.bytes_today(capped) == 150
+        # 用量写入数据库后重新读取，结果不变
+        main.tenants.sync()
+        assert main.tenants.bytes_today(capped) == 150
+        scheduler.submit(make_task(capped))
+        item, _ = scheduler._pop_next()
+        assert item[3] == busy
+        item, wait = scheduler._pop_next()
+        assert item is None and wait > 0
+    finally:
+        main.tenants = original
+
+def test_admission():
+    limited = f"limited-{uuid.uuid4()}"
+    original = main.tenants
+    main.tenants = registry(**{limited: {"max_bytes_per_day": 100, "max_priority": "normal"}})
+    request = types.SimpleNamespace(state=types.SimpleNamespace(tenant=limited))
+    try:
+        assert admit_request(request, "low") == (limited, main.PRIORITY_LEVELS["low"])
+        try:
+            admit_request(request, "high")
+        except HTTPException as e:
+            assert e.status_code == 403
+        else:
+            raise AssertionError("priority above the tenant's maximum should be rejected")
+        main.tenants.record_progress("t", limited, "v.mp4", 0)
+        main.tenants.record_progress("t", limited, "v.mp4", 100)
+        try:
+            admit_request(request, "normal")
+        except HTTPException as e:
+            assert e.status_code == 429 and int(e.headers["Retry-After"]) > 0
+        else:
+            raise AssertionError("tenant over its daily quota should be rejected")
+        assert main.tenants.rejected[limited] == 1
+    finally:
+        main.tenants.finish("t")
+        main.tenants = original
+
+def test_task_endpoints_are_scoped():
+    """其他租户停止或重新开始任务时返回 404；用完配额的租户不能通过重新开始绕过配额"""
+    owner = f"owner-{uuid.uuid4()}"
+    original = main.tenants
+    main.tenants = registry(**{owner: {"max_bytes_per_day": 100}})
+    task_id = main.state.add_task(f"https://example.com/{uuid.uuid4()}", "./downloads", "best", tenant=owner)
+    as_owner = types.SimpleNamespace(state=types.SimpleNamespace(tenant=owner))
+    as_other = types.SimpleNamespace(state=types.SimpleNamespace(tenant=DEFAULT_TENANT))
+
+    def status_code(call) -> int:
+        try:
+            asyncio.run(call)
+        except HTTPException as e:
+            return e.status_code
+        return 200
+
+    try:
+        assert status_code(stop_task(task_id, as_other)) == 404
+        assert main.state.get_task(task_id).status == "pending"
+        assert status_code(stop_task(task_id, as_owner)) == 200
+        assert main.state.get_task(task_id).status == "canceled"
+        assert status_code(restart_task(task_id, as_other)) == 404
+        main.tenants.record_progress("t", owner, "v.mp4", 0)
+        main.tenants.record_progress("t", owner, "v.mp4", 100)
+        assert status_code(restart_task(task_id, as_owner)) == 429
+        assert main.state.get_task(task_id).status == "canceled"
+    finally:
+        main.tenants.finish("t")
+        main.tenants = original
+        main.state.delete_task(task_id)
+
+def test_dedup_within_tenant():
+    """相同的链接只在同一租户内去重，其他租户得到自己的任务并可以管理它"""
+    url = f"https://example.com/{uuid.uuid4()}"
+    original = main.scheduler
+    main.scheduler = DownloadScheduler(1)
+    task_ids = set()
+
+    def submit(tenant: str) -> dict:
+        result = asyncio.run(submit_download(None, url, "./downloads", "best", False, False, tenant=tenant))
+        task_ids.add(result["task_id"])
+        return result
+
+    try:
+        first = submit("alice")
+        assert first["created"] and submit("alice") == {"task_id": first["task_id"], "created": False}
+        second = submit("bob")
+        assert second["created"] and second["task_id"] != first["task_id"]
+        assert main.state.get_task(second["task_id"]).tenant == "bob"
+        assert main.scheduler.queued_by_tenant() == {"alice": 1, "bob": 1}
+        as_bob = types.SimpleNamespace(state=types.SimpleNamespace(tenant="bob"))
+        asyncio.run(stop_task(second["task_id"], as_bob))
+        assert main.state.get_task(second["task_id"]).status == "canceled"
+        assert main.state.get_task(first["task_id"]).status == "pending"
+    finally:
+        main.scheduler = original
+        for task_id in task_ids:
+            main.state.delete_task(task_id)
+
+def test_dedup_keys_migrated():
+    """旧版本生成的去重键（不含租户；其他站点也去掉 ref 等参数并统一为 https）在启动时按新规则重新生成"""
+    db_file = os.path.join(tempfile.mkdtemp(), "tasks.db")
+    os.environ["YTDLP_TASK_DB"] = db_file
+    try:
+        state = main.State()
+        task_id = state.add_task("https://example.com/old", "./downloads", "best", tenant="alice")
+        state.store.execute("UPDATE tasks SET dedup_key = ? WHERE id = ?", (make_dedup_key("https://example.com/old", "./downloads", "best"), task_id))
+        http_id = state.add_task("http://example.com/v?ref=a", "./downloads", "best")
+        state.store.execute("UPDATE tasks SET dedup_key = ? WHERE id = ?", (make_dedup_key("https://example.com/v", "./downloads", "best"), http_id))
+        state.store.execute("PRAGMA user_version = 0")
+        state.store.close()
+        state = main.State()
+    finally:
+        del os.environ["YTDLP_TASK_DB"]
+    assert state.find_duplicate("https://example.com/old", "./downloads", "best", "alice").id == task_id
+    assert state.find_duplicate("https://example.com/old", "./downloads", "best") is None
+    assert state.find_duplicate("http://example.com/v?ref=a", "./downloads", "best").id == http_id
+    assert state.find_duplicate("https://example.com/v", "./downloads", "best") is None
+    state.store.close()
+
+def keyed_registry() -> TenantRegistry:
+    return TenantRegistry({name: TenantConfig(keys=[f"{name}-key"]).model_dump() for name in ("alice", "bob")}, None, main.state.store,
+                          admin_key="admin-key")
+
+def test_reads_are_scoped():
+    """租户只能查看自己的任务、列表和队列；管理员密钥可以查看所有租户并修改下载限制"""
+    original_tenants, original_scheduler = main.tenants, main.scheduler
+    main.tenants, main.scheduler = keyed_registry(), DownloadScheduler(1)
+    prefix = f"https://example.com/{uuid.uuid4()}/"
+    task_ids = {name: main.state.add_task(prefix + name, "./downloads", "best", tenant=name) for name in ("alice", "bob")}
+    client = TestClient(main.app)
+    alice, bob, admin = ({"X-API-Key": f"{name}-key"} for name in ("alice", "bob", "admin"))
+    try:
+        for task_id in task_ids.values():
+            main.scheduler.submit(main.state.get_task(task_id))
+        bob_task = task_ids["bob"]
+        for path in (f"/task/{bob_task}", f"/task/{bob_task}/events", f"/download/{bob_task}/file", f"/download/{bob_task}/stream",
+                     f"/queue?task_id={bob_task}"):
+            assert client.get(path, headers=alice).status_code == 404, path
+        assert client.get(f"/task/{bob_task}", headers=bob).status_code == 200
+        assert client.get(f"/task/{bob_task}", headers=admin).status_code == 200
+
+        listed = client.get("/tasks", params={"url_prefix": prefix}, headers=alice).json()["data"]
+        assert [item["id"] for item in listed] == [task_ids["alice"]]
+        assert client.get("/tasks", params={"tenant": "bob"}, headers=alice).status_code == 403
+        listed = client.get("/tasks", params={"url_prefix": prefix, "tenant": "bob"}, headers=admin).json()["data"]
+        assert [item["id"] for item in listed] == [bob_task]
+        assert len(client.get("/tasks", params={"url_prefix": prefix}, headers=admin).json()["data"]) == 2
+
+        queue = client.get("/queue", headers=bob).json()["data"]
+        assert queue["depth"] == 1 and queue["tasks"] == [{"id": bob_task, "position": 2}]
+        assert list(queue["tenants"]) == ["bob"]
+        assert client.get("/queue", headers=admin).json()["data"]["depth"] == 2
+
+        assert client.put("/limits", json={}, headers=alice).status_code == 403
+        assert client.put("/limits", json={}, headers=admin).status_code == 200
+    finally:
+        main.tenants, main.scheduler = original_tenants, original_scheduler
+        for task_id in task_ids.values():
+            main.state.delete_task(task_id)
+
+def test_websocket_events_are_scoped():
+    """WebSocket 即使订阅了其他租户的任务ID，也只推送调用方租户的任务事件"""
+    original = main.tenants
+    main.tenants = keyed_registry()
+    try:
+        with TestClient(main.app) as client:
+            task_ids = {name: main.state.add_task(f"https://example.com/{uuid.uuid4()}", "./downloads", "best", tenant=name)
+                        for name in ("alice", "bob")}
+            try:
+                with client.websocket_connect(f"/events?task_ids={task_ids['bob']}", headers={"X-API-Key": "alice-key"}) as websocket:
+                    # 其他租户的任务不推送当前状态，只收到自己任务的快照
+                    websocket.send_json({"subscribe": [task_ids["alice"]]})
+                    assert [e["id"] for e in websocket.receive_json()["data"]] == [task_ids["alice"]]
+                    main.state.cancel_task(task_ids["bob"])
+                    main.state.cancel_task(task_ids["alice"])
+                    message = websocket.receive_json()
+                    assert [(e["id"], e["tenant"]) for e in message["data"]] == [(task_ids["alice"], "alice")]
+            finally:
+                for task_id in task_ids.values():
+                    main.state.delete_task(task_id)
+    finally:
+        main.tenants = original
+
+class OfflineStore:
+    def execute(self, *args, **kwargs):
+        raise AssertionError("the database must not be accessed")
+
+    transaction = execute
+
+def test_dispatch_reads_usage_from_memory():
+    """出队和准入检查不访问数据库，数据库中的用量由 sync 在事件循环之外读取"""
+    capped = f"capped-{uuid.uuid4()}"
+    original = main.tenants
+    main.tenants = registry(**{capped: {"max_bytes_per_day": 100}})
+    main.state.store.execute("INSERT INTO tenant_usage (tenant, day, bytes) VALUES (?, ?, ?)", (capped, main.utc_day(), 500))
+    try:
+        # 其他进程写入的用量在 sync 之后才可见
+        assert main.tenants.bytes_today(capped) == 0
+        main.tenants.sync()
+        main.tenants.store = OfflineStore()
+        scheduler = DownloadScheduler(1)
+        scheduler.submit(make_task(capped))
+        item, wait = scheduler._pop_next()
+        assert item is None and wait > 0
+        request = types.SimpleNamespace(state=types.SimpleNamespace(tenant=capped))
+        try:
+            admit_request(request, "normal")
+        except HTTPException as e:
+            assert e.status_code == 429
+        else:
+            raise AssertionError("tenant over its daily quota should be rejected")
+    finally:
+        main.tenants = original
+
+if __name__ == "__main__":
+    test_authenticate()
+    test_weighted_fair_queuing()
+    test_tenant_limits()
+    test_admission()
+    test_task_endpoints_are_scoped()
+    test_dispatch_reads_usage_from_memory()
+    test_dedup_within_tenant()
+    test_dedup_keys_migrated()
+    test_reads_are_scoped()
+    test_websocket_events_are_scoped()
+    print("✅ 所有测试完成")
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试 YoutubeDL 实例池：相同选项复用实例，每个任务的选项、钩子和后处理器不会带到下一个任务
+"""
+
+from main import FormatSelectedPP, YoutubeDLPool
+
+def test_reuse_and_reset():
+    pool = YoutubeDLPool(max_idle=2)
+    hook = lambda progress: None
+    with pool.checkout({"quiet": True}, {"outtmpl": "/a/%(title)s.%(ext)s", "format": "best", "progress_hooks": [hook]}) as first:
+        first.add_post_processor(FormatSelectedPP(lambda info: None), when="before_dl")
+        first.params["ratelimit"] = 1000
+        assert first.params["outtmpl"]["default"] == "/a/%(title)s.%(ext)s"
+        assert first._progress_hooks == [hook]
+        task_params = first.params
+    with pool.checkout({"quiet": True}, {"format": "worst"}) as second:
+        assert second is first
+        assert second.params is not task_params
+        assert second.params["format"] == "worst"
+        assert "ratelimit" not in second.params
+        assert second.params["outtmpl"]["default"] != "/a/%(title)s.%(ext)s"
+        assert second._progress_hooks == [] and second._pps["before_dl"] == []
+    # 选项不同的任务使用另一个实例
+    with pool.checkout({"quiet": False}) as other:
+        assert other is not first
+    assert pool.metrics()["created"] == 2 and pool.metrics()["reused"] == 1
+
+def test_discard_after_error():
+    """运行中出错的实例不放回池中"""
+    pool = YoutubeDLPool(max_idle=2)
+    try:
+        with pool.checkout({"quiet": True}) as ydl:
+            failed = ydl
+            raise RuntimeError("boom")
+    except RuntimeError:
+        pass
+    with pool.checkout({"quiet": True}) as ydl:
+        assert ydl is not failed
+    assert pool.metrics()["discarded"] == 1
+
+def test_pool_disabled():
+    pool = YoutubeDLPool(max_idle=0)
+    with pool.checkout({"quiet": True}) as first:
+        pass
+    with pool.checkout({"quiet": True}) as second:
+        assert second is not first
+    assert pool.metrics()["idle"] == 0
+
+if __name__ == "__main__":
+    test_reuse_and_reset()
+    test_discard_after_error()
+    test_pool_disabled()
+    print("✅ 所有测试完成")